@@ -0,0 +1 @@
+default_app_config = 'debits.debits_base.apps.DebitsBaseConfig'
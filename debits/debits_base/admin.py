@@ -0,0 +1,125 @@
+"""Django admin for purchases, payments and transactions.
+
+The lists load related objects (through the multi-table inheritance chain) in the same query,
+filter and search only by indexed columns and don't count all rows of big tables.
+Bulk actions change the selected purchases by a few `UPDATE` queries in one transaction; the action
+which needs to call payment processors (canceling subscriptions) queues the purchases for
+the `cancels` job of :mod:`debits.debits_base.scheduler`."""
+
+from django.conf import settings
+from django.contrib import admin, messages
+from django.core.paginator import Paginator
+from django.db import connections, transaction
+from django.utils.functional import cached_property
+from django.utils.translation import ugettext_lazy as _
+
+from debits.debits_base.models import SubscriptionPurchase, Purchase, Payment, BaseTransaction
+
+
+class EstimatedCountPaginator(Paginator):
+    """A paginator which, on PostgreSQL, takes the number of rows of an unfiltered big table
+    from the table statistics instead of counting them.
+
+    The estimate is used when it is above `settings.PAYMENTS_ADMIN_EXACT_COUNT_LIMIT` (10000 by default)."""
+
+    @cached_property
+    def count(self):
+        query = self.object_list.query
+        connection = connections[self.object_list.db]
+        if connection.vendor == 'postgresql' and not query.where:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s", [query.model._meta.db_table])
+                row = cursor.fetchone()
+            if row is not None and row[0] > getattr(settings, 'PAYMENTS_ADMIN_EXACT_COUNT_LIMIT', 10000):
+                return int(row[0])
+        return super().count
+
+
+class ScalableAdmin(admin.ModelAdmin):
+    """Internal.
+
+    Common options of the admins of big tables."""
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_per_page = 100
+
+
+def set_purchase_flags(queryset, **fields):
+    """Internal.
+
+    Sets fields of :class:`Purchase` for the selected subscription purchases and updates their statuses,
+    in one transaction, without loading them."""
+    with transaction.atomic():
+        pks = queryset.values('pk')
+        count = Purchase.objects.filter(pk__in=pks).update(**fields)
+        SubscriptionPurchase.update_statuses(pks)
+    return count
+
+
+@admin.register(SubscriptionPurchase)
+class SubscriptionPurchaseAdmin(ScalableAdmin):
+    list_display = ('id', 'item', 'email', 'processor', 'subscription_reference', 'status', 'due_payment_date',
+                    'payment_deadline', 'blocked', 'gratis')
+    list_select_related = ('item__product', 'processor')
+    list_filter = ('status', 'processor')
+    search_fields = ('=subscription_reference',)
+    raw_id_fields = ('item', 'payment', 'parent', 'old_subscription')
+    readonly_fields = ('version', 'status', 'next_action', 'next_action_at')
+    actions = ('block', 'unblock', 'make_gratis', 'cancel')
+
+    def block(self, request, queryset):
+        count = set_purchase_flags(queryset, blocked=True)
+        self.message_user(request, _("%d purchase(s) blocked.") % count)
+    block.short_description = _("Block selected purchases")
+
+    def unblock(self, request, queryset):
+        count = set_purchase_flags(queryset, blocked=False)
+        self.message_user(request, _("%d purchase(s) unblocked.") % count)
+    unblock.short_description = _("Unblock selected purchases")
+
+    def make_gratis(self, request, queryset):
+        count = set_purchase_flags(queryset, gratis=True)
+        self.message_user(request, _("%d purchase(s) made gratis.") % count)
+    make_gratis.short_description = _("Make selected purchases gratis")
+
+    def cancel(self, request, queryset):
+        count = SubscriptionPurchase.request_cancels(queryset)
+        self.message_user(request, _("%d subscription(s) queued for canceling.") % count, messages.INFO)
+    cancel.short_description = _("Cancel automatic payments of selected purchases")
+
+
+@admin.register(Payment)
+class PaymentAdmin(ScalableAdmin):
+    list_display = ('id', 'payment_time', 'email', 'transaction', 'transaction_purchase', 'transaction_processor',
+                    'refunded')
+    list_select_related = ('transaction__purchase__item__product', 'transaction__processor')
+    search_fields = ('=email',)
+    raw_id_fields = ('transaction',)
+    actions = ('mark_refunded',)
+
+    def transaction_purchase(self, payment):
+        return payment.transaction.purchase
+    transaction_purchase.short_description = _("Purchase")
+
+    def transaction_processor(self, payment):
+        return payment.transaction.processor
+    transaction_processor.short_description = _("Processor")
+
+    def mark_refunded(self, request, queryset):
+        # Payments don't store the processor's sale ID, so the money cannot be returned from here.
+        # Payments already refunded are skipped (see Payment.refund_payment()).
+        with transaction.atomic():
+            payments = queryset.filter(refunded=False).select_related('transaction__purchase__item')
+            recorded = sum(payment.refund_payment() for payment in payments)
+        self.message_user(request, _("%d refund(s) recorded.") % recorded)
+    mark_refunded.short_description = _("Record refunds of selected payments (refund them at the processor first)")
+
+
+@admin.register(BaseTransaction)
+class BaseTransactionAdmin(ScalableAdmin):
+    list_display = ('id', 'creation_date', 'invoice', 'purchase', 'processor')
+    list_select_related = ('purchase__item__product', 'processor')
+    list_filter = ('processor',)
+    search_fields = ('=invoice',)
+    raw_id_fields = ('purchase',)
+    readonly_fields = ('nonce', 'invoice')
@@ -0,0 +1,14 @@
+from django.apps import AppConfig
+from django.db.models.signals import post_save, post_delete
+
+
+class DebitsBaseConfig(AppConfig):
+    name = 'debits.debits_base'
+    label = 'debits_base'
+    verbose_name = "Debits"
+
+    def ready(self):
+        from debits.debits_base.models import PaymentProcessor, processor_registry
+        post_save.connect(processor_registry.clear, sender=PaymentProcessor, dispatch_uid='debits_processor_registry')
+        post_delete.connect(processor_registry.clear, sender=PaymentProcessor, dispatch_uid='debits_processor_registry')
+        import debits.debits_base.signals  # connects signal handlers
@@ -0,0 +1,231 @@
+"""Archiving old unpaid transactions, abandoned purchases and purchases superseded by upgrades.
+
+Archived rows are deleted from the DB and written to a text stream (usually a gzipped file),
+one line (a JSON array in Django serialization format) per archived transaction or purchase
+(with its subclass rows, for a superseded purchase with its transactions, payments and lineage,
+and for a purchase, its item if not used by other purchases).
+:func:`restore` brings them back.
+
+Every chunk is archived in a separate short DB transaction. An object is archived only
+if deleting it would not delete or modify anything except of what is archived together with it."""
+
+import datetime
+from itertools import islice
+
+from django.core import serializers
+from django.db import transaction, router, connections, IntegrityError
+from django.db.models import ProtectedError, Q, F, Min
+from django.db.models.deletion import Collector
+from django.utils import timezone
+
+from debits.debits_base.base import logger
+from debits.debits_base.models import BaseTransaction, Purchase, Item, Payment, PurchaseLineage
+
+
+class ArchiveCollector(Collector):
+    """Internal.
+
+    Collects all deleted objects (without "fast deletes"), so that they all can be archived."""
+
+    def can_fast_delete(self, *args, **kwargs):
+        return False
+
+
+def archivable(collector, allowed):
+    """Internal.
+
+    Args:
+        collector: :class:`ArchiveCollector` with collected objects.
+        allowed: a dict from a base model to the set of PKs of its (or its subclasses) objects
+            which we allow to archive.
+
+    Returns:
+        Whether all collected objects are allowed."""
+    deleted = {(model._meta.concrete_model, obj.pk) for model, instances in collector.data.items() for obj in instances}
+    for model, updates in collector.field_updates.items():
+        for instances in updates.values():
+            if any((model._meta.concrete_model, obj.pk) not in deleted for obj in instances):
+                return False  # would modify an object which is not archived
+    for model, instances in collector.data.items():
+        base = next((b for b in allowed if issubclass(model, b)), None)
+        if base is None or any(obj.pk not in allowed[base] for obj in instances):
+            return False
+    return True
+
+
+def archive_objects(out, roots, allowed):
+    """Internal.
+
+    Archives `roots` (and everything their deletion cascades to) if allowed.
+
+    Returns:
+        Whether archived."""
+    collector = ArchiveCollector(using=router.db_for_write(type(roots[0])))
+    try:
+        for root in roots:
+            collector.collect([root])
+    except ProtectedError:
+        return False
+    if not archivable(collector, allowed):
+        return False
+    objs = [obj for instances in collector.data.values() for obj in instances]
+    objs.sort(key=lambda obj: len(obj._meta.get_parent_list()))  # parents first
+    out.write(serializers.serialize('json', objs) + '\n')
+    collector.delete()
+    return True
+
+
+def lock_rows(queryset):
+    """Internal.
+
+    `select_for_update()` locking only rows of the queryset model (not of outer joined tables)."""
+    if connections[queryset.db].features.has_select_for_update_of:
+        return queryset.select_for_update(of=('self',))
+    return queryset.select_for_update()
+
+
+def archive_chunked(out, queryset, chunk_size, archive_one):
+    """Internal."""
+    last_pk = 0
+    count = 0
+    while True:
+        with transaction.atomic():
+            objs = list(lock_rows(queryset.filter(pk__gt=last_pk).order_by('pk')[:chunk_size]))
+            if not objs:
+                break
+            last_pk = objs[-1].pk
+            for obj in objs:
+                if archive_one(out, obj):
+                    count += 1
+        out.flush()  # before the next transaction, so that archived data is not lost
+    return count
+
+
+def archive_unpaid_transactions(out, days, chunk_size=100):
+    """Archive transactions without payments created more than `days` days ago.
+
+    Transactions of subscribed purchases (which may be charged later) and of purchases
+    in an unexpired trial are not archived, so that their IPNs can still find them.
+
+    Returns:
+        The number of archived transactions."""
+    cutoff = timezone.now() - datetime.timedelta(days=days)
+    queryset = BaseTransaction.objects.filter(creation_date__lt=cutoff, payment__isnull=True).\
+        exclude(Q(purchase__subscriptionpurchase__subscription_reference__isnull=False) |
+                Q(purchase__subscriptionpurchase__trial=True,
+                  purchase__subscriptionpurchase__payment_deadline__gte=datetime.date.today()))
+    return archive_chunked(out, queryset, chunk_size,
+                           lambda out, t: archive_objects(out, [t], {BaseTransaction: {t.pk}}))
+
+
+def archive_abandoned_purchases(out, days, chunk_size=100):
+    """Archive unpaid purchases without transactions (for example, left after upgrades
+    which were not paid) created more than `days` days ago.
+
+    Active and gratis subscriptions and purchases referred from other models
+    (for example, from an organization of your app) are not archived.
+
+    Returns:
+        The number of archived purchases."""
+    cutoff = timezone.now() - datetime.timedelta(days=days)
+    queryset = Purchase.objects.filter(creation_date__lt=cutoff, payment__isnull=True,
+                                       transactions__isnull=True, gratis=False).\
+        exclude(subscriptionpurchase__payment_deadline__gte=datetime.date.today())
+
+    def archive_one(out, purchase):
+        roots = [purchase]
+        allowed = {Purchase: {purchase.pk}}
+        if not Purchase.objects.filter(item_id=purchase.item_id).exclude(pk=purchase.pk).exists():
+            roots.append(purchase.item)
+            allowed[Item] = {purchase.item_id}
+        return archive_objects(out, roots, allowed)
+
+    return archive_chunked(out, queryset, chunk_size, archive_one)
+
+
+class NotArchived(Exception):
+    """Internal."""
+    pass
+
+
+def archive_superseded_purchases(out, days, chunk_size=100):
+    """Archive purchases replaced by a completed upgrade (not the head of their
+    :class:`~debits.debits_base.models.PurchaseLineage`) created more than `days` days ago,
+    together with their transactions, payments and lineage rows.
+
+    Purchases with an active subscription (whose cancel may be not yet done), purchases being upgraded
+    and purchases referred from other models (for example, from an organization of your app) are not archived.
+    If the first purchase of a chain is archived, the next remaining one becomes the root of the chain.
+
+    Returns:
+        The number of archived purchases."""
+    cutoff = timezone.now() - datetime.timedelta(days=days)
+    queryset = Purchase.objects.filter(creation_date__lt=cutoff, lineage__isnull=False).\
+        exclude(lineage__head_id=F('pk')).\
+        exclude(subscriptionpurchase__subscription_reference__isnull=False)
+
+    def archive_one(out, purchase):
+        transactions = set(BaseTransaction.objects.filter(purchase=purchase).values_list('pk', flat=True))
+        roots = [purchase]
+        allowed = {Purchase: {purchase.pk},
+                   BaseTransaction: transactions,
+                   Payment: set(Payment.objects.filter(transaction_id__in=transactions).values_list('pk', flat=True)),
+                   PurchaseLineage: {purchase.pk}}
+        if not Purchase.objects.filter(item_id=purchase.item_id).exclude(pk=purchase.pk).exists():
+            roots.append(purchase.item)
+            allowed[Item] = {purchase.item_id}
+        try:
+            with transaction.atomic():
+                chain = PurchaseLineage.objects.filter(root_id=purchase.pk).exclude(purchase_id=purchase.pk)
+                new_root = chain.aggregate(root=Min('purchase_id'))['root']
+                if new_root is not None:
+                    chain.update(root_id=new_root)
+                if not archive_objects(out, roots, allowed):
+                    raise NotArchived  # rolls back the new root
+        except NotArchived:
+            return False
+        return True
+
+    return archive_chunked(out, queryset, chunk_size, archive_one)
+
+
+def restore_line(line):
+    """Internal.
+
+    Inserts the objects of an archive line.
+
+    Returns:
+        Whether restored (`False` if some of the objects already exist)."""
+    try:
+        with transaction.atomic():
+            for obj in serializers.deserialize('json', line):
+                obj.save(force_insert=True)
+    except IntegrityError:
+        return False
+    return True
+
+
+def restore(stream, chunk_size=100):
+    """Restore objects archived by :func:`archive_unpaid_transactions`, :func:`archive_abandoned_purchases`
+    or :func:`archive_superseded_purchases`.
+
+    Objects are only inserted: an archived transaction or purchase (with the objects archived together with it)
+    which already exists in the DB (was restored before or created again) is skipped and logged,
+    so existing data is never overwritten. So restoring the same data again does no harm.
+
+    Returns:
+        The numbers of restored and skipped transactions and purchases."""
+    lines = iter(stream)
+    restored = skipped = 0
+    while True:
+        chunk = list(islice(lines, chunk_size))
+        if not chunk:
+            break
+        with transaction.atomic():
+            for line in chunk:
+                if restore_line(line):
+                    restored += 1
+                else:
+                    skipped += 1
+                    logger.warning("Not restored (already exists): %s" % line.strip()[:200])
+    return restored, skipped
@@ -1,6 +1,9 @@
 import logging
+from decimal import Decimal
 from composite_field import CompositeField
 from dateutil.relativedelta import relativedelta
+from django.conf import settings
+from django.core.cache import caches
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 
@@ -9,6 +12,13 @@ logger = logging.getLogger('debits')
 """The logger used by Debits."""
 
 
+def get_cache():
+    """The Django cache used by Debits.
+
+    It is the cache named by `settings.PAYMENTS_CACHE` (`'default'` if not set)."""
+    return caches[getattr(settings, 'PAYMENTS_CACHE', 'default')]
+
+
 class Period(CompositeField):
     """Period (for example of recurring payment or of a trial subscription).
 
@@ -62,3 +72,13 @@ def period_to_delta(period):
         Period.UNIT_MONTHS: lambda: relativedelta(months=period.count),
         Period.UNIT_YEARS: lambda: relativedelta(years=period.count),
     }[period.unit]()
+
+
+def period_to_months(period):
+    """Convert :class:`Period` to the (fractional) number of months, as :class:`Decimal`."""
+    return {
+        Period.UNIT_DAYS: lambda: Decimal(period.count) * 12 / Decimal('365.25'),
+        Period.UNIT_WEEKS: lambda: Decimal(period.count) * 7 * 12 / Decimal('365.25'),
+        Period.UNIT_MONTHS: lambda: Decimal(period.count),
+        Period.UNIT_YEARS: lambda: Decimal(period.count) * 12,
+    }[period.unit]()
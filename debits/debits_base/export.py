@@ -0,0 +1,118 @@
+"""Exporting payments (together with their transactions, purchases, items and products) as CSV or JSON Lines.
+
+Every payment becomes one row. Rows are read in one query joining all the tables, by key ranges
+of :attr:`~debits.debits_base.models.Payment.pk`, with server-side cursors where the DB supports them,
+so that the memory used does not depend on the number of exported payments."""
+
+import csv
+import datetime
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from debits.debits_base.models import Payment
+
+
+EXPORT_FIELDS = (
+    ('payment_id', 'pk'),
+    ('payment_time', 'payment_time'),
+    ('payment_email', 'email'),
+    ('subscription_reference', 'automaticpayment__subscription_reference'),
+    ('transaction_id', 'transaction_id'),
+    ('invoice', 'transaction__invoice'),
+    ('processor', 'transaction__processor__name'),
+    ('transaction_date', 'transaction__creation_date'),
+    ('purchase_id', 'transaction__purchase_id'),
+    ('purchase_date', 'transaction__purchase__creation_date'),
+    ('gratis', 'transaction__purchase__gratis'),
+    ('shipping', 'transaction__purchase__shipping'),
+    ('tax', 'transaction__purchase__tax'),
+    ('due_payment_date', 'transaction__purchase__subscriptionpurchase__due_payment_date'),
+    ('payment_deadline', 'transaction__purchase__subscriptionpurchase__payment_deadline'),
+    ('trial', 'transaction__purchase__subscriptionpurchase__trial'),
+    ('item_id', 'transaction__purchase__item_id'),
+    ('product', 'transaction__purchase__item__product__name'),
+    ('product_qty', 'transaction__purchase__item__product_qty'),
+    ('currency', 'transaction__purchase__item__currency'),
+    ('price', 'transaction__purchase__item__price'),
+)
+"""Pairs (column name, lookup from :class:`~debits.debits_base.models.Payment`)."""
+
+COLUMNS = [column for column, lookup in EXPORT_FIELDS]
+
+
+def day_start(date):
+    """Internal.
+
+    The beginning of the day as a datetime comparable with `DateTimeField` values."""
+    result = datetime.datetime.combine(date, datetime.time.min)
+    return timezone.make_aware(result) if settings.USE_TZ else result
+
+
+def export_rows(since=None, until=None, chunk_size=2000):
+    """Generates exported rows (tuples of values of :data:`COLUMNS`).
+
+    Args:
+        since: export payments made on or after this date or `None`.
+        until: export payments made before this date or `None`.
+        chunk_size: how many rows to read with one query."""
+    queryset = Payment.objects.all()
+    if since is not None:
+        queryset = queryset.filter(payment_time__gte=day_start(since))
+    if until is not None:
+        queryset = queryset.filter(payment_time__lt=day_start(until))
+    queryset = queryset.order_by('pk').values_list(*[lookup for column, lookup in EXPORT_FIELDS])
+    last_pk = 0
+    while True:
+        count = 0
+        for row in queryset.filter(pk__gt=last_pk)[:chunk_size].iterator(chunk_size=chunk_size):
+            count += 1
+            last_pk = row[0]
+            yield row
+        if count < chunk_size:
+            break
+
+
+class Echo(object):
+    """Internal.
+
+    A pseudo-file returning what is written, for :func:`csv_lines`."""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    """Generates CSV lines (with the header) for :func:`export_rows`."""
+    writer = csv.writer(Echo())
+    yield writer.writerow(COLUMNS)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def jsonl_lines(rows):
+    """Generates JSON Lines for :func:`export_rows`."""
+    for row in rows:
+        yield json.dumps(dict(zip(COLUMNS, row)), cls=DjangoJSONEncoder) + '\n'
+
+
+FORMATS = {
+    'csv': (csv_lines, 'text/csv'),
+    'jsonl': (jsonl_lines, 'application/jsonl'),
+}
+"""Export format name -> (lines generator, MIME type)."""
+
+
+def month_range(month):
+    """Internal.
+
+    Args:
+        month: a string like ``2020-05``.
+
+    Returns:
+        A pair of dates: the first day of the month and the first day of the next month."""
+    since = datetime.datetime.strptime(month, '%Y-%m').date()
+    until = (since + datetime.timedelta(days=31)).replace(day=1)
+    return since, until
@@ -0,0 +1,117 @@
+"""Payment, transaction and purchase history, newest first, by pages.
+
+Pages are selected by keyset pagination: a page continues after the (time, PK) of the last row of
+the previous page, passed as an opaque cursor string. It is backed by indexes on (time, PK),
+so any page costs as much as the first one, whatever the size of the table."""
+
+import base64
+import binascii
+from collections import namedtuple
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from debits.debits_base.models import Payment, BaseTransaction, Purchase
+
+MAX_LIMIT = 500
+"""The maximum number of rows in a page."""
+
+Page = namedtuple('Page', ('rows', 'next_cursor'))
+"""A page of history: the list of rows (dicts) and the cursor of the next page (`None` for the last page)."""
+
+PAYMENT_FIELDS = ('id', 'payment_time', 'email', 'transaction_id', 'transaction__invoice',
+                  'transaction__purchase_id', 'transaction__processor__name')
+"""The fields of payment history rows."""
+
+TRANSACTION_FIELDS = ('id', 'creation_date', 'invoice', 'purchase_id', 'processor__name', 'payment__id')
+"""The fields of transaction history rows."""
+
+PURCHASE_FIELDS = ('id', 'creation_date', 'item_id', 'item__product__name', 'item__price', 'item__currency',
+                   'gratis', 'blocked', 'payment_id', 'old_subscription_id')
+"""The fields of purchase history rows."""
+
+
+def encode_cursor(time, pk):
+    """Internal."""
+    return base64.urlsafe_b64encode(('%s,%d' % (time.isoformat(), pk)).encode('ascii')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Internal.
+
+    Raises `ValueError` for a wrong cursor."""
+    try:
+        time, pk = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii').rsplit(',', 1)
+        time = parse_datetime(time)
+    except (TypeError, UnicodeError, binascii.Error):
+        raise ValueError("Wrong cursor")
+    if time is None:
+        raise ValueError("Wrong cursor")
+    return time, int(pk)
+
+
+def keyset_page(queryset, time_field, fields, cursor=None, limit=50):
+    """A :class:`Page` of `queryset` ordered by (`time_field`, PK) descending.
+
+    Args:
+        queryset: the rows to show.
+        time_field: the name of a `DateTimeField` of the model (there should be an index on it and the PK).
+        fields: the fields of the rows (they should include `time_field` and ``'id'``).
+        cursor: :attr:`Page.next_cursor` of the previous page or `None` for the first page.
+        limit: the maximal number of rows (not more than :data:`MAX_LIMIT`).
+
+    Raises `ValueError` for a wrong cursor."""
+    limit = max(1, min(limit, MAX_LIMIT))
+    if cursor is not None:
+        time, pk = decode_cursor(cursor)
+        # The first condition alone limits the index range scan.
+        queryset = queryset.filter(Q(**{time_field + '__lte': time}),
+                                   Q(**{time_field + '__lt': time}) | Q(pk__lt=pk))
+    rows = list(queryset.order_by('-' + time_field, '-pk').values(*fields)[:limit + 1])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][time_field], rows[-1]['id'])
+    return Page(rows, next_cursor)
+
+
+def payment_history(purchase_ids=None, email=None, cursor=None, limit=50):
+    """A :class:`Page` of payments, newest first.
+
+    Args:
+        purchase_ids: show only payments for these purchases (for example, all purchases of a customer) or `None`.
+        email: show only payments by this email or `None`.
+        cursor: see :func:`keyset_page`.
+        limit: see :func:`keyset_page`."""
+    queryset = Payment.objects.all()
+    if purchase_ids is not None:
+        queryset = queryset.filter(transaction_purchase_id__in=purchase_ids)
+    if email is not None:
+        queryset = queryset.filter(email=email)
+    return keyset_page(queryset, 'payment_time', PAYMENT_FIELDS, cursor, limit)
+
+
+def transaction_history(purchase_ids=None, cursor=None, limit=50):
+    """A :class:`Page` of transactions, newest first.
+
+    Args:
+        purchase_ids: show only transactions of these purchases or `None`.
+        cursor: see :func:`keyset_page`.
+        limit: see :func:`keyset_page`."""
+    queryset = BaseTransaction.objects.all()
+    if purchase_ids is not None:
+        queryset = queryset.filter(purchase_id__in=purchase_ids)
+    return keyset_page(queryset, 'creation_date', TRANSACTION_FIELDS, cursor, limit)
+
+
+def purchase_history(purchase_ids=None, cursor=None, limit=50):
+    """A :class:`Page` of purchases, newest first.
+
+    Args:
+        purchase_ids: show only these purchases or `None`.
+        cursor: see :func:`keyset_page`.
+        limit: see :func:`keyset_page`."""
+    queryset = Purchase.objects.all()
+    if purchase_ids is not None:
+        queryset = queryset.filter(pk__in=purchase_ids)
+    return keyset_page(queryset, 'creation_date', PURCHASE_FIELDS, cursor, limit)
@@ -0,0 +1,77 @@
+"""Loading a transaction together with its purchase, item and product (for IPN handlers).
+
+A burst of IPNs about one purchase (for example, `subscr_signup` and `subscr_payment`) needs
+the same objects. The transaction row and the item (with its subclass row and product) rarely
+change, so they are cached for `settings.PAYMENTS_LOADER_CACHE_TIMEOUT` seconds (60 by default)
+and removed from the cache by signals when saved or deleted. The purchase, which changes
+on every IPN, is always read from the DB (in one query, with its subclass rows)."""
+
+from django.conf import settings
+
+from debits.debits_base.base import get_cache
+from debits.debits_base.models import Item, Purchase
+
+LOADER_CACHE_VERSION = 1
+"""Increase it when the format of cached objects changes."""
+
+
+def transaction_cache_key(pk):
+    """Internal."""
+    return 'debits.loader:%d:t:%d' % (LOADER_CACHE_VERSION, pk)
+
+
+def item_cache_key(pk):
+    """Internal."""
+    return 'debits.loader:%d:i:%d' % (LOADER_CACHE_VERSION, pk)
+
+
+def invalidate_transactions(*pks):
+    """Remove cached transactions. It is called automatically when a transaction is saved or deleted."""
+    get_cache().delete_many([transaction_cache_key(pk) for pk in pks])
+
+
+def invalidate_items(*pks):
+    """Remove cached items. It is called automatically when an item or a product is saved or deleted."""
+    get_cache().delete_many([item_cache_key(pk) for pk in pks])
+
+
+def cache_timeout():
+    """Internal."""
+    return getattr(settings, 'PAYMENTS_LOADER_CACHE_TIMEOUT', 60)
+
+
+def load_item(pk):
+    """An :class:`~debits.debits_base.models.Item` with its product and subclass rows
+    (`subscriptionitem` or `simpleitem`) loaded. Don't modify it."""
+    cache = get_cache()
+    item = cache.get(item_cache_key(pk))
+    if item is None:
+        item = Item.objects.select_related('product', 'subscriptionitem', 'simpleitem').get(pk=pk)
+        cache.set(item_cache_key(pk), item, cache_timeout())
+    return item
+
+
+def load_transaction(klass, pk):
+    """A transaction with its purchase (with its subclass rows), item and product loaded.
+
+    Args:
+        klass: :class:`~debits.debits_base.models.BaseTransaction` or its subclass.
+        pk: the transaction PK.
+
+    Raises `klass.DoesNotExist` if there is no such transaction of this class."""
+    cache = get_cache()
+    transaction = cache.get(transaction_cache_key(pk))
+    if not isinstance(transaction, klass):
+        transaction = klass.objects.get(pk=pk)
+        cache.set(transaction_cache_key(pk), transaction, cache_timeout())
+    purchase = Purchase.objects.select_related('subscriptionpurchase', 'simplepurchase__prolongpurchase',
+                                               'payment').get(pk=transaction.purchase_id)
+    item = load_item(purchase.item_id)
+    purchase.item = item
+    for child in ('subscriptionpurchase', 'simplepurchase'):
+        try:
+            getattr(purchase, child).item = item
+        except Purchase.DoesNotExist:
+            pass
+    transaction.purchase = purchase
+    return transaction
@@ -0,0 +1,38 @@
+"""Serializing processing of events (such as IPNs) of one purchase.
+
+PayPal sends several IPNs for one purchase almost at the same time (for example, `subscr_signup`
+and `subscr_payment`). :func:`purchase_lock` makes them run one after another, so that the second
+one sees the changes of the first. Events of different purchases still run in parallel.
+
+Requests to payment processors, emails and hooks of an event are deferred until the lock is released
+(by :func:`~debits.debits_base.models.after_commit`)."""
+
+from contextlib import contextmanager
+
+from django.db import connections, router, transaction
+
+from debits.debits_base.models import Purchase
+
+ADVISORY_LOCK_CLASS = 0x44656269
+"""The first key of PostgreSQL advisory locks of purchases (the second key is the purchase PK)."""
+
+
+@contextmanager
+def purchase_lock(purchase_id):
+    """Runs the block in a DB transaction holding an exclusive lock of the purchase.
+
+    On PostgreSQL it is a transaction-level advisory lock (which does not lock any rows),
+    otherwise the row of the purchase is locked by `SELECT ... FOR UPDATE`.
+
+    Args:
+        purchase_id: the PK of the :class:`~debits.debits_base.models.Purchase` or `None` for no locking."""
+    using = router.db_for_write(Purchase)
+    with transaction.atomic(using=using):
+        if purchase_id is not None:
+            connection = connections[using]
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)", [ADVISORY_LOCK_CLASS, purchase_id])
+            else:
+                list(Purchase.objects.using(using).select_for_update().filter(pk=purchase_id).values_list('pk'))
+        yield
@@ -0,0 +1,35 @@
+import gzip
+
+from django.core.management.base import BaseCommand
+
+from debits.debits_base.archive import archive_unpaid_transactions, archive_abandoned_purchases, \
+    archive_superseded_purchases
+
+
+class Command(BaseCommand):
+    help = "Move old unpaid transactions, abandoned purchases and purchases superseded by upgrades " \
+           "from the DB to an archive file " \
+           "(gzipped if its name ends with .gz)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help="The archive file (appended to, if exists).")
+        parser.add_argument('--days', type=int, required=True,
+                            help="Archive only objects created more than this number of days ago.")
+        parser.add_argument('--chunk-size', type=int, default=100,
+                            help="How many objects to archive in one DB transaction.")
+        parser.add_argument('--only', choices=['transactions', 'purchases', 'superseded'],
+                            help="Archive only unpaid transactions, only abandoned purchases "
+                                 "or only superseded purchases.")
+
+    def handle(self, *args, **options):
+        opener = gzip.open if options['output'].endswith('.gz') else open
+        with opener(options['output'], 'at', encoding='utf-8') as out:
+            if options['only'] in (None, 'transactions'):
+                count = archive_unpaid_transactions(out, options['days'], options['chunk_size'])
+                self.stdout.write("%d transaction(s) archived." % count)
+            if options['only'] in (None, 'purchases'):
+                count = archive_abandoned_purchases(out, options['days'], options['chunk_size'])
+                self.stdout.write("%d purchase(s) archived." % count)
+            if options['only'] in (None, 'superseded'):
+                count = archive_superseded_purchases(out, options['days'], options['chunk_size'])
+                self.stdout.write("%d superseded purchase(s) archived." % count)
@@ -0,0 +1,86 @@
+import datetime
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router
+from django.utils import timezone
+
+from debits.debits_base.models import BaseTransaction, Purchase, SubscriptionPurchase, SubscriptionAction, \
+    SubscriptionStatus, Payment, AutomaticPayment
+
+
+def hot_queries():
+    """The queries which must use indexes, as (name, queryset) pairs.
+
+    The parameters are typical for the app (for example, archiving selects transactions
+    older than 90 days), so that on real data the queries select a small part of the tables."""
+    today = datetime.date.today()
+    now = timezone.now()
+    day_ago = now - datetime.timedelta(days=1)
+    archive_cutoff = now - datetime.timedelta(days=90)
+    return [
+        ('send_reminders', SubscriptionPurchase.objects.filter(next_action_at__lte=today,
+                                                               next_action__in=SubscriptionAction.REMINDERS)),
+        ('sweep_expired', SubscriptionPurchase.objects.filter(next_action_at__lte=today, payment_deadline__lt=today,
+                                                              expired=False, gratis=False).order_by('next_action_at')),
+        ('grace_period', SubscriptionPurchase.objects.filter(status=SubscriptionStatus.GRACE,
+                                                             payment_deadline__gte=today)),
+        ('cancel_requests', SubscriptionPurchase.objects.filter(cancel_requested_at__lte=now).
+         order_by('cancel_requested_at')),
+        ('subscription_reference', SubscriptionPurchase.objects.filter(subscription_reference='I-0')),
+        ('automatic_payment_reference', AutomaticPayment.objects.filter(subscription_reference='I-0')),
+        ('invoice', BaseTransaction.objects.filter(invoice='0-0')),
+        ('payments_by_time', Payment.objects.filter(payment_time__gte=day_ago).order_by('payment_time')),
+        ('unpaid_transactions', BaseTransaction.objects.filter(creation_date__lt=archive_cutoff,
+                                                               payment__isnull=True)),
+        ('payment_history', Payment.objects.filter(payment_time__lte=now).order_by('-payment_time', '-pk')[:50]),
+        ('payment_purchase_history', Payment.objects.filter(transaction_purchase_id__in=[0, 1],
+                                                            payment_time__lte=now).order_by('-payment_time', '-pk')[:50]),
+        ('payment_email_history', Payment.objects.filter(email='a@example.com', payment_time__lte=now).
+         order_by('-payment_time', '-pk')[:50]),
+        ('transaction_history', BaseTransaction.objects.filter(purchase_id=0, creation_date__lte=now).
+         order_by('-creation_date', '-pk')[:50]),
+        ('purchase_history', Purchase.objects.filter(creation_date__lte=now).order_by('-creation_date', '-pk')[:50]),
+        ('abandoned_purchases', Purchase.objects.filter(creation_date__lt=archive_cutoff, payment__isnull=True,
+                                                        gratis=False)),
+    ]
+
+
+# Table scans in EXPLAIN output (the name of the table is the first group).
+FULL_SCAN = {
+    'postgresql': re.compile(r'Seq Scan on (\w+)'),
+    'sqlite': re.compile(r'\bSCAN (?:TABLE )?(\w+)\b(?! USING)'),
+}
+
+
+def explain(queryset):
+    """The query plan of a queryset and the list of tables it scans fully.
+
+    The planner chooses by the table statistics, so the result is meaningful only
+    for a DB with enough (real or generated) data, analyzed after filling it."""
+    using = router.db_for_read(queryset.model)
+    plan = queryset.using(using).explain()
+    pattern = FULL_SCAN.get(connections[using].vendor)
+    return plan, pattern.findall(plan) if pattern is not None else []
+
+
+class Command(BaseCommand):
+    help = "Show query plans of the hot queries of this app and check that they use indexes. " \
+           "Run it on a DB with production-sized data (small tables are always scanned)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help="Fail if a hot query reads a table without an index.")
+
+    def handle(self, *args, **options):
+        failed = []
+        for name, queryset in hot_queries():
+            plan, tables = explain(queryset)
+            self.stdout.write("== %s\n%s\n" % (name, plan))
+            if tables:
+                failed.append("%s (%s)" % (name, ', '.join(tables)))
+        if failed:
+            message = "Full table scans: " + '; '.join(failed)
+            if options['check']:
+                raise CommandError(message)
+            self.stderr.write(message)
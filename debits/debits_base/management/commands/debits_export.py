@@ -0,0 +1,41 @@
+import gzip
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from debits.debits_base.export import export_rows, month_range, FORMATS
+
+
+class Command(BaseCommand):
+    help = "Export payments with their transaction, purchase, item and product data as CSV or JSON Lines " \
+           "(gzipped if the file name ends with .gz)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help="The output file or - for stdout.")
+        parser.add_argument('--format', choices=sorted(FORMATS),
+                            help="The output format (by default, guessed from the file name, otherwise csv).")
+        parser.add_argument('--month', help="Export payments of this month (YYYY-MM).")
+        parser.add_argument('--since', type=parse_date, help="Export payments made on or after this date.")
+        parser.add_argument('--until', type=parse_date, help="Export payments made before this date.")
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help="How many rows to read with one query.")
+
+    def handle(self, *args, **options):
+        output = options['output']
+        format = options['format'] or ('jsonl' if '.jsonl' in output else 'csv')
+        since, until = options['since'], options['until']
+        if options['month']:
+            if since or until:
+                raise CommandError("--month cannot be used together with --since or --until.")
+            try:
+                since, until = month_range(options['month'])
+            except ValueError:
+                raise CommandError("Wrong --month, use YYYY-MM.")
+        lines = FORMATS[format][0](export_rows(since, until, options['chunk_size']))
+        if output == '-':
+            sys.stdout.writelines(lines)
+            return
+        opener = gzip.open if output.endswith('.gz') else open
+        with opener(output, 'wt', encoding='utf-8', newline='') as out:
+            out.writelines(lines)
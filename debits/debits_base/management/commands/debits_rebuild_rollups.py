@@ -0,0 +1,23 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from debits.debits_base.rollups import rebuild
+
+
+class Command(BaseCommand):
+    help = "Rebuild daily rollups (for dashboards) from payments and purchases."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help="How many rows to read with one query.")
+        parser.add_argument('--days', type=int, default=31,
+                            help="How many days to rebuild in one DB transaction.")
+        parser.add_argument('--since', type=datetime.date.fromisoformat,
+                            help="The first day to rebuild (YYYY-MM-DD), by default the first day with data.")
+        parser.add_argument('--until', type=datetime.date.fromisoformat,
+                            help="The day after the last day to rebuild (YYYY-MM-DD), "
+                                 "by default the day after the last day with data.")
+
+    def handle(self, *args, **options):
+        rebuild(options['since'], options['until'], chunk_size=options['chunk_size'], days=options['days'])
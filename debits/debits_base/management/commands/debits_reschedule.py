@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from debits.debits_base.models import SubscriptionPurchase
+
+
+class Command(BaseCommand):
+    help = "Recalculate the next scheduled action (reminder, expiry) of every subscription purchase."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="How many purchases to update in one query.")
+
+    def handle(self, *args, **options):
+        SubscriptionPurchase.reschedule_all(batch_size=options['batch_size'])
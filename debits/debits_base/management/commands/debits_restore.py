@@ -0,0 +1,20 @@
+import gzip
+
+from django.core.management.base import BaseCommand
+
+from debits.debits_base.archive import restore
+
+
+class Command(BaseCommand):
+    help = "Restore transactions and purchases from an archive file created by debits_archive."
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help="The archive file.")
+        parser.add_argument('--chunk-size', type=int, default=100,
+                            help="How many archived objects to restore in one DB transaction.")
+
+    def handle(self, *args, **options):
+        opener = gzip.open if options['input'].endswith('.gz') else open
+        with opener(options['input'], 'rt', encoding='utf-8') as stream:
+            restored, skipped = restore(stream, options['chunk_size'])
+        self.stdout.write("%d transaction(s) or purchase(s) restored, %d already existing skipped." % (restored, skipped))
@@ -0,0 +1,33 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from debits.debits_base.scheduler import Scheduler
+
+
+class Command(BaseCommand):
+    help = "Run periodic jobs (reminders, expiry, archiving) on one of the nodes running this command."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lease', type=int, default=60,
+                            help="Seconds after which another node takes over if the leader stops.")
+        parser.add_argument('--poll', type=int, default=10,
+                            help="How often (in seconds) to check for due jobs.")
+        parser.add_argument('--once', action='store_true',
+                            help="Run due jobs (if this node is the leader) once and exit.")
+
+    def handle(self, *args, **options):
+        scheduler = Scheduler(lease_seconds=options['lease'])
+        if options['once']:
+            try:
+                for run in scheduler.run_pending():
+                    self.stdout.write("%s: %s in %.1fs" % (run.job, "done" if run.succeeded else "failed",
+                                                          run.duration))
+            finally:
+                scheduler.release()
+            return
+        stop = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: stop.set())
+        scheduler.run_forever(poll=options['poll'], stop=stop)
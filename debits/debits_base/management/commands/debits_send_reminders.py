@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from debits.debits_base.workers import run_sharded
+
+
+class Command(BaseCommand):
+    help = "Send payment reminder emails which are due today."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help="How many purchases to claim at once.")
+        parser.add_argument('--node', type=int, default=0,
+                            help="The number of this node (from 0), when run on several nodes.")
+        parser.add_argument('--nodes', type=int, default=1,
+                            help="The number of nodes (purchases are split among them "
+                                 "by settings.PAYMENTS_WORKER_SHARDS shards).")
+        parser.add_argument('--processes', type=int,
+                            help="The number of processes (0 for the number of CPUs).")
+
+    def handle(self, *args, **options):
+        count = run_sharded('reminders', options['node'], options['nodes'], options['processes'],
+                            batch_size=options['batch_size'])
+        self.stdout.write("%d reminder(s) sent." % count)
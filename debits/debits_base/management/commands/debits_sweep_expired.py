@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from debits.debits_base.models import SubscriptionPurchase
+from debits.debits_base.workers import run_sharded
+
+
+class Command(BaseCommand):
+    help = "Mark subscription purchases with passed payment deadline as expired " \
+           "and call on_subscription_expired() of settings.PAYMENTS_CALLBACK. " \
+           "Also update subscription statuses changed because of the passed time."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="How many purchases to mark in one database transaction.")
+        parser.add_argument('--node', type=int, default=0,
+                            help="The number of this node (from 0), when run on several nodes.")
+        parser.add_argument('--nodes', type=int, default=1,
+                            help="The number of nodes (purchases are split among them "
+                                 "by settings.PAYMENTS_WORKER_SHARDS shards).")
+        parser.add_argument('--processes', type=int,
+                            help="The number of processes (0 for the number of CPUs).")
+
+    def handle(self, *args, **options):
+        count = run_sharded('expiry', options['node'], options['nodes'], options['processes'],
+                            batch_size=options['batch_size'])
+        self.stdout.write("%d purchase(s) expired." % count)
+        if options['node'] == 0:  # one node is enough
+            count = SubscriptionPurchase.sweep_statuses(batch_size=options['batch_size'])
+            self.stdout.write("%d status(es) changed." % count)
@@ -0,0 +1,73 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:49
+
+import datetime
+
+from django.conf import settings
+from django.db import migrations, models
+
+# The values of SubscriptionAction
+REMIND_BEFORE_DUE, REMIND_DUE, REMIND_DEADLINE, EXPIRE = 1, 2, 3, 4
+
+
+def next_action(purchase):
+    """(next_action_at, next_action) of a purchase, as calculated by SubscriptionPurchase.reschedule()."""
+    days_before = settings.PAYMENTS_DAYS_BEFORE_TRIAL_END_REMIND if purchase.trial \
+        else settings.PAYMENTS_DAYS_BEFORE_DUE_REMIND
+    actions = []
+    if purchase.reminders_sent < 3:
+        actions.append((purchase.due_payment_date - datetime.timedelta(days=days_before), REMIND_BEFORE_DUE))
+    if purchase.reminders_sent < 2:
+        actions.append((purchase.due_payment_date, REMIND_DUE))
+    if purchase.payment_deadline is not None:
+        if purchase.reminders_sent < 1:
+            actions.append((purchase.payment_deadline, REMIND_DEADLINE))
+        if not purchase.expired and not purchase.gratis:
+            actions.append((purchase.payment_deadline + datetime.timedelta(days=1), EXPIRE))
+    return min(actions) if actions else (None, None)
+
+
+def schedule_existing(apps, schema_editor):
+    """Schedules the next actions of existing purchases."""
+    SubscriptionPurchase = apps.get_model('debits_base', 'SubscriptionPurchase')
+    last_pk = 0
+    while True:
+        purchases = list(SubscriptionPurchase.objects.filter(pk__gt=last_pk).order_by('pk').
+                         only('trial', 'reminders_sent', 'due_payment_date', 'payment_deadline', 'expired',
+                              'gratis')[:1000])
+        if not purchases:
+            break
+        for purchase in purchases:
+            purchase.next_action_at, purchase.next_action = next_action(purchase)
+        SubscriptionPurchase.objects.bulk_update(purchases, ['next_action', 'next_action_at'])
+        last_pk = purchases[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    replaces = [
+        ('debits_base', '0003_subscriptionpurchase_expired'),
+        ('debits_base', '0004_subscriptionpurchase_next_action'),
+    ]
+
+    dependencies = [
+        ('debits_base', '0002_auto_20200504_0400'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscriptionpurchase',
+            name='expired',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='subscriptionpurchase',
+            name='next_action',
+            field=models.SmallIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='subscriptionpurchase',
+            name='next_action_at',
+            field=models.DateField(db_index=True, null=True),
+        ),
+        migrations.RunPython(schedule_existing, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('debits_base', '0003_squashed_0004_subscriptionpurchase_next_action'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='basetransaction',
+            name='nonce',
+            field=models.CharField(max_length=32, null=True, unique=True),
+        ),
+    ]
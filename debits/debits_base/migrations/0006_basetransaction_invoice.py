@@ -0,0 +1,64 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:55
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def make_invoice_id(transaction, kind):
+    """The invoice ID of a transaction, as generated by SimpleTransaction and SubscriptionTransaction."""
+    purchase = transaction.purchase
+    if kind == 'simple':
+        return settings.PAYMENTS_REALM + ' p-%d' % (purchase.pk,)
+    subinvoice = (purchase.old_subscription or purchase).subscriptionpurchase.subinvoice
+    if purchase.old_subscription_id:
+        return settings.PAYMENTS_REALM + ' %d-%d-u' % (purchase.pk, subinvoice)
+    return settings.PAYMENTS_REALM + ' %d-%d' % (purchase.pk, subinvoice)
+
+
+def fill_invoices(apps, schema_editor):
+    """Stores invoice IDs of existing transactions.
+
+    Several transactions of a purchase (checkouts started again) may have the same invoice ID.
+    It is stored only for the newest of them (all of them belong to the same purchase)."""
+    BaseTransaction = apps.get_model('debits_base', 'BaseTransaction')
+    used = set()
+    last_pk = None
+    while True:
+        q = BaseTransaction.objects.filter(invoice__isnull=True).order_by('-pk').\
+            select_related('simpletransaction', 'subscriptiontransaction', 'purchase__old_subscription')
+        if last_pk is not None:
+            q = q.filter(pk__lt=last_pk)
+        transactions = list(q[:1000])
+        if not transactions:
+            break
+        changed = []
+        for transaction in transactions:
+            if hasattr(transaction, 'simpletransaction'):
+                kind = 'simple'
+            elif hasattr(transaction, 'subscriptiontransaction'):
+                kind = 'subscription'
+            else:
+                continue
+            invoice = make_invoice_id(transaction, kind)
+            if invoice not in used and not BaseTransaction.objects.filter(invoice=invoice).exists():
+                used.add(invoice)
+                transaction.invoice = invoice
+                changed.append(transaction)
+        BaseTransaction.objects.bulk_update(changed, ['invoice'])
+        last_pk = transactions[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('debits_base', '0005_basetransaction_nonce'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='basetransaction',
+            name='invoice',
+            field=models.CharField(max_length=127, null=True, unique=True),
+        ),
+        migrations.RunPython(fill_invoices, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.2.25 on 2026-10-18 20:58
+
+from django.db import migrations, models
+
+from debits.debits_base.operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+
+    atomic = False  # for AddIndexConcurrently
+
+    dependencies = [
+        ('debits_base', '0006_basetransaction_invoice'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='automaticpayment',
+            index=models.Index(fields=['subscription_reference'], name='debits_autopayment_reference'),
+        ),
+        AddIndexConcurrently(
+            model_name='basetransaction',
+            index=models.Index(fields=['creation_date'], name='debits_transaction_created'),
+        ),
+        AddIndexConcurrently(
+            model_name='payment',
+            index=models.Index(fields=['payment_time'], name='debits_payment_time'),
+        ),
+        AddIndexConcurrently(
+            model_name='purchase',
+            index=models.Index(condition=models.Q(('gratis', False), ('payment__isnull', True)), fields=['creation_date'], name='debits_purchase_unpaid'),
+        ),
+        AddIndexConcurrently(
+            model_name='subscriptionpurchase',
+            index=models.Index(fields=['next_action', 'next_action_at'], name='debits_sp_next_action'),
+        ),
+        AddIndexConcurrently(
+            model_name='subscriptionpurchase',
+            index=models.Index(condition=models.Q(('expired', False)), fields=['next_action_at', 'payment_deadline'], name='debits_sp_to_expire'),
+        ),
+    ]
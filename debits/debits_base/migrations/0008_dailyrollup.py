@@ -0,0 +1,36 @@
+# Generated by Django 3.2.25 on 2026-10-18 21:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('debits_base', '0007_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('currency', models.CharField(max_length=3)),
+                ('payments', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('refunds', models.IntegerField(default=0)),
+                ('refunded', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('activations', models.IntegerField(default=0)),
+                ('cancellations', models.IntegerField(default=0)),
+                ('mrr_change', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('trials_started', models.IntegerField(default=0)),
+                ('trials_converted', models.IntegerField(default=0)),
+                ('product', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='debits_base.product')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='dailyrollup',
+            constraint=models.UniqueConstraint(fields=('day', 'product', 'currency'), name='debits_rollup_unique'),
+        ),
+    ]
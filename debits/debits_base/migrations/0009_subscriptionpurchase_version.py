@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 21:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('debits_base', '0008_dailyrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscriptionpurchase',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
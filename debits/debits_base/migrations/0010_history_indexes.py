@@ -0,0 +1,38 @@
+# Generated by Django 3.2.25 on 2026-10-18 21:15
+
+from django.db import migrations, models
+
+from debits.debits_base.operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+
+    atomic = False  # for AddIndexConcurrently
+
+    dependencies = [
+        ('debits_base', '0009_subscriptionpurchase_version'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='basetransaction',
+            index=models.Index(fields=['purchase', 'creation_date', 'id'], name='debits_transaction_history'),
+        ),
+        AddIndexConcurrently(
+            model_name='payment',
+            index=models.Index(fields=['payment_time', 'id'], name='debits_payment_history'),
+        ),
+        AddIndexConcurrently(
+            model_name='payment',
+            index=models.Index(fields=['email', 'payment_time', 'id'], name='debits_payment_email_history'),
+        ),
+        AddIndexConcurrently(
+            model_name='purchase',
+            index=models.Index(fields=['creation_date', 'id'], name='debits_purchase_history'),
+        ),
+        # replaced by debits_payment_history
+        migrations.RemoveIndex(
+            model_name='payment',
+            name='debits_payment_time',
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 3.2.25 on 2026-10-18 21:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def record_references(apps, schema_editor):
+    """Record the references of active subscriptions, so that they can be resolved after an upgrade."""
+    SubscriptionPurchase = apps.get_model('debits_base', 'SubscriptionPurchase')
+    PurchaseLineage = apps.get_model('debits_base', 'PurchaseLineage')
+    rows = SubscriptionPurchase.objects.filter(subscription_reference__isnull=False).\
+        values_list('pk', 'subscription_reference').order_by('pk')
+    batch = []
+    for pk, reference in rows.iterator():
+        batch.append(PurchaseLineage(purchase_id=pk, root_id=pk, head_id=pk, subscription_reference=reference))
+        if len(batch) == 1000:
+            PurchaseLineage.objects.bulk_create(batch)
+            batch = []
+    PurchaseLineage.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('debits_base', '0010_history_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PurchaseLineage',
+            fields=[
+                ('purchase', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='lineage', serialize=False, to='debits_base.purchase')),
+                ('subscription_reference', models.CharField(db_index=True, max_length=255, null=True)),
+                ('head', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='debits_base.purchase')),
+                ('root', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='debits_base.purchase')),
+            ],
+        ),
+        migrations.RunPython(record_references, migrations.RunPython.noop),
+    ]
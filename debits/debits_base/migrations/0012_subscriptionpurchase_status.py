@@ -0,0 +1,51 @@
+# Generated by Django 3.2.25 on 2026-10-18 21:21
+
+import datetime
+
+from django.db import migrations, models
+from django.db.models import Case, Q, Value, When
+
+from debits.debits_base.operations import AddIndexConcurrently
+
+TRIAL, ACTIVE, GRACE, EXPIRED, BLOCKED, GRATIS = range(1, 7)  # SubscriptionStatus
+
+
+def fill_statuses(apps, schema_editor):
+    """Computes the statuses of existing purchases as SubscriptionPurchase.compute_status() does
+    (there are no canceled ones yet), by ranges of 1000 PKs (each range is a separate statement)."""
+    SubscriptionPurchase = apps.get_model('debits_base', 'SubscriptionPurchase')
+    today = datetime.date.today()
+    derived = Case(
+        When(Q(payment_deadline__isnull=True) | Q(payment_deadline__lt=today), then=Value(EXPIRED)),
+        When(due_payment_date__lt=today, then=Value(GRACE)),
+        When(trial=True, then=Value(TRIAL)),
+        default=Value(ACTIVE))
+    last_pk = SubscriptionPurchase.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+    for start in range(0, last_pk, 1000):
+        queryset = SubscriptionPurchase.objects.filter(pk__gt=start, pk__lte=start + 1000)
+        # fields of Purchase (blocked, gratis) can be used only in filters of update()
+        queryset.filter(blocked=True).update(status=BLOCKED)
+        queryset.filter(blocked=False, gratis=True).update(status=GRATIS)
+        queryset.filter(blocked=False, gratis=False).update(status=derived)
+
+
+class Migration(migrations.Migration):
+
+    atomic = False  # for AddIndexConcurrently
+
+    dependencies = [
+        ('debits_base', '0011_purchaselineage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscriptionpurchase',
+            name='status',
+            field=models.SmallIntegerField(choices=[(1, 'Trial'), (2, 'Active'), (3, 'Grace period'), (4, 'Expired'), (5, 'Blocked'), (6, 'Gratis'), (7, 'Canceled')], default=4, verbose_name='Status'),
+        ),
+        migrations.RunPython(fill_statuses, migrations.RunPython.noop),
+        AddIndexConcurrently(
+            model_name='subscriptionpurchase',
+            index=models.Index(fields=['status', 'payment_deadline'], name='debits_sp_status'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.2.25 on 2026-10-18 21:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('debits_base', '0012_subscriptionpurchase_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job', models.CharField(max_length=100)),
+                ('node', models.CharField(max_length=255)),
+                ('started', models.DateTimeField()),
+                ('duration', models.FloatField(null=True)),
+                ('succeeded', models.BooleanField(null=True)),
+                ('error', models.TextField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SchedulerLease',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('holder', models.CharField(max_length=255)),
+                ('expires_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='jobrun',
+            index=models.Index(fields=['job', 'started'], name='debits_jobrun_started'),
+        ),
+    ]
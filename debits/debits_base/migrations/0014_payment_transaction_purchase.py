@@ -0,0 +1,41 @@
+# Generated by Django 3.2.25 on 2026-10-18 21:49
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+from debits.debits_base.operations import AddIndexConcurrently
+
+
+def fill_transaction_purchase(apps, schema_editor):
+    """Copies the purchases of the transactions of existing payments, by ranges of 1000 PKs
+    (each range is a separate statement, not to lock the whole table)."""
+    Payment = apps.get_model('debits_base', 'Payment')
+    BaseTransaction = apps.get_model('debits_base', 'BaseTransaction')
+    purchase = Subquery(BaseTransaction.objects.filter(pk=OuterRef('transaction_id')).values('purchase_id')[:1])
+    last_pk = Payment.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+    for start in range(0, last_pk, 1000):
+        Payment.objects.filter(pk__gt=start, pk__lte=start + 1000, transaction_purchase__isnull=True).\
+            update(transaction_purchase=purchase)
+
+
+class Migration(migrations.Migration):
+
+    atomic = False  # for AddIndexConcurrently
+
+    dependencies = [
+        ('debits_base', '0013_scheduler'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='transaction_purchase',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='debits_base.purchase'),
+        ),
+        migrations.RunPython(fill_transaction_purchase, migrations.RunPython.noop),
+        AddIndexConcurrently(
+            model_name='payment',
+            index=models.Index(fields=['transaction_purchase', 'payment_time', 'id'], name='debits_payment_purchase_hist'),
+        ),
+    ]
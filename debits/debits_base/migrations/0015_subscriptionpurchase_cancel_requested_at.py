@@ -0,0 +1,26 @@
+# Generated by Django 3.2.25 on 2026-10-18 21:52
+
+from django.db import migrations, models
+
+from debits.debits_base.operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+
+    atomic = False  # for AddIndexConcurrently
+
+    dependencies = [
+        ('debits_base', '0014_payment_transaction_purchase'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscriptionpurchase',
+            name='cancel_requested_at',
+            field=models.DateTimeField(null=True),
+        ),
+        AddIndexConcurrently(
+            model_name='subscriptionpurchase',
+            index=models.Index(condition=models.Q(('cancel_requested_at__isnull', False)), fields=['cancel_requested_at'], name='debits_sp_cancel_requested'),
+        ),
+    ]
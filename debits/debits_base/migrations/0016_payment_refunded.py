@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 22:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('debits_base', '0015_subscriptionpurchase_cancel_requested_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='refunded',
+            field=models.BooleanField(default=False),
+        ),
+    ]
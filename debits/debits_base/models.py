@@ -1,22 +1,45 @@
 import abc
+import hashlib
 import hmac
 import datetime
+import secrets
+import threading
+import random
+import time
+from decimal import Decimal
 
 import html2text
+from asgiref.sync import sync_to_async
 from django.apps import apps
 from django.urls import reverse
-from django.db import models
-from django.db.models import F
+from django.db import models, IntegrityError, router
+from django.db.models import F, Q, Case, When, Value
+from django.db.models.functions import Mod
 import django.db
 from django.db import transaction
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.mail import send_mail
 from django.template.loader import render_to_string
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from composite_field import CompositeField
 from django.conf import settings
 
-from debits.debits_base.base import logger, Period, period_to_delta
+from debits.debits_base.base import logger, Period, period_to_delta, period_to_months, get_cache
+
+
+def after_commit(func, *args, **kwargs):
+    """Runs `func(*args, **kwargs)` after the current DB transaction (of purchases) is committed
+    (at once, if there is no transaction), logging its exceptions.
+
+    Requests to payment processors, emails and :class:`~debits.debits_base.processors.PaymentCallback`
+    hooks run so, not to hold :func:`~debits.debits_base.locks.purchase_lock` and DB locks while they wait."""
+    def run():
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logger.exception("Error after commit in %s" % getattr(func, '__qualname__', func))
+    transaction.on_commit(run, using=router.db_for_write(Purchase))
 
 
 class ModelRef(CompositeField):
@@ -60,6 +83,128 @@ class PaymentProcessor(models.Model):
         return self.name
 
 
+class ProcessorRegistry(object):
+    """In-memory map from :class:`PaymentProcessor` IDs to processors, their classes and API clients.
+
+    It is loaded from the DB on first use, so resolving a processor usually needs no DB queries.
+    An ID missing from the loaded processors (for example, of a processor added by another process)
+    makes it reload once. Use the :data:`processor_registry` instance.
+
+    Processors are normally changed only on deploy (by fixtures). When a :class:`PaymentProcessor`
+    is saved or deleted, signals increment a version in the cache (:func:`~debits.debits_base.base.get_cache`),
+    and every process reloads the registry when it sees a new version. The version is checked
+    at most every `settings.PAYMENTS_PROCESSOR_REGISTRY_CHECK_INTERVAL` seconds (60 by default).
+    With a per-process cache (like the default `LocMemCache`) other processes see changes only after restart."""
+
+    VERSION_KEY = 'debits.processors:version'
+    """The cache key of the shared version."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.processors = None
+        self.version = None
+        self.checked = 0
+        self.klasses = {}
+        self.apis = {}
+        self.async_apis = {}
+
+    def load(self):
+        """Load all processors from the DB."""
+        version = get_cache().get(ProcessorRegistry.VERSION_KEY, 0)
+        processors = {p.pk: p for p in PaymentProcessor.objects.all()}
+        with self.lock:
+            self.forget()
+            self.processors = processors
+            self.version = version
+            self.checked = time.monotonic()
+
+    def clear(self, **kwargs):
+        """Forget all loaded processors, in this and (by the shared version) other processes.
+        (Can be used as a signal handler.)"""
+        cache = get_cache()
+        if not cache.add(ProcessorRegistry.VERSION_KEY, 1, None):
+            try:
+                cache.incr(ProcessorRegistry.VERSION_KEY)
+            except ValueError:  # has just expired
+                cache.add(ProcessorRegistry.VERSION_KEY, 1, None)
+        with self.lock:
+            self.forget()
+
+    def forget(self):
+        """Internal."""
+        self.processors = None
+        self.klasses = {}
+        self.apis = {}
+        self.async_apis = {}
+
+    def check(self):
+        """Internal.
+
+        Forget the processors if they were changed by another process."""
+        interval = getattr(settings, 'PAYMENTS_PROCESSOR_REGISTRY_CHECK_INTERVAL', 60)
+        if time.monotonic() - self.checked < interval:
+            return
+        self.checked = time.monotonic()
+        if get_cache().get(ProcessorRegistry.VERSION_KEY, 0) != self.version:
+            self.forget()
+
+    def processor(self, pk):
+        """Returns a :class:`PaymentProcessor` by its ID.
+
+        Don't modify the returned object."""
+        with self.lock:
+            self.check()
+            if self.processors is None:
+                self.load()
+            elif pk not in self.processors:  # may be added after loading
+                self.load()
+            try:
+                return self.processors[pk]
+            except KeyError:
+                raise PaymentProcessor.DoesNotExist
+
+    def klass(self, pk):
+        """The Django model class (with API for payments and similar stuff) of a processor."""
+        with self.lock:
+            self.check()
+            try:
+                return self.klasses[pk]
+            except KeyError:
+                klass = model_from_ref(self.processor(pk).klass)
+                self.klasses[pk] = klass
+                return klass
+
+    def api(self, pk):
+        """An API client of a processor.
+
+        The client is reused for `settings.PAYMENTS_API_CLIENT_TIMEOUT` seconds (by default one hour)."""
+        timeout = getattr(settings, 'PAYMENTS_API_CLIENT_TIMEOUT', 3600)
+        with self.lock:
+            self.check()
+            api, created = self.apis.get(pk, (None, None))
+            if api is None or time.monotonic() - created >= timeout:
+                api = self.klass(pk)().api()
+                self.apis[pk] = (api, time.monotonic())
+            return api
+
+    async def async_api(self, pk):
+        """An async API client of a processor (see :meth:`api`)."""
+        timeout = getattr(settings, 'PAYMENTS_API_CLIENT_TIMEOUT', 3600)
+        with self.lock:
+            self.check()
+            api, created = self.async_apis.get(pk, (None, None))
+        if api is None or time.monotonic() - created >= timeout:
+            klass = await sync_to_async(self.klass)(pk)
+            api = await klass().async_api()
+            with self.lock:
+                self.async_apis[pk] = (api, time.monotonic())
+        return api
+
+
+processor_registry = ProcessorRegistry()
+"""The :class:`ProcessorRegistry`."""
+
+
 class Product(models.Model):
     name = models.CharField(_('Product name'), max_length=255)
     """Product name."""
@@ -76,6 +221,14 @@ class BaseTransaction(models.Model):
     # class Meta:
     #     abstract = True
 
+    class Meta:
+        indexes = [
+            # archiving of unpaid transactions
+            models.Index(fields=['creation_date'], name='debits_transaction_created'),
+            # history (see debits.debits_base.history)
+            models.Index(fields=['purchase', 'creation_date', 'id'], name='debits_transaction_history'),
+        ]
+
     processor = models.ForeignKey(PaymentProcessor, on_delete=models.CASCADE)
     """Payment processor."""
 
@@ -85,9 +238,90 @@ class BaseTransaction(models.Model):
     purchase = models.ForeignKey('Purchase', related_name='transactions', null=False, on_delete=models.CASCADE)
     """The stuff sold by this transaction."""
 
+    nonce = models.CharField(max_length=32, null=True, unique=True)
+    """Random code for a transaction created after redirecting the user to the payment processor
+    (see :meth:`for_checkout`)."""
+
+    invoice = models.CharField(max_length=127, null=True, unique=True)
+    """The invoice ID sent to the payment processor (see :meth:`invoice_id`).
+
+    It allows to find the transaction of an IPN without `custom` and prevents to create
+    two transactions for the same invoice."""
+
+    lazy_kind = None
+    """Internal.
+
+    Letter identifying the transaction class in :meth:`custom` of a not yet saved transaction."""
+
     def __repr__(self):
         return "<BaseTransaction: %s>" % (("pk=%d" % self.pk) if self.pk else "no pk")
 
+    @classmethod
+    def for_checkout(cls, **kwargs):
+        """Creates a transaction before redirecting the user to the payment processor.
+
+        If `settings.PAYMENTS_LAZY_TRANSACTIONS` is true, the transaction is not saved to the DB.
+        Instead, :meth:`custom` refers to the purchase and a random nonce, and the transaction
+        is created by :meth:`pk_from_custom_or_create` when the payment processor notifies us
+        about it. So abandoned checkouts don't create transactions.
+
+        Args:
+            kwargs: the fields of the transaction.
+
+        Returns:
+            An object of this class."""
+        transaction = cls(**kwargs)
+        if not getattr(settings, 'PAYMENTS_LAZY_TRANSACTIONS', False):
+            # reuse an existing transaction for the same invoice
+            transaction, created = cls.objects.get_or_create(invoice=transaction.invoice_id(), defaults=kwargs)
+            if not created:
+                for name, value in kwargs.items():
+                    setattr(transaction, name, value)
+                transaction.save(update_fields=list(kwargs))
+        return transaction
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        """Saves the transaction.
+
+        A new transaction with the :attr:`invoice` of an existing one (a checkout of the same purchase
+        started again) is not inserted: the existing transaction is updated by it instead,
+        so that this object becomes that transaction (with its primary key)."""
+        if self.invoice is None:
+            self.invoice = self.make_invoice_id()
+        if not self._state.adding or self.pk is not None or force_update or update_fields is not None:
+            super().save(force_insert=force_insert, force_update=force_update, using=using,
+                         update_fields=update_fields)
+            return
+        try:
+            with transaction.atomic(using=using):
+                super().save(force_insert=force_insert, using=using)
+        except IntegrityError:
+            existing = type(self).objects.using(using or router.db_for_write(type(self), instance=self)).\
+                filter(invoice=self.invoice).first()
+            if existing is None:
+                raise
+            self.pk = existing.pk
+            self.creation_date = existing.creation_date
+            if self.nonce is None:
+                self.nonce = existing.nonce
+            self._state.adding = False
+            super().save(using=using)
+
+    @staticmethod
+    def sign(message):
+        """Internal."""
+        # MD5 was the default of hmac.new() before Python 3.8, keep it to accept old customs
+        return hmac.new(settings.SECRET_KEY.encode(), message.encode(), hashlib.md5).hexdigest()
+
+    def custom(self):
+        """Secret code of this transaction (see :meth:`custom_from_pk`)."""
+        if self.pk is not None:
+            return BaseTransaction.custom_from_pk(self.pk)
+        if self.nonce is None:
+            self.nonce = secrets.token_hex(16)
+        ref = '%s%d.%s' % (self.lazy_kind, self.purchase_id, self.nonce)
+        return settings.PAYMENTS_REALM + ' ' + ref + ' ' + BaseTransaction.sign('lazy ' + ref)
+
     @staticmethod
     def custom_from_pk(pk):
         """Secret code of a transaction.
@@ -100,7 +334,7 @@ class BaseTransaction(models.Model):
 
         Returns:
             A secret string."""
-        secret = hmac.new(settings.SECRET_KEY.encode(), ('payid ' + str(pk)).encode()).hexdigest()
+        secret = BaseTransaction.sign('payid ' + str(pk))
         return settings.PAYMENTS_REALM + ' ' + str(pk) + ' ' + secret
 
     @staticmethod
@@ -119,18 +353,67 @@ class BaseTransaction(models.Model):
             raise BaseTransaction.DoesNotExist
         try:
             pk = int(r[1])
-            secret = hmac.new(settings.SECRET_KEY.encode(), ('payid ' + str(pk)).encode()).hexdigest()
-            if r[2] != secret:
+            secret = BaseTransaction.sign('payid ' + str(pk))
+            if not hmac.compare_digest(r[2], secret):
                 raise BaseTransaction.DoesNotExist
             return pk
         except ValueError:
             raise BaseTransaction.DoesNotExist
 
-    @abc.abstractmethod
+    @staticmethod
+    def pk_from_custom_or_create(custom, processor_id):
+        """Like :meth:`pk_from_custom`, but also accepts the "custom" of a transaction
+        not saved by :meth:`for_checkout`, creating the transaction (once).
+
+        Raises :class:`BaseTransaction.DoesNotExist` if the custom is wrong.
+
+        Args:
+            custom: A secret string.
+            processor_id: the ID of :class:`PaymentProcessor` for a created transaction.
+
+        Returns:
+            The primary key for :class:`BaseTransaction`."""
+        r = custom.split(' ', 2)
+        klasses = {klass.lazy_kind: klass for klass in (SimpleTransaction, SubscriptionTransaction)}
+        if len(r) != 3 or r[0] != settings.PAYMENTS_REALM or r[1][:1] not in klasses:
+            return BaseTransaction.pk_from_custom(custom)
+        if not hmac.compare_digest(r[2], BaseTransaction.sign('lazy ' + r[1])):
+            raise BaseTransaction.DoesNotExist
+        try:
+            purchase_id, nonce = r[1][1:].split('.', 1)
+            purchase_id = int(purchase_id)
+        except ValueError:
+            raise BaseTransaction.DoesNotExist
+        fields = {'purchase_id': purchase_id, 'processor_id': processor_id, 'nonce': nonce}
+        klass = klasses[r[1][0]]
+        transaction, created = klass.objects.get_or_create(invoice=klass(**fields).invoice_id(), defaults=fields)
+        return transaction.pk
+
+    @staticmethod
+    def pk_from_invoice(invoice):
+        """Find the :class:`BaseTransaction` primary key by :attr:`invoice`.
+
+        Raises :class:`BaseTransaction.DoesNotExist` if there is no such transaction."""
+        pk = BaseTransaction.objects.filter(invoice=invoice).values_list('pk', flat=True).first()
+        if pk is None:
+            raise BaseTransaction.DoesNotExist
+        return pk
+
     def invoice_id(self):
         """Invoice ID.
 
-        Used internally to prevent more than one payment for the same transaction."""
+        Used internally to prevent more than one payment for the same transaction.
+        It is generated by :meth:`make_invoice_id` and stored in :attr:`invoice`
+        when the transaction is saved the first time."""
+        if self.invoice is None:
+            self.invoice = self.make_invoice_id()
+        return self.invoice
+
+    @abc.abstractmethod
+    def make_invoice_id(self):
+        """Internal.
+
+        Generates :meth:`invoice_id`."""
         pass
 
     def invoiced_purchase(self):
@@ -148,10 +431,12 @@ class BaseTransaction(models.Model):
 class SimpleTransaction(BaseTransaction):
     """A one-time (non-recurring) transaction."""
 
+    lazy_kind = 'p'
+
     def subinvoice(self):
         return 1
 
-    def invoice_id(self):
+    def make_invoice_id(self):
         return settings.PAYMENTS_REALM + ' p-%d' % (self.purchase.pk,)
 
     # Make transaction atomic to be sure that simpleitem.save() and advance_parent() do together
@@ -159,6 +444,7 @@ class SimpleTransaction(BaseTransaction):
     def on_accept_regular_payment(self, email):
         """Handles confirmation of a (non-recurring) payment."""
         payment = SimplePayment.objects.create(transaction=self, email=email)
+        DailyRollup.record(self.purchase, payments=1, revenue=DailyRollup.amount(self.purchase))
         self.purchase.status = SimplePaymentStatus.PAID
         self.purchase.payment = payment
         self.purchase.upgrade_subscription()
@@ -180,22 +466,26 @@ class SimpleTransaction(BaseTransaction):
         `prolongitem.period` contains the number of days to advance the parent (:class:`SubscriptionItem`)
         item. The parent transaction is advanced this number of days.
         """
-        parent_purchase = SubscriptionPurchase.objects.select_for_update().get(
-            pk=prolongpurchase.prolonged_id)  # must be inside transaction
+        parent_purchase = SubscriptionPurchase.objects.get(pk=prolongpurchase.prolonged_id)
         # parent.email = transaction.email
-        base_date = max(datetime.date.today(), parent_purchase.due_payment_date)
-        klass = model_from_ref(payment.transaction.processor.klass)  # prolongpurchase.payment is None, so use payment instead
-        parent_purchase.set_payment_date(klass.offset_date(base_date, prolongpurchase.period))
-        parent_purchase.save()
+        klass = processor_registry.klass(payment.transaction.processor_id)  # prolongpurchase.payment is None, so use payment instead
+
+        def change(purchase):
+            base_date = max(datetime.date.today(), purchase.due_payment_date)
+            purchase.set_payment_date(klass.offset_date(base_date, prolongpurchase.period))
+            purchase.reactivate()
+        parent_purchase.update_dates(change)  # locks the row till the end of the transaction
 
 
 class SubscriptionTransaction(BaseTransaction):
     """A transaction for a subscription service."""
 
+    lazy_kind = 's'
+
     def subinvoice(self):
         return self.invoiced_purchase().subscriptionpurchase.subinvoice
 
-    def invoice_id(self):
+    def make_invoice_id(self):
         if self.purchase.old_subscription:
             return settings.PAYMENTS_REALM + ' %d-%d-u' % (self.purchase.pk, self.subinvoice())
         else:
@@ -244,6 +534,56 @@ class SimplePaymentStatus(object):
     REFUNDED = 3
 
 
+class SubscriptionAction(object):
+    """What to do next with a subscription purchase (see :attr:`SubscriptionPurchase.next_action`)."""
+    REMIND_BEFORE_DUE = 1
+    REMIND_DUE = 2
+    REMIND_DEADLINE = 3
+    EXPIRE = 4
+
+    REMINDERS = (REMIND_BEFORE_DUE, REMIND_DUE, REMIND_DEADLINE)
+
+
+class SubscriptionStatus(object):
+    """The state of a subscription purchase, as shown to the customer."""
+    TRIAL = 1
+    ACTIVE = 2
+    GRACE = 3
+    """Not paid on :attr:`SubscriptionPurchase.due_payment_date`, but before :attr:`SubscriptionPurchase.payment_deadline`."""
+    EXPIRED = 4
+    BLOCKED = 5
+    GRATIS = 6
+    CANCELED = 7
+    """The automatic payments were canceled (and it was not paid after that).
+
+    It is not derived from the other fields (see :meth:`SubscriptionPurchase.compute_status`)."""
+
+    STICKY = (BLOCKED, CANCELED)
+    """Not changed by :meth:`SubscriptionPurchase.sweep_expired`."""
+
+    names = {TRIAL: 'trial', ACTIVE: 'active', GRACE: 'grace', EXPIRED: 'expired', BLOCKED: 'blocked',
+             GRATIS: 'gratis', CANCELED: 'canceled'}
+
+    choices = ((TRIAL, _('Trial')), (ACTIVE, _('Active')), (GRACE, _('Grace period')), (EXPIRED, _('Expired')),
+               (BLOCKED, _('Blocked')), (GRATIS, _('Gratis')), (CANCELED, _('Canceled')))
+    """Choices of :attr:`SubscriptionPurchase.status`."""
+
+    @staticmethod
+    def derive(blocked, gratis, trial, due_payment_date, payment_deadline, today=None):
+        """The status from the fields of :class:`SubscriptionPurchase`."""
+        if today is None:
+            today = datetime.date.today()
+        if blocked:
+            return SubscriptionStatus.BLOCKED
+        if gratis:
+            return SubscriptionStatus.GRATIS
+        if payment_deadline is None or today > payment_deadline:
+            return SubscriptionStatus.EXPIRED
+        if today > due_payment_date:
+            return SubscriptionStatus.GRACE
+        return SubscriptionStatus.TRIAL if trial else SubscriptionStatus.ACTIVE
+
+
 class SimpleItem(Item):
     """Non-subscription item.
 
@@ -274,6 +614,15 @@ class SubscriptionItem(Item):
 
 
 class Purchase(models.Model):
+    class Meta:
+        indexes = [
+            # archiving of abandoned purchases (partial index, skipped by databases not supporting them)
+            models.Index(fields=['creation_date'], name='debits_purchase_unpaid',
+                         condition=Q(payment__isnull=True, gratis=False)),
+            # history (see debits.debits_base.history)
+            models.Index(fields=['creation_date', 'id'], name='debits_purchase_history'),
+        ]
+
     item = models.ForeignKey('Item', null=False, on_delete=models.CASCADE)
 
     parent = models.ForeignKey('AggregatePurchase', null=True, on_delete=models.SET_NULL, related_name='childs')
@@ -323,6 +672,44 @@ class Purchase(models.Model):
     def __repr__(self):
         return "<Purchase pk=%d, %s>" % (self.pk, self.item.product.name)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.mark_saved(field_names, values)
+        return instance
+
+    def mark_saved(self, attnames, values=None):
+        """Internal.
+
+        Remember the values of fields (by their attnames) as being in the DB."""
+        if values is None:
+            values = [getattr(self, attname) for attname in attnames]
+        saved = self.__dict__.setdefault('saved_values', {})
+        saved.update(zip(attnames, values))
+
+    def changed_fields(self):
+        """Names of the fields changed since loading from the DB (`None` if not known)."""
+        saved = self.__dict__.get('saved_values')
+        if saved is None:
+            return None
+        return [field.name for field in self._meta.concrete_fields
+                if field.attname in saved and getattr(self, field.attname) != saved[field.attname]]
+
+    def save(self, *args, **kwargs):
+        """Saves only changed fields of a purchase loaded from the DB (unless `update_fields` is given)."""
+        if not self._state.adding and not args and kwargs.get('update_fields') is None:
+            changed = self.changed_fields()
+            if changed is not None:
+                kwargs['update_fields'] = changed
+        super().save(*args, **kwargs)
+        self.mark_saved([field.attname for field in self._meta.concrete_fields])
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        if fields is None:
+            fields = [field.name for field in self._meta.concrete_fields]
+        self.mark_saved([self._meta.get_field(name).attname for name in fields])
+
     @property
     def is_aggregate(self):
         return False
@@ -340,12 +727,14 @@ class Purchase(models.Model):
     def do_upgrade_subscription(self):
         """Internal.
 
+        The old subscription is canceled at the processor after commit.
+
         TODO: Remove ALL old subscriptions as in payment_system2."""
-        try:
-            self.old_subscription.subscriptionpurchase.force_cancel(is_upgrade=True)
-        except CannotCancelSubscription:
-            pass
+        after_commit(self.old_subscription.subscriptionpurchase.cancel_upgraded)
         # self.on_upgrade_subscription(transaction, item.old_subscription)  # TODO: Needed?
+        PurchaseLineage.link(self.old_subscription_id, self.pk)  # before the link is lost
+        SubscriptionPurchase.objects.filter(pk=self.old_subscription_id).\
+            update(status=SubscriptionStatus.CANCELED, version=F('version') + 1)
         Purchase.objects.filter(pk=self.pk).update(old_subscription=None)
 
     # TODO: Move to Payment class?
@@ -388,6 +777,20 @@ class SimplePurchase(Purchase):
 
 
 class SubscriptionPurchase(Purchase):
+    class Meta:
+        indexes = [
+            # send_reminders()
+            models.Index(fields=['next_action', 'next_action_at'], name='debits_sp_next_action'),
+            # counting and filtering by status (see SubscriptionStatus)
+            models.Index(fields=['status', 'payment_deadline'], name='debits_sp_status'),
+            # sweep_expired() (partial index, skipped by databases not supporting them)
+            models.Index(fields=['next_action_at', 'payment_deadline'], name='debits_sp_to_expire',
+                         condition=Q(expired=False)),
+            # process_cancel_requests() (partial index)
+            models.Index(fields=['cancel_requested_at'], name='debits_sp_cancel_requested',
+                         condition=Q(cancel_requested_at__isnull=False)),
+        ]
+
     due_payment_date = models.DateField(default=datetime.date.today, db_index=True)
     """The reference payment date."""
 
@@ -416,6 +819,25 @@ class SubscriptionPurchase(Purchase):
 
     DalPay requires to notify the customer 10 days before every payment."""
 
+    expired = models.BooleanField(default=False)
+    """:attr:`payment_deadline` has passed and :meth:`sweep_expired` has already reported it."""
+
+    next_action = models.SmallIntegerField(null=True)  # SubscriptionAction
+    """What should be done next with this purchase or `None`.
+
+    Calculated by :meth:`reschedule`."""
+
+    next_action_at = models.DateField(null=True, db_index=True)
+    """When :attr:`next_action` should be done.
+
+    Periodic jobs select purchases by this field only."""
+
+    status = models.SmallIntegerField(_('Status'), choices=SubscriptionStatus.choices,
+                                      default=SubscriptionStatus.EXPIRED)  # SubscriptionStatus
+    """:class:`SubscriptionStatus` as of the last change or the last :meth:`sweep_statuses`.
+
+    It is calculated by :meth:`reschedule`."""
+
     def __init__(self, *args, **kwargs):
         try:
             settings.PROLONG_PAYMENT_VIEW
@@ -436,14 +858,23 @@ class SubscriptionPurchase(Purchase):
                 datetime.date.today() <= self.payment_deadline
         return (prior or self.gratis) and not self.blocked
 
+    async def ais_active(self):
+        """Async version of :meth:`is_active`."""
+        return self.is_active()
+
     @staticmethod
-    def quick_is_active(item_id):
-        """Is the item with given PK active (paid on time and not blocked).
+    def quick_is_active(purchase_id):
+        """Is the purchase with given PK active (paid on time and not blocked).
 
-        Usually you should use quick_is_active() instead because that is faster."""
-        item = SubscriptionItem.objects.filter(pk=item_id).\
+        It loads only the needed fields."""
+        purchase = SubscriptionPurchase.objects.filter(pk=purchase_id).\
             only('payment_deadline', 'gratis', 'blocked').get()
-        return item.is_active()
+        return purchase.is_active()
+
+    @staticmethod
+    async def aquick_is_active(purchase_id):
+        """Async version of :meth:`quick_is_active`."""
+        return await sync_to_async(SubscriptionPurchase.quick_is_active)(purchase_id)
 
     def set_payment_date(self, date):
         """Sets both :attr:`due_payment_date` and :attr:`payment_deadline`."""
@@ -451,6 +882,9 @@ class SubscriptionPurchase(Purchase):
         # klass = model_from_ref(self.payment.transaction.processor.klass)
         # self.payment_deadline = klass.offset_date(self.due_payment_date, self.grace_period)
         self.payment_deadline = self.due_payment_date + period_to_delta(self.item.subscriptionitem.grace_period)
+        if self.payment_deadline >= datetime.date.today():
+            self.expired = False
+        self.reschedule()
 
     def start_trial(self):
         """Start trial period.
@@ -461,41 +895,233 @@ class SubscriptionPurchase(Purchase):
             # klass = model_from_ref(self.payment.transaction.processor.klass)  # not yet defined
             # self.set_payment_date(klass.offset_date(datetime.date.today(), self.trial_period))
             self.set_payment_date(datetime.date.today() + period_to_delta(self.item.subscriptionitem.trial_period))
+            DailyRollup.record(self, trials_started=1)
+
+    def days_before_due_remind(self):
+        """Internal."""
+        if self.trial:
+            return settings.PAYMENTS_DAYS_BEFORE_TRIAL_END_REMIND
+        else:
+            return settings.PAYMENTS_DAYS_BEFORE_DUE_REMIND
+
+    def reschedule(self):
+        """Recalculates :attr:`next_action` and :attr:`next_action_at` (without saving).
+
+        It is called by :meth:`save`. Code which changes the purchase by `update()`
+        should call it itself and also update :meth:`schedule_fields`."""
+        actions = []
+        if self.reminders_sent < 3:
+            actions.append((self.due_payment_date - datetime.timedelta(days=self.days_before_due_remind()),
+                            SubscriptionAction.REMIND_BEFORE_DUE))
+        if self.reminders_sent < 2:
+            actions.append((self.due_payment_date, SubscriptionAction.REMIND_DUE))
+        if self.payment_deadline is not None:
+            if self.reminders_sent < 1:
+                actions.append((self.payment_deadline, SubscriptionAction.REMIND_DEADLINE))
+            if not self.expired and not self.gratis:
+                actions.append((self.payment_deadline + datetime.timedelta(days=1), SubscriptionAction.EXPIRE))
+        self.next_action_at, self.next_action = min(actions) if actions else (None, None)
+        self.status = self.compute_status()
+
+    def schedule_fields(self):
+        """Internal.
+
+        The fields calculated by :meth:`reschedule` (for `update()`)."""
+        return {'next_action': self.next_action, 'next_action_at': self.next_action_at, 'status': self.status}
+
+    def compute_status(self):
+        """The current :class:`SubscriptionStatus`.
+
+        :data:`SubscriptionStatus.CANCELED` is kept until the purchase is subscribed again
+        or paid (see :meth:`reactivate`)."""
+        if self.status == SubscriptionStatus.CANCELED and not self.subscribed:
+            return SubscriptionStatus.CANCELED
+        return SubscriptionStatus.derive(self.blocked, self.gratis, self.trial,
+                                         self.due_payment_date, self.payment_deadline)
+
+    def reactivate(self):
+        """Internal.
+
+        Forgets :data:`SubscriptionStatus.CANCELED` (when the purchase is paid)."""
+        if self.status == SubscriptionStatus.CANCELED:
+            self.status = SubscriptionStatus.EXPIRED
+        self.reschedule()
+
+    version = models.PositiveIntegerField(default=0)
+    """Incremented on every change of the purchase (see :meth:`update_dates` and
+    :mod:`debits.debits_base.summary`).
+
+    Code which changes the purchase by `update()` should also set it to `F('version') + 1`."""
+
+    DATE_FIELDS = ('due_payment_date', 'payment_deadline', 'trial', 'expired', 'next_action', 'next_action_at', 'status')
+    """Fields changed by :meth:`update_dates`."""
+
+    def save(self, *args, **kwargs):
+        self.reschedule()
+        changed = kwargs.get('update_fields')
+        if changed is None:
+            changed = self.changed_fields()
+        bump = bool(changed) and 'version' not in changed
+        if bump:
+            # F() and not self.version + 1, as the row may have been updated by `update()`
+            self.version = F('version') + 1
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = list(kwargs['update_fields']) + ['version']
+        super().save(*args, **kwargs)
+        if bump:
+            self.refresh_from_db(fields=['version'])
+
+    def update_dates(self, change):
+        """Changes :data:`DATE_FIELDS`.
+
+        `change(purchase)` should modify the dates of `purchase` (for example, by :meth:`set_payment_date`).
+
+        Outside of a DB transaction, it is a compare-and-swap update, without locking the row:
+        if the dates were modified by somebody else since this object was loaded, they are reloaded
+        and `change` is applied again, up to `settings.PAYMENTS_UPDATE_RETRIES` (10 by default) times.
+
+        Inside a transaction (such as of :func:`~debits.debits_base.locks.purchase_lock`) a retry would
+        sleep holding the locks of the transaction and (under `REPEATABLE READ`) reload the same snapshot,
+        so instead the row is locked by `SELECT ... FOR UPDATE` (which reads the last committed version),
+        the dates are reloaded and changed once.
+
+        Raises :class:`ConcurrentUpdate` if all attempts failed."""
+        using = router.db_for_write(SubscriptionPurchase)
+        if transaction.get_connection(using).in_atomic_block:
+            current = SubscriptionPurchase.objects.using(using).select_for_update().filter(pk=self.pk).\
+                values(*SubscriptionPurchase.DATE_FIELDS, 'version').get()
+            for name, value in current.items():
+                setattr(self, name, value)
+            change(self)
+            self.reschedule()
+            values = {name: getattr(self, name) for name in SubscriptionPurchase.DATE_FIELDS}
+            SubscriptionPurchase.objects.using(using).filter(pk=self.pk).update(version=F('version') + 1, **values)
+            self.version += 1
+            self.mark_saved(SubscriptionPurchase.DATE_FIELDS + ('version',))
+            return
+        for attempt in range(getattr(settings, 'PAYMENTS_UPDATE_RETRIES', 10)):
+            change(self)
+            self.reschedule()
+            values = {name: getattr(self, name) for name in SubscriptionPurchase.DATE_FIELDS}
+            if SubscriptionPurchase.objects.using(using).filter(pk=self.pk, version=self.version).\
+                    update(version=F('version') + 1, **values):
+                self.version += 1
+                self.mark_saved(SubscriptionPurchase.DATE_FIELDS + ('version',))
+                return
+            self.refresh_from_db(fields=SubscriptionPurchase.DATE_FIELDS + ('version',))
+            time.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+        raise ConcurrentUpdate("Cannot update dates of purchase %d" % self.pk)
+
+    @staticmethod
+    def reschedule_all(batch_size=1000):
+        """Recalculate :attr:`next_action` for all purchases.
+
+        Needed after upgrading from a version without :attr:`next_action`
+        or after changing `PAYMENTS_DAYS_BEFORE_*` settings."""
+        last_pk = 0
+        while True:
+            purchases = list(SubscriptionPurchase.objects.filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+            if not purchases:
+                break
+            for purchase in purchases:
+                purchase.reschedule()
+            SubscriptionPurchase.objects.bulk_update(purchases, ['next_action', 'next_action_at', 'status'])
+            last_pk = purchases[-1].pk
+
+    def cancel_upgraded(self):
+        """Internal.
+
+        Cancels the subscription replaced by an upgrade."""
+        try:
+            self.force_cancel(is_upgrade=True)
+        except CannotCancelSubscription:
+            pass
 
     # TODO: The same as in do_upgrade_subscription()
     #@shared_task  # PayPal tormoz, so run in a separate thread # TODO: celery (with `TypeError: force_cancel() missing 1 required positional argument: 'self'`)
     def force_cancel(self, is_upgrade=False):
         """Cancels the :attr:`transaction`."""
         if self.subscription_reference:
-            klass = model_from_ref(self.processor.klass)
-            api = klass().api()
+            api = processor_registry.api(self.processor_id)
             try:
                 api.cancel_agreement(self.subscription_reference, is_upgrade=is_upgrade)  # may raise an exception
             except CannotCancelSubscription:
                 logger.warn("Cannot cancel subscription " + self.subscription_reference)
                 # fallback
-                SubscriptionPurchase.objects.filter(pk=self.pk).update(
-                    payment=None, processor=None, subscription_reference=None, subinvoice=F('subinvoice') + 1)
+                self.clear_subscription()
                 raise
             # transaction.cancel_subscription()  # runs in the callback
         else:
             # SubscriptionItem.objects.filter(payment=self.pk).update(payment=None, subinvoice=F('subinvoice') + 1)  # called in cancel_subscription()
             pass
 
+    async def aforce_cancel(self, is_upgrade=False):
+        """Async version of :meth:`force_cancel`."""
+        if self.subscription_reference:
+            api = await processor_registry.async_api(self.processor_id)
+            try:
+                await api.cancel_agreement(self.subscription_reference, is_upgrade=is_upgrade)  # may raise an exception
+            except CannotCancelSubscription:
+                logger.warn("Cannot cancel subscription " + self.subscription_reference)
+                # fallback
+                await sync_to_async(self.clear_subscription)()
+                raise
+
     @django.db.transaction.atomic
     def activate_subscription(self, ref, email, processor):
         """Internal.
 
-        "Competes" with :meth:`on_accept_regular_payment`."""
-        SubscriptionPurchase.objects.filter(pk=self.pk).update(subscription_reference=ref, email=email, processor=processor)
+        "Competes" with :meth:`on_accept_regular_payment`.
+
+        Returns:
+            Whether the subscription was not active before (it is called more than once for a subscription)."""
+        fields = {'subscription_reference': ref, 'email': email, 'processor': processor, 'version': F('version') + 1}
+        activated = SubscriptionPurchase.objects.filter(pk=self.pk, subscription_reference__isnull=True).update(**fields)
+        if not activated:
+            SubscriptionPurchase.objects.filter(pk=self.pk).update(**fields)
+        self.refresh_from_db(fields=['subscription_reference', 'email', 'processor', 'status', 'version'])
+        if self.status == SubscriptionStatus.CANCELED:  # subscribed again
+            self.reschedule()
+            SubscriptionPurchase.objects.filter(pk=self.pk).update(status=self.status, version=F('version') + 1)
+            self.refresh_from_db(fields=['status', 'version'])
+        PurchaseLineage.activated(self.pk, ref)
+        if self.old_subscription_id is not None:
+            PurchaseLineage.link(self.old_subscription_id, self.pk)
+        if activated:
+            DailyRollup.record(self, activations=1, trials_converted=1 if self.trial else 0,
+                               mrr_change=DailyRollup.monthly_amount(self.item.price,
+                                                                     self.item.subscriptionitem.payment_period))
+        return bool(activated)
+
+    @django.db.transaction.atomic
+    def clear_subscription(self):
+        """Internal.
+
+        Returns:
+            Whether the subscription was active before."""
+        fields = {'payment': None, 'subscription_reference': None, 'processor': None,
+                  'subinvoice': F('subinvoice') + 1, 'version': F('version') + 1}
+        canceled = SubscriptionPurchase.objects.filter(pk=self.pk, subscription_reference__isnull=False).\
+            update(status=SubscriptionStatus.CANCELED, **fields)
+        if not canceled:
+            SubscriptionPurchase.objects.filter(pk=self.pk).update(**fields)
+        self.refresh_from_db(fields=['payment', 'subscription_reference', 'processor', 'subinvoice', 'status',
+                                     'version'])
+        if canceled:
+            DailyRollup.record(self, cancellations=1,
+                               mrr_change=-DailyRollup.monthly_amount(self.item.price,
+                                                                      self.item.subscriptionitem.payment_period))
+        return bool(canceled)
 
     def cancel_subscription(self):
-        """Called when we detect that the subscription was canceled."""
-        # atomic operation
-        SubscriptionPurchase.objects.filter(pk=self.pk).update(
-            payment=None, subscription_reference=None, processor=None, subinvoice=F('subinvoice') + 1)
+        """Called when we detect that the subscription was canceled.
+
+        Returns:
+            Whether the subscription was active before."""
+        canceled = self.clear_subscription()
         if not self.old_subscription:  # don't send this email on plan upgrade
-            self.cancel_subscription_email()
+            after_commit(self.cancel_subscription_email)
+        return canceled
 
     def cancel_subscription_email(self):
         """Internal.
@@ -511,114 +1137,233 @@ class SubscriptionPurchase(Purchase):
                                   'days_before': days_before})
 
     @staticmethod
-    def send_reminders():
-        """Send all email reminders."""
-        SubscriptionPurchase.send_regular_reminders()
-        SubscriptionPurchase.send_trial_reminders()
+    def in_shard(queryset, shard, shards):
+        """Internal.
 
-    @staticmethod
-    def send_regular_reminders():
-        """Internal."""
-        # start with the last
-        SubscriptionPurchase.send_regular_before_due_reminders()
-        SubscriptionPurchase.send_regular_due_reminders()
-        SubscriptionPurchase.send_regular_deadline_reminders()
+        Only the purchases of the shard number `shard` (from 0) of `shards` (partitioned by the PK)."""
+        if shards == 1:
+            return queryset
+        return queryset.annotate(debits_shard=Mod('pk', shards)).filter(debits_shard=shard)
 
     @staticmethod
-    def send_regular_before_due_reminders():
-        """Internal."""
-        days_before = settings.PAYMENTS_DAYS_BEFORE_DUE_REMIND
-        reminder_date = datetime.date.today() + datetime.timedelta(days=days_before)
-        q = SubscriptionPurchase.objects.filter(reminders_sent__lt=3, due_payment_date__lte=reminder_date, trial=False)
-        for purchase in q:
-            Item.objects.filter(pk=purchase.pk).update(reminders_sent=3)
-            url = reverse(settings.PROLONG_PAYMENT_VIEW, args=[purchase.pk])
-            purchase.send_rendered_email('debits/email/before-due-remind.html',
-                                     _("You need to pay for %s") % purchase.product.name,
-                                     {'transaction': purchase,
-                                      'product': purchase.product.name,
-                                      'url': url,
-                                      'days_before': days_before})
+    def stopped(stop):
+        """Internal.
+
+        Whether the event `stop` (or `None`) of a batch job is set."""
+        return stop is not None and stop.is_set()
 
     @staticmethod
-    def send_regular_due_reminders():
-        """Internal."""
-        reminder_date = datetime.date.today()
-        q = SubscriptionPurchase.objects.filter(reminders_sent__lt=2, due_payment_date__lte=reminder_date, trial=False)
-        for purchase in q:
-            Item.objects.filter(pk=purchase.pk).update(reminders_sent=2)
-            url = reverse(settings.PROLONG_PAYMENT_VIEW, args=[purchase.pk])
-            purchase.send_rendered_email('debits/email/due-remind.html',
-                                     _("You need to pay for %s") % purchase.product.name,
-                                     {'transaction': purchase,
-                                      'product': purchase.product.name,
-                                      'url': url})
+    def sweep_expired(callback=None, batch_size=1000, shard=0, shards=1, stop=None):
+        """Mark purchases whose :attr:`payment_deadline` has passed as :attr:`expired`.
+
+        Gratis purchases are skipped (until they stop being gratis).
+        Reminders not yet sent for an expired purchase are not sent anymore.
+
+        Several processes can run it at once: rows locked by others are skipped.
+
+        Args:
+            callback: :class:`~debits.debits_base.processors.PaymentCallback` whose
+                :meth:`~debits.debits_base.processors.PaymentCallback.on_subscription_expired`
+                is called for every batch (in the transaction marking it, so that if the callback raises,
+                the batch is not marked and is passed to the callback again next time), or `None`.
+            batch_size: how many purchases to mark in one database transaction.
+            shard: process only this shard (see `shards`).
+            shards: the number of shards (of purchases partitioned by the PK).
+            stop: an event (:class:`threading.Event` or `multiprocessing.Event`) stopping the work after
+                the current batch when it is set (for example, when the scheduler loses its lease), or `None`.
+
+        Returns:
+            The number of newly expired purchases."""
+        today = datetime.date.today()
+        total = 0
+        status = Case(When(status__in=SubscriptionStatus.STICKY, then=F('status')),
+                      default=Value(SubscriptionStatus.EXPIRED))
+        while not SubscriptionPurchase.stopped(stop):
+            with transaction.atomic():
+                q = SubscriptionPurchase.objects.select_for_update(skip_locked=True).\
+                    filter(next_action_at__lte=today, payment_deadline__lt=today, expired=False, gratis=False)
+                pks = list(SubscriptionPurchase.in_shard(q, shard, shards).
+                           order_by('next_action_at').values_list('pk', flat=True)[:batch_size])
+                if not pks:
+                    break
+                SubscriptionPurchase.objects.filter(pk__in=pks).update(expired=True, next_action=None, next_action_at=None,
+                                                                      status=status, version=F('version') + 1)
+                if callback is not None:
+                    callback.on_subscription_expired(list(SubscriptionPurchase.objects.filter(pk__in=pks)))
+            total += len(pks)
+        return total
 
     @staticmethod
-    def send_regular_deadline_reminders():
-        """Internal."""
-        reminder_date = datetime.date.today()
-        q = SubscriptionPurchase.objects.filter(reminders_sent__lt=1, payment_deadline__lte=reminder_date, trial=False)
-        for purchase in q:
-            Item.objects.filter(pk=purchase.pk).update(reminders_sent=1)
-            url = reverse(settings.PROLONG_PAYMENT_VIEW, args=[purchase.pk])
-            purchase.send_rendered_email('debits/email/deadline-remind.html',
-                                     _("You need to pay for %s") % purchase.product.name,
-                                     {'transaction': purchase,
-                                      'product': purchase.product.name,
-                                      'url': url})
+    def sweep_statuses(batch_size=1000, stop=None):
+        """Updates :attr:`status` which changed because of the passed time (to be run daily).
+
+        Trial and active purchases not paid on :attr:`due_payment_date` go to the grace period,
+        purchases (including canceled ones, unless replaced by an upgrade) after :attr:`payment_deadline` expire.
+
+        Args:
+            batch_size: how many purchases to update by one query.
+            stop: an event stopping the work after the current batch (see :meth:`sweep_expired`) or `None`.
+
+        Returns:
+            The number of changed purchases."""
+        today = datetime.date.today()
+        superseded = Q(lineage__isnull=False) & ~Q(lineage__head_id=F('pk'))
+        transitions = [
+            (Q(status__in=(SubscriptionStatus.TRIAL, SubscriptionStatus.ACTIVE), due_payment_date__lt=today,
+               payment_deadline__gte=today), SubscriptionStatus.GRACE),
+            (Q(status__in=(SubscriptionStatus.TRIAL, SubscriptionStatus.ACTIVE, SubscriptionStatus.GRACE),
+               payment_deadline__lt=today), SubscriptionStatus.EXPIRED),
+            (Q(status=SubscriptionStatus.CANCELED, payment_deadline__lt=today) & ~superseded,
+             SubscriptionStatus.EXPIRED),
+        ]
+        total = 0
+        for condition, status in transitions:
+            while not SubscriptionPurchase.stopped(stop):
+                pks = list(SubscriptionPurchase.objects.filter(condition).order_by('status', 'payment_deadline').
+                           values_list('pk', flat=True)[:batch_size])
+                if not pks:
+                    break
+                # the condition is repeated in case of concurrent changes
+                total += SubscriptionPurchase.objects.filter(condition, pk__in=pks).\
+                    update(status=status, version=F('version') + 1)
+        return total
 
     @staticmethod
-    def send_trial_reminders():
-        """Internal."""
-        # start with the last
-        SubscriptionPurchase.send_trial_before_due_reminders()
-        SubscriptionPurchase.send_trial_due_reminders()
-        SubscriptionPurchase.send_trial_deadline_reminders()
+    def update_statuses(pks):
+        """Recalculates :attr:`status` of the given purchases (for example, after changing them by `update()`),
+        as :meth:`compute_status` does, by a few `UPDATE` queries (without loading the purchases).
+
+        It also increments :attr:`version`.
+
+        Args:
+            pks: a list of PKs or a queryset of PKs (like `queryset.values('pk')`)."""
+        today = datetime.date.today()
+        queryset = SubscriptionPurchase.objects.filter(pk__in=pks)
+        canceled = Q(status=SubscriptionStatus.CANCELED) & \
+            (Q(subscription_reference__isnull=True) | Q(subscription_reference=''))
+        version = F('version') + 1
+        # Fields of Purchase (`blocked`, `gratis`) can be used only in filters of `update()`, not in values.
+        queryset.filter(canceled).update(version=version)
+        queryset = queryset.exclude(canceled)
+        queryset.filter(blocked=True).update(status=SubscriptionStatus.BLOCKED, version=version)
+        queryset.filter(blocked=False, gratis=True).update(status=SubscriptionStatus.GRATIS, version=version)
+        queryset.filter(blocked=False, gratis=False).update(status=Case(
+            When(Q(payment_deadline__isnull=True) | Q(payment_deadline__lt=today),
+                 then=Value(SubscriptionStatus.EXPIRED)),
+            When(due_payment_date__lt=today, then=Value(SubscriptionStatus.GRACE)),
+            When(trial=True, then=Value(SubscriptionStatus.TRIAL)),
+            default=Value(SubscriptionStatus.ACTIVE)), version=version)
+
+    cancel_requested_at = models.DateTimeField(null=True)
+    """When to (try again to) cancel the automatic payments at the processor or `None` if it is not requested
+    (see :meth:`request_cancels`)."""
 
     @staticmethod
-    def send_trial_before_due_reminders():
-        """Internal."""
-        days_before = settings.PAYMENTS_DAYS_BEFORE_TRIAL_END_REMIND
-        reminder_date = datetime.date.today() + datetime.timedelta(days=days_before)
-        q = SubscriptionPurchase.objects.filter(reminders_sent__lt=3, due_payment_date__lte=reminder_date, trial=True)
-        for purchase in q:
-            Item.objects.filter(pk=purchase.pk).update(reminders_sent=3)
-            url = reverse(settings.PROLONG_PAYMENT_VIEW, args=[purchase.pk])
-            purchase.send_rendered_email('debits/email/before-due-remind.html',
-                                     _("You need to pay for %s") % purchase.product.name,
-                                     {'transaction': purchase,
-                                      'product': purchase.product.name,
-                                      'url': url,
-                                      'days_before': days_before})
+    def request_cancels(queryset):
+        """Queues canceling the automatic payments of the subscribed purchases of `queryset`,
+        done by :meth:`process_cancel_requests` (the `cancels` job of :mod:`debits.debits_base.scheduler`).
+
+        Returns:
+            The number of queued purchases."""
+        return queryset.filter(subscription_reference__isnull=False).\
+            update(cancel_requested_at=timezone.now(), version=F('version') + 1)
 
     @staticmethod
-    def send_trial_due_reminders():
-        """Internal."""
-        reminder_date = datetime.date.today()
-        q = SubscriptionPurchase.objects.filter(reminders_sent__lt=2, due_payment_date__lte=reminder_date, trial=True)
-        for purchase in q:
-            Item.objects.filter(pk=purchase.pk).update(reminders_sent=2)
-            url = reverse(settings.PROLONG_PAYMENT_VIEW, args=[purchase.pk])
-            purchase.send_rendered_email('debits/email/due-remind.html',
-                                     _("You need to pay for %s") % purchase.product.name,
-                                     {'transaction': purchase,
-                                      'product': purchase.product.name,
-                                      'url': url})
+    def process_cancel_requests(batch_size=100, shard=0, shards=1, stop=None):
+        """Cancels the automatic payments queued by :meth:`request_cancels` which are due.
+
+        A batch is claimed by moving :attr:`cancel_requested_at` `settings.PAYMENTS_CANCEL_RETRY_SECONDS`
+        (600 by default) seconds forward, so that several processes can run it at once and a cancel which failed
+        (or whose process died) is retried after that time. A successful one is removed from the queue.
+
+        Args:
+            batch_size: how many purchases to claim at once.
+            shard: process only this shard (see `shards`).
+            shards: the number of shards (of purchases partitioned by the PK).
+            stop: an event stopping the work after the current batch (see :meth:`sweep_expired`) or `None`.
+
+        Returns:
+            The number of canceled subscriptions."""
+        retry = datetime.timedelta(seconds=getattr(settings, 'PAYMENTS_CANCEL_RETRY_SECONDS', 600))
+        total = 0
+        while not SubscriptionPurchase.stopped(stop):
+            now = timezone.now()
+            with transaction.atomic():
+                q = SubscriptionPurchase.objects.select_for_update(skip_locked=True).filter(cancel_requested_at__lte=now)
+                pks = list(SubscriptionPurchase.in_shard(q, shard, shards).
+                           order_by('cancel_requested_at').values_list('pk', flat=True)[:batch_size])
+                if not pks:
+                    break
+                SubscriptionPurchase.objects.filter(pk__in=pks).update(cancel_requested_at=now + retry)
+            for purchase in SubscriptionPurchase.objects.filter(pk__in=pks).order_by('pk'):
+                try:
+                    purchase.force_cancel()
+                except CannotCancelSubscription:
+                    pass  # logged, and the subscription is cleared by force_cancel()
+                except Exception:
+                    logger.exception("Cannot cancel subscription of purchase %d, will retry" % purchase.pk)
+                    continue
+                SubscriptionPurchase.objects.filter(pk=purchase.pk).update(cancel_requested_at=None)
+                total += 1
+        return total
 
     @staticmethod
-    def send_trial_deadline_reminders():
-        """Internal."""
-        reminder_date = datetime.date.today()
-        q = SubscriptionPurchase.objects.filter(reminders_sent__lt=1, payment_deadline__lte=reminder_date, trial=True)
-        for purchase in q:
-            Item.objects.filter(pk=purchase.pk).update(reminders_sent=1)
-            url = reverse(settings.PROLONG_PAYMENT_VIEW, args=[purchase.pk])
-            purchase.send_rendered_email('debits/email/deadline-remind.html',
-                                     _("You need to pay for %s") % purchase.product.name,
-                                     {'transaction': purchase,
-                                      'product': purchase.product.name,
-                                      'url': url})
+    def send_reminders(batch_size=100, shard=0, shards=1, stop=None):
+        """Send all email reminders (at most one to a purchase).
+
+        Several processes can run it at once: every batch of purchases is claimed by locking their rows
+        (`SELECT ... FOR UPDATE SKIP LOCKED`), so that no reminder is sent twice.
+
+        Args:
+            batch_size: how many purchases to claim at once.
+            shard: process only this shard (see `shards`).
+            shards: the number of shards (of purchases partitioned by the PK).
+            stop: an event stopping the work after the current batch (see :meth:`sweep_expired`) or `None`.
+
+        Returns:
+            The number of sent reminders."""
+        q = SubscriptionPurchase.objects.filter(next_action_at__lte=datetime.date.today(),
+                                                next_action__in=SubscriptionAction.REMINDERS)
+        q = SubscriptionPurchase.in_shard(q, shard, shards)
+        last_pk = 0
+        total = 0
+        while not SubscriptionPurchase.stopped(stop):
+            with transaction.atomic():
+                # by PK (not until no more due ones), so that no purchase receives two reminders in one run
+                pks = list(q.select_for_update(skip_locked=True).filter(pk__gt=last_pk).order_by('pk').
+                           values_list('pk', flat=True)[:batch_size])
+                if not pks:
+                    break
+                last_pk = pks[-1]
+                for purchase in SubscriptionPurchase.objects.filter(pk__in=pks).\
+                        select_related('item__product', 'payment').order_by('pk'):
+                    try:
+                        with transaction.atomic():  # don't record a reminder which was not sent
+                            purchase.send_reminder()
+                        total += 1
+                    except Exception:
+                        logger.exception("Cannot send reminder for purchase %d" % purchase.pk)
+        return total
+
+    def send_reminder(self):
+        """Internal.
+
+        Sends the reminder of :attr:`next_action` and schedules the next action."""
+        template_name, reminders_sent = {
+            SubscriptionAction.REMIND_BEFORE_DUE: ('debits/email/before-due-remind.html', 3),
+            SubscriptionAction.REMIND_DUE: ('debits/email/due-remind.html', 2),
+            SubscriptionAction.REMIND_DEADLINE: ('debits/email/deadline-remind.html', 1),
+        }[self.next_action]
+        data = {'transaction': self,
+                'product': self.item.product.name,
+                'url': reverse(settings.PROLONG_PAYMENT_VIEW, args=[self.pk])}
+        if self.next_action == SubscriptionAction.REMIND_BEFORE_DUE:
+            data['days_before'] = self.days_before_due_remind()
+        self.reminders_sent = reminders_sent
+        self.reschedule()
+        SubscriptionPurchase.objects.filter(pk=self.pk).update(reminders_sent=reminders_sent, version=F('version') + 1,
+                                                                 **self.schedule_fields())
+        self.send_rendered_email(template_name, _("You need to pay for %s") % self.item.product.name, data)
 
     # TODO
     # def get_email(self):
@@ -648,9 +1393,9 @@ class ProlongPurchase(SimplePurchase):
         For :class:`ProlongPurchase` we subtract the prolong days back from the :attr:`parent` item."""
         prolong2 = self.period
         prolong2.count *= -1
-        klass = model_from_ref(self.payment.transaction.processor.klass)
-        self.prolonged.set_payment_date(klass.offset_date(self.prolonged.due_payment_date, prolong2))
-        self.prolonged.save()
+        klass = processor_registry.klass(self.payment.transaction.processor_id)
+        self.prolonged.update_dates(
+            lambda purchase: purchase.set_payment_date(klass.offset_date(purchase.due_payment_date, prolong2)))
 
 
 class Payment(models.Model):
@@ -658,31 +1403,65 @@ class Payment(models.Model):
 
     It generated by our IPN handler."""
 
+    class Meta:
+        indexes = [
+            # export and history (see debits.debits_base.history)
+            models.Index(fields=['payment_time', 'id'], name='debits_payment_history'),
+            models.Index(fields=['email', 'payment_time', 'id'], name='debits_payment_email_history'),
+            models.Index(fields=['transaction_purchase', 'payment_time', 'id'], name='debits_payment_purchase_hist'),
+        ]
+
     payment_time = models.DateTimeField(_('Payment time'), auto_now_add=True)
 
     transaction = models.OneToOneField('BaseTransaction', on_delete=models.CASCADE)
     """The transaction we accepted."""
 
+    transaction_purchase = models.ForeignKey('Purchase', null=True, related_name='+', db_index=False,
+                                             on_delete=models.CASCADE)
+    """The purchase of :attr:`transaction` (copied from it on save), for the payment history of purchases
+    (see :mod:`debits.debits_base.history`)."""
+
+    def save(self, *args, **kwargs):
+        if self.transaction_purchase_id is None:
+            self.transaction_purchase_id = self.transaction.purchase_id
+        super().save(*args, **kwargs)
+
     email = models.EmailField(null=True)
     """User's email.
 
     DalPay requires to notify the customer 10 days before every payment."""
 
+    refunded = models.BooleanField(default=False)
+    """Whether the refund of this payment was recorded (see :meth:`refund_payment`)."""
+
     def refund_payment(self):
-        """Handles payment refund."""
+        """Handles payment refund.
+
+        A refund is recorded only once (for example, recorded in the admin and then notified
+        by the payment processor).
+
+        Returns:
+            Whether the refund was recorded now."""
         # Controversial decision to reset payment=None on refund
         # try:
         #     SimplePayment.objects.filter(pk=self.pk).update(payment=None, status=SimplePaymentStatus.REFUNDED)
         # except ObjectDoesNotExist:
         #     Payment.objects.filter(pk=self.pk).update(payment=None)
-        try:
-            SimplePurchase.objects.filter(pk=self.purchase.pk).update(status=SimplePaymentStatus.REFUNDED)
-        except ObjectDoesNotExist:
-            pass
-        try:
-            self.transaction.purchase.simplepurchase.prolongpurchase.refund_payment()
-        except (SimplePurchase.DoesNotExist, ProlongPurchase.DoesNotExist):
-            pass
+        with transaction.atomic():
+            if not Payment.objects.filter(pk=self.pk, refunded=False).update(refunded=True):
+                return False
+            self.refunded = True
+            purchase = self.transaction.purchase
+            try:
+                SimplePurchase.objects.filter(pk=purchase.pk).update(status=SimplePaymentStatus.REFUNDED)
+            except ObjectDoesNotExist:
+                pass
+            DailyRollup.record(purchase, refunds=1, refunded=DailyRollup.amount(purchase))
+            try:
+                self.transaction.purchase.simplepurchase.prolongpurchase.refund_payment()
+            except (SimplePurchase.DoesNotExist, ProlongPurchase.DoesNotExist):
+                pass
+        return True
 
 
 class SimplePayment(Payment):
@@ -694,6 +1473,11 @@ class SimplePayment(Payment):
 class AutomaticPayment(Payment):
     """Automatic (recurring) payment."""
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['subscription_reference'], name='debits_autopayment_reference'),
+        ]
+
     processor = models.ForeignKey(PaymentProcessor, on_delete=models.CASCADE)
     """Payment processor."""
 
@@ -744,6 +1528,197 @@ class AggregatePurchase(SimplePurchase):
         return True
 
 
+class PurchaseLineage(models.Model):
+    """Maps every purchase of an upgrade chain (see :attr:`Purchase.old_subscription`) to the first purchase
+    of the chain and to the current one.
+
+    :attr:`Purchase.old_subscription` is reset after an upgrade, so the chain cannot be walked later.
+    Purchases which were never upgraded may have no lineage."""
+
+    purchase = models.OneToOneField(Purchase, primary_key=True, related_name='lineage', on_delete=models.CASCADE)
+
+    root = models.ForeignKey(Purchase, related_name='+', on_delete=models.CASCADE)
+    """The first purchase of the chain."""
+
+    head = models.ForeignKey(Purchase, related_name='+', on_delete=models.CASCADE)
+    """The current (latest activated) purchase of the chain."""
+
+    subscription_reference = models.CharField(max_length=255, null=True, db_index=True)
+    """The last :attr:`SubscriptionPurchase.subscription_reference` of :attr:`purchase`
+    (kept after the subscription is canceled)."""
+
+    @staticmethod
+    def ensure(purchase_id):
+        """Internal.
+
+        Creates the lineage of a purchase, as a chain of one purchase, if it has none."""
+        try:
+            with transaction.atomic():
+                PurchaseLineage.objects.get_or_create(purchase_id=purchase_id,
+                                                      defaults={'root_id': purchase_id, 'head_id': purchase_id})
+        except IntegrityError:  # created concurrently
+            pass
+
+    @staticmethod
+    @transaction.atomic
+    def link(old_id, new_id):
+        """Internal.
+
+        Makes the purchase `new_id` the head of the chain of `old_id`. It can be called repeatedly."""
+        PurchaseLineage.ensure(old_id)
+        root_id = PurchaseLineage.objects.filter(purchase_id=old_id).values_list('root_id', flat=True).get()
+        # serializes concurrent links of the same chain
+        PurchaseLineage.objects.select_for_update().filter(purchase_id=root_id).exists()
+        PurchaseLineage.objects.filter(root_id=new_id).update(root_id=root_id)
+        PurchaseLineage.ensure(new_id)
+        PurchaseLineage.objects.filter(purchase_id=new_id).update(root_id=root_id)
+        PurchaseLineage.objects.filter(root_id=root_id).update(head_id=new_id)
+
+    @staticmethod
+    def activated(purchase_id, subscription_reference):
+        """Internal.
+
+        Records the subscription reference of an activated subscription."""
+        PurchaseLineage.ensure(purchase_id)
+        PurchaseLineage.objects.filter(purchase_id=purchase_id).update(subscription_reference=subscription_reference)
+
+    @staticmethod
+    def current(purchase_id):
+        """The PK of the current purchase of the chain of the given purchase (by one indexed lookup)."""
+        head_id = PurchaseLineage.objects.filter(purchase_id=purchase_id).values_list('head_id', flat=True).first()
+        return purchase_id if head_id is None else head_id
+
+    @staticmethod
+    def current_by_reference(subscription_reference):
+        """The PK of the current purchase of the chain of the purchase with the given (maybe old)
+        subscription reference, or `None` if no activated purchase had this reference."""
+        return PurchaseLineage.objects.filter(subscription_reference=subscription_reference).\
+            values_list('head_id', flat=True).first()
+
+
+class DailyRollup(models.Model):
+    """Totals of a day for a product and currency, for dashboards.
+
+    They are updated incrementally when payments, activations, cancellations, refunds and trials happen.
+    See :mod:`debits.debits_base.rollups` for reading and rebuilding them."""
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'product', 'currency'], name='debits_rollup_unique'),
+        ]
+
+    day = models.DateField()
+
+    product = models.ForeignKey(Product, null=True, on_delete=models.CASCADE)
+
+    currency = models.CharField(max_length=3)
+
+    payments = models.IntegerField(default=0)
+    """The number of received payments."""
+
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    """The sum of received payments (including shipping and tax)."""
+
+    refunds = models.IntegerField(default=0)
+    """The number of refunded payments."""
+
+    refunded = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    """The refunded sum."""
+
+    activations = models.IntegerField(default=0)
+    """The number of activated subscriptions."""
+
+    cancellations = models.IntegerField(default=0)
+    """The number of canceled subscriptions."""
+
+    mrr_change = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    """Change of the monthly recurring revenue."""
+
+    trials_started = models.IntegerField(default=0)
+
+    trials_converted = models.IntegerField(default=0)
+    """The number of subscriptions activated during a trial period."""
+
+    COUNTERS = ('payments', 'revenue', 'refunds', 'refunded', 'activations', 'cancellations', 'mrr_change',
+                'trials_started', 'trials_converted')
+
+    @staticmethod
+    def add(day, product_id, currency, **deltas):
+        """Internal.
+
+        Adds `deltas` (counter name -> value) to the counters of a rollup, creating it if needed."""
+        keys = {'day': day, 'product_id': product_id, 'currency': currency}
+        updates = {name: F(name) + value for name, value in deltas.items()}
+        if DailyRollup.objects.filter(**keys).update(**updates):
+            return
+        try:
+            with transaction.atomic():
+                DailyRollup.objects.create(**keys, **deltas)
+        except IntegrityError:  # created concurrently
+            DailyRollup.objects.filter(**keys).update(**updates)
+
+    @staticmethod
+    def record(purchase, **deltas):
+        """Internal.
+
+        Adds `deltas` to today's rollup of the product and the currency of `purchase`."""
+        DailyRollup.add(datetime.date.today(), purchase.item.product_id, purchase.item.currency, **deltas)
+
+    @staticmethod
+    def amount(purchase):
+        """Internal.
+
+        The amount paid for `purchase`."""
+        return purchase.item.price + purchase.shipping + purchase.tax
+
+    @staticmethod
+    def monthly_amount(price, period):
+        """Internal.
+
+        `price` paid every `period` (:class:`~debits.debits_base.base.Period`) converted to the monthly amount."""
+        months = period_to_months(period)
+        if months == 0:
+            return Decimal(0)
+        return (price / months).quantize(Decimal('0.01'))
+
+
+class SchedulerLease(models.Model):
+    """Who runs periodic jobs (see :mod:`debits.debits_base.scheduler`).
+
+    The node which renewed the lease last is the leader until :attr:`expires_at`."""
+
+    name = models.CharField(max_length=100, primary_key=True)
+
+    holder = models.CharField(max_length=255)
+    """The ID of the leader node."""
+
+    expires_at = models.DateTimeField()
+
+
+class JobRun(models.Model):
+    """A run of a periodic job (see :mod:`debits.debits_base.scheduler`)."""
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['job', 'started'], name='debits_jobrun_started'),
+        ]
+
+    job = models.CharField(max_length=100)
+
+    node = models.CharField(max_length=255)
+    """The ID of the node which ran the job."""
+
+    started = models.DateTimeField()
+
+    duration = models.FloatField(null=True)
+    """In seconds (`None` while running)."""
+
+    succeeded = models.BooleanField(null=True)
+    """`None` while running."""
+
+    error = models.TextField(null=True)
+
+
 class CannotCancelSubscription(Exception):
     """Canceling subscription failed."""
     pass
@@ -752,3 +1727,8 @@ class CannotCancelSubscription(Exception):
 class CannotRefund(Exception):
     """Refunding payment failed."""
     pass
+
+
+class ConcurrentUpdate(Exception):
+    """The object was changed concurrently too many times (see :meth:`SubscriptionPurchase.update_dates`)."""
+    pass
@@ -0,0 +1,36 @@
+from django.db import NotSupportedError
+from django.db.migrations.operations import AddIndex
+
+
+class AddIndexConcurrently(AddIndex):
+    """Like :class:`AddIndex`, but on PostgreSQL creates the index without locking the table for writes.
+
+    On other databases it is the same as :class:`AddIndex`.
+    A migration using it on PostgreSQL must have ``atomic = False``."""
+
+    def describe(self):
+        return "Concurrently create index %s on field(s) %s of model %s" % (
+            self.index.name, ', '.join(self.index.fields), self.model_name)
+
+    @staticmethod
+    def _concurrently(schema_editor):
+        if schema_editor.connection.vendor != 'postgresql':
+            return False
+        if schema_editor.connection.in_atomic_block:
+            raise NotSupportedError("AddIndexConcurrently cannot be executed inside a transaction, "
+                                    "set atomic = False in the migration.")
+        return True
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if not self._concurrently(schema_editor):
+            return super().database_forwards(app_label, schema_editor, from_state, to_state)
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.add_index(model, self.index, concurrently=True)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if not self._concurrently(schema_editor):
+            return super().database_backwards(app_label, schema_editor, from_state, to_state)
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.remove_index(model, self.index, concurrently=True)
@@ -110,6 +110,9 @@ class PaymentCallback(object):
     In current implementation, :meth:`on_subscription_created` may be called when it was already started
     and :meth:`on_subscription_canceled` may be called when it is already stopped.
     (In other words, they can be called multiple times in a row.)
+
+    The hooks called for an event (IPN) are called after its DB transaction is committed,
+    so they don't hold the lock of the purchase; their exceptions are logged.
     """
     def on_payment(self, payment):
         """Called on any payment (subscription or regular)."""
@@ -125,3 +128,11 @@ class PaymentCallback(object):
     def on_subscription_canceled(self, POST, subscription):
         """Called when a subscription is canceled."""
         pass
+
+    def on_subscription_expired(self, purchases):
+        """Called by :meth:`~debits.debits_base.models.SubscriptionPurchase.sweep_expired`
+        with a list of purchases whose payment deadline has just passed.
+
+        It is called before the transaction marking them as expired is committed: if it raises,
+        the purchases are not marked and are passed to it again by the next sweep."""
+        pass
@@ -0,0 +1,189 @@
+"""Reading and rebuilding :class:`~debits.debits_base.models.DailyRollup`.
+
+Dashboard reads sum rollups by day, so their cost depends on the number of days, not on the number
+of purchases and payments."""
+
+import datetime
+from collections import defaultdict
+from itertools import chain
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum, Min, Max
+from django.utils import timezone
+
+from debits.debits_base.models import DailyRollup, Payment, SubscriptionPurchase, SimplePaymentStatus
+
+
+def rollups(product=None, currency=None):
+    """Internal."""
+    queryset = DailyRollup.objects.all()
+    if product is not None:
+        queryset = queryset.filter(product=product)
+    if currency is not None:
+        queryset = queryset.filter(currency=currency)
+    return queryset
+
+
+def daily_totals(since, until, product=None, currency=None):
+    """Counters of :class:`~debits.debits_base.models.DailyRollup` summed by day.
+
+    Besides of the counters, every day contains the number of `active_subscribers` and the `mrr`
+    (monthly recurring revenue) at the end of the day. Amounts in different currencies are summed,
+    so pass `currency` to get meaningful sums.
+
+    Args:
+        since: the first day.
+        until: the day after the last day.
+        product: :class:`~debits.debits_base.models.Product` (or its PK) or `None` for all products.
+        currency: a currency code or `None` for all currencies.
+
+    Returns:
+        A list of dicts (with `day` key and counters) ordered by day. Days without rollups are skipped."""
+    queryset = rollups(product, currency)
+    before = queryset.filter(day__lt=since).aggregate(
+        activations=Sum('activations'), cancellations=Sum('cancellations'), mrr=Sum('mrr_change'))
+    active_subscribers = (before['activations'] or 0) - (before['cancellations'] or 0)
+    mrr = before['mrr'] or 0
+    result = []
+    days = queryset.filter(day__gte=since, day__lt=until).values('day').\
+        annotate(**{name: Sum(name) for name in DailyRollup.COUNTERS}).order_by('day')
+    for day in days:
+        active_subscribers += day['activations'] - day['cancellations']
+        mrr += day['mrr_change']
+        day['active_subscribers'] = active_subscribers
+        day['mrr'] = mrr
+        result.append(day)
+    return result
+
+
+def local_day(time):
+    """Internal."""
+    return timezone.localtime(time).date() if timezone.is_aware(time) else time.date()
+
+
+def add_all(totals):
+    """Internal.
+
+    Adds collected `totals` ((day, product_id, currency) -> counter name -> value) to the rollups."""
+    for (day, product_id, currency), deltas in totals.items():
+        DailyRollup.add(day, product_id, currency, **deltas)
+
+
+def day_start(day):
+    """Internal.
+
+    The beginning of a day (in the current time zone) as a value for datetime fields."""
+    time = datetime.datetime.combine(day, datetime.time.min)
+    return timezone.make_aware(time) if timezone.is_naive(time) and settings.USE_TZ else time
+
+
+def keyset_chunks(queryset, fields, chunk_size):
+    """Internal.
+
+    Generates lists of :meth:`values_list` rows (PK is the first field) in PK order."""
+    last_pk = 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last_pk).order_by('pk').values_list('pk', *fields)[:chunk_size])
+        if not rows:
+            break
+        yield rows
+        last_pk = rows[-1][0]
+
+
+def data_days():
+    """Internal.
+
+    The first day with data and the day after the last day (`None, None` if there is no data)."""
+    days = []
+    for model, field in ((Payment, 'payment_time'), (SubscriptionPurchase, 'creation_date')):
+        times = model.objects.aggregate(first=Min(field), last=Max(field))
+        days += [local_day(times['first']), local_day(times['last'])] if times['first'] is not None else []
+    rollup_days = DailyRollup.objects.aggregate(first=Min('day'), last=Max('day'))
+    days += [rollup_days['first'], rollup_days['last']] if rollup_days['first'] is not None else []
+    if not days:
+        return None, None
+    return min(days), max(days) + datetime.timedelta(days=1)
+
+
+def rebuild(since=None, until=None, chunk_size=1000, days=31, stop=None):
+    """Rebuilds rollups from payments and purchases.
+
+    Rollups are rebuilt by ranges of `days` days, every range in a separate DB transaction
+    (deleting and rebuilding its rollups), so that the incremental updates of rollups are
+    not blocked for long. (An event which happens while its day is being rebuilt may be
+    counted twice or not at all, so rebuild at a quiet time or rebuild the day again.)
+
+    The DB does not keep the history of cancellations and refunds, so:
+
+    * active subscriptions are counted as activated on the day of their last payment
+      (or of the purchase creation) and subscriptions canceled in the past are not counted at all;
+    * refunds are counted on the day of the payment.
+
+    Args:
+        since: the first day to rebuild or `None` for the first day with data.
+        until: the day after the last day to rebuild or `None` for the day after the last day with data.
+        chunk_size: how many rows to read with one query.
+        days: the number of days rebuilt in one DB transaction.
+        stop: :class:`threading.Event` stopping the rebuild after the current range when it is set, or `None`."""
+    first, last = data_days()
+    since = since or first
+    until = until or last
+    if since is None:
+        return
+    day = since
+    while day < until and not (stop is not None and stop.is_set()):
+        end = min(day + datetime.timedelta(days=days), until)
+        rebuild_range(day, end, chunk_size)
+        day = end
+
+
+@transaction.atomic
+def rebuild_range(since, until, chunk_size):
+    """Internal.
+
+    Rebuilds the rollups of the days from `since` until (excluding) `until`."""
+    DailyRollup.objects.filter(day__gte=since, day__lt=until).delete()
+    start, end = day_start(since), day_start(until)
+
+    fields = ('payment_time', 'transaction__purchase__item__product_id', 'transaction__purchase__item__currency',
+              'transaction__purchase__item__price', 'transaction__purchase__shipping', 'transaction__purchase__tax',
+              'transaction__purchase__simplepurchase__status')
+    payments = Payment.objects.filter(payment_time__gte=start, payment_time__lt=end)
+    for rows in keyset_chunks(payments, fields, chunk_size):
+        totals = defaultdict(lambda: defaultdict(int))
+        for pk, time, product_id, currency, price, shipping, tax, status in rows:
+            counters = totals[(local_day(time), product_id, currency)]
+            counters['payments'] += 1
+            counters['revenue'] += price + shipping + tax
+            if status == SimplePaymentStatus.REFUNDED:
+                counters['refunds'] += 1
+                counters['refunded'] += price + shipping + tax
+        add_all(totals)
+
+    fields = ('creation_date', 'payment__payment_time', 'item__product_id', 'item__currency', 'item__price',
+              'item__subscriptionitem__payment_period_unit', 'item__subscriptionitem__payment_period_count',
+              'item__subscriptionitem__trial_period_count', 'subscription_reference')
+
+    def in_range(time):
+        return time is not None and start <= time < end
+
+    # created in the range and created before it but paid in it (two queries, each using an index)
+    created_purchases = SubscriptionPurchase.objects.filter(creation_date__gte=start, creation_date__lt=end)
+    paid_purchases = SubscriptionPurchase.objects.filter(payment__payment_time__gte=start,
+                                                         payment__payment_time__lt=end, creation_date__lt=start)
+    for rows in chain(keyset_chunks(created_purchases, fields, chunk_size),
+                      keyset_chunks(paid_purchases, fields, chunk_size)):
+        totals = defaultdict(lambda: defaultdict(int))
+        for pk, created, paid, product_id, currency, price, unit, count, trial_count, reference in rows:
+            if trial_count:
+                if in_range(created):
+                    totals[(local_day(created), product_id, currency)]['trials_started'] += 1
+                if in_range(paid):
+                    totals[(local_day(paid), product_id, currency)]['trials_converted'] += 1
+            if reference is not None and in_range(paid or created):
+                counters = totals[(local_day(paid or created), product_id, currency)]
+                counters['activations'] += 1
+                counters['mrr_change'] += DailyRollup.monthly_amount(price, SimpleNamespace(unit=unit, count=count))
+        add_all(totals)
@@ -0,0 +1,127 @@
+"""Sending reads of Debits models to DB replicas.
+
+Add ``'debits.debits_base.routers.DebitsRouter'`` to `settings.DATABASE_ROUTERS`
+and ``'debits.debits_base.routers.ReplicaPinningMiddleware'`` to `settings.MIDDLEWARE`.
+
+Settings:
+
+* `PAYMENTS_PRIMARY_DATABASE` - the DB alias used for writes (``'default'`` by default);
+* `PAYMENTS_REPLICA_DATABASES` - list of DB aliases used for reads (if empty, reads go to the primary);
+* `PAYMENTS_REPLICA_PIN_SECONDS` - how long after a write reads go to the primary (5 by default);
+* `PAYMENTS_ROUTED_APPS` - app labels to route (``('debits_base', 'paypal')`` by default).
+"""
+
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+
+
+_pinned_until = ContextVar('debits_pinned_until', default=0.0)
+_primary_depth = ContextVar('debits_primary_depth', default=0)
+
+
+def primary_database():
+    """The DB alias used for writes."""
+    return getattr(settings, 'PAYMENTS_PRIMARY_DATABASE', 'default')
+
+
+def replica_databases():
+    """The DB aliases used for reads."""
+    return getattr(settings, 'PAYMENTS_REPLICA_DATABASES', [])
+
+
+def pin_seconds():
+    """Internal."""
+    return getattr(settings, 'PAYMENTS_REPLICA_PIN_SECONDS', 5)
+
+
+def pin_to_primary():
+    """Make reads (in the current thread or coroutine) go to the primary for the next
+    `PAYMENTS_REPLICA_PIN_SECONDS` seconds. Called on every write of a routed model."""
+    _pinned_until.set(time.time() + pin_seconds())
+
+
+@contextmanager
+def use_primary():
+    """Context manager to read routed models only from the primary."""
+    token = _primary_depth.set(_primary_depth.get() + 1)
+    try:
+        yield
+    finally:
+        _primary_depth.reset(token)
+
+
+def read_from_primary():
+    """Whether routed models should now be read from the primary."""
+    primary = primary_database()
+    return not replica_databases() or \
+        _primary_depth.get() > 0 or \
+        _pinned_until.get() > time.time() or \
+        connections[primary].in_atomic_block  # for example, select_for_update()
+
+
+class DebitsRouter(object):
+    """Routes reads of Debits models to replicas and writes to the primary.
+
+    Reads go to the primary inside :func:`use_primary`, inside DB transactions and
+    for `PAYMENTS_REPLICA_PIN_SECONDS` after a write."""
+
+    def routed(self, model):
+        """Internal."""
+        return model._meta.app_label in getattr(settings, 'PAYMENTS_ROUTED_APPS', ('debits_base', 'paypal'))
+
+    def db_for_read(self, model, **hints):
+        if not self.routed(model):
+            return None
+        if read_from_primary():
+            return primary_database()
+        return random.choice(replica_databases())
+
+    def db_for_write(self, model, **hints):
+        if not self.routed(model):
+            return None
+        pin_to_primary()
+        return primary_database()
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if self.routed(type(obj1)) and self.routed(type(obj2)):
+            return True  # replicas contain the same data
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label in getattr(settings, 'PAYMENTS_ROUTED_APPS', ('debits_base', 'paypal')):
+            return db == primary_database()
+        return None
+
+
+class ReplicaPinningMiddleware(object):
+    """Keeps reading from the primary in following requests of the same client after a write.
+
+    The pin is kept in a cookie for `PAYMENTS_REPLICA_PIN_SECONDS`."""
+
+    cookie_name = 'debits_pinned_until'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        now = time.time()
+        try:
+            pinned_until = float(request.COOKIES.get(self.cookie_name, 0))
+        except ValueError:
+            pinned_until = 0.0
+        pinned_until = min(pinned_until, now + pin_seconds())  # don't trust the client too much
+        token = _pinned_until.set(pinned_until)
+        try:
+            response = self.get_response(request)
+            new_pinned_until = _pinned_until.get()
+        finally:
+            _pinned_until.reset(token)
+        if new_pinned_until > pinned_until:
+            response.set_cookie(self.cookie_name, str(new_pinned_until),
+                                max_age=int(new_pinned_until - now) + 1, httponly=True)
+        return response
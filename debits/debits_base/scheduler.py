@@ -0,0 +1,242 @@
+"""Running periodic jobs (reminders, expiry, archiving, rollups) on one of several nodes.
+
+Every node runs ``python manage.py debits_scheduler``. The nodes elect the leader by
+:class:`~debits.debits_base.models.SchedulerLease`: the leader renews the lease while it works,
+and when it dies (stops renewing), another node takes the lease after it expires.
+Only the leader runs jobs. Every run is recorded as :class:`~debits.debits_base.models.JobRun`,
+so the new leader continues the schedule of the old one.
+
+Jobs are configured by `settings.PAYMENTS_SCHEDULER_JOBS`, a dict from a job name to a dict
+with the keys `function` (a dotted path of a function without arguments) and `interval` (in seconds).
+It is merged with :data:`DEFAULT_JOBS`; a job set to `None` or with `None` interval is disabled.
+
+The lease is timed by the DB clock (not by the clocks of nodes, which may differ).
+If the leader fails to renew the lease while a job runs (so that another node may take it),
+the job is asked to stop: a function having the argument `stop` receives :class:`threading.Event`
+which is set then, and should return soon after it (the default jobs stop after the current batch).
+Such a run is recorded as failed."""
+
+import datetime
+import gzip
+import inspect
+import os
+import random
+import socket
+import threading
+import time
+import traceback
+
+from django.conf import settings
+from django.db import IntegrityError, transaction, close_old_connections, connection
+from django.db.models import Q, DateTimeField, ExpressionWrapper
+from django.db.models.functions import Now
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from debits.debits_base.base import logger
+from debits.debits_base.models import SubscriptionPurchase, SchedulerLease, JobRun
+from debits.debits_base.workers import run_sharded
+
+LEASE_NAME = 'debits'
+"""The name of the lease of the scheduler."""
+
+
+def send_reminders(stop=None):
+    """The job sending reminders (in `settings.PAYMENTS_WORKER_PROCESSES` processes)."""
+    run_sharded('reminders', stop=stop)
+
+
+def expire(stop=None):
+    """The job expiring purchases (see :meth:`~debits.debits_base.models.SubscriptionPurchase.sweep_expired`),
+    in `settings.PAYMENTS_WORKER_PROCESSES` processes, and updating their statuses."""
+    run_sharded('expiry', stop=stop)
+    SubscriptionPurchase.sweep_statuses(stop=stop)
+
+
+def cancel_subscriptions(stop=None):
+    """The job canceling subscriptions queued by
+    :meth:`~debits.debits_base.models.SubscriptionPurchase.request_cancels` (for example, in the admin)."""
+    run_sharded('cancels', stop=stop)
+
+
+def archive():
+    """The job archiving objects older than `settings.PAYMENTS_ARCHIVE_DAYS` (90 by default) days
+    to the file `settings.PAYMENTS_ARCHIVE_FILE` (nothing is done if it is not set)."""
+    from debits.debits_base.archive import archive_unpaid_transactions, archive_abandoned_purchases, \
+        archive_superseded_purchases
+    filename = getattr(settings, 'PAYMENTS_ARCHIVE_FILE', None)
+    if filename is None:
+        return
+    days = getattr(settings, 'PAYMENTS_ARCHIVE_DAYS', 90)
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'at', encoding='utf-8') as out:
+        archive_unpaid_transactions(out, days)
+        archive_abandoned_purchases(out, days)
+        archive_superseded_purchases(out, days)
+
+
+def rebuild_rollups(stop=None):
+    """The job reconciling dashboard rollups with payments (see :func:`debits.debits_base.rollups.rebuild`)."""
+    from debits.debits_base.rollups import rebuild
+    rebuild(stop=stop)
+
+
+DEFAULT_JOBS = {
+    'reminders': {'function': 'debits.debits_base.scheduler.send_reminders', 'interval': 3600},
+    'expiry': {'function': 'debits.debits_base.scheduler.expire', 'interval': 3600},
+    'cancels': {'function': 'debits.debits_base.scheduler.cancel_subscriptions', 'interval': 60},
+    'archive': {'function': 'debits.debits_base.scheduler.archive', 'interval': 86400},
+    # it rebuilds everything, enable it by {'interval': ...} if needed
+    'rollups': {'function': 'debits.debits_base.scheduler.rebuild_rollups', 'interval': None},
+}
+"""Default jobs (see the module docs)."""
+
+
+def configured_jobs():
+    """Internal.
+
+    The jobs from :data:`DEFAULT_JOBS` and settings, as a dict from the name to (function, interval)."""
+    jobs = {}
+    overrides = getattr(settings, 'PAYMENTS_SCHEDULER_JOBS', {})
+    for name in set(DEFAULT_JOBS) | set(overrides):
+        if name in overrides and overrides[name] is None:
+            continue
+        job = dict(DEFAULT_JOBS.get(name, {}), **overrides.get(name, {}))
+        if job['interval'] is not None:
+            jobs[name] = (import_string(job['function']), job['interval'])
+    return jobs
+
+
+def node_id():
+    """Internal.
+
+    A unique ID of this process."""
+    return '%s:%d:%s' % (socket.gethostname(), os.getpid(), '%08x' % random.getrandbits(32))
+
+
+class Scheduler(object):
+    """Runs periodic jobs on the leader node.
+
+    Args:
+        jobs: a dict from a job name to (function, interval in seconds); by default :func:`configured_jobs`.
+        lease_seconds: how long the leader keeps the lease without renewing it.
+        jitter: the relative random deviation of intervals (so that nodes and jobs don't run in lockstep)."""
+
+    def __init__(self, jobs=None, lease_seconds=60, jitter=0.1):
+        self.jobs = configured_jobs() if jobs is None else jobs
+        self.lease_seconds = lease_seconds
+        self.jitter = jitter
+        self.node = node_id()
+        self.next_runs = {}
+
+    def renew(self):
+        """Takes or renews the lease.
+
+        Returns:
+            Whether this node is the leader."""
+        expires_at = ExpressionWrapper(Now() + datetime.timedelta(seconds=self.lease_seconds),
+                                       output_field=DateTimeField())
+        if SchedulerLease.objects.filter(Q(holder=self.node) | Q(expires_at__lte=Now()), name=LEASE_NAME).\
+                update(holder=self.node, expires_at=expires_at):
+            return True
+        try:
+            with transaction.atomic():
+                SchedulerLease.objects.create(name=LEASE_NAME, holder=self.node, expires_at=expires_at)
+            return True
+        except IntegrityError:  # exists and held by another node
+            return False
+
+    def release(self):
+        """Gives the lease to another node (if this node is the leader)."""
+        SchedulerLease.objects.filter(name=LEASE_NAME, holder=self.node).update(expires_at=Now())
+
+    def jittered(self, interval):
+        """Internal."""
+        return datetime.timedelta(seconds=interval * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def next_run(self, name, interval, now):
+        """Internal.
+
+        When to run the job next (continuing the schedule of the previous leader)."""
+        if name not in self.next_runs:
+            last = JobRun.objects.filter(job=name).order_by('-started').values_list('started', flat=True).first()
+            self.next_runs[name] = now if last is None else last + self.jittered(interval)
+        return self.next_runs[name]
+
+    def run_job(self, name):
+        """Runs a job (while renewing the lease) and records it as :class:`~debits.debits_base.models.JobRun`.
+
+        If the lease is lost, the job is asked to stop (see the module docs) and the run is recorded as failed."""
+        function, interval = self.jobs[name]
+        run = JobRun.objects.create(job=name, node=self.node, started=timezone.now())
+        self.next_runs[name] = run.started + self.jittered(interval)
+        done = threading.Event()
+        lost = threading.Event()
+        heartbeat = threading.Thread(target=self.heartbeat, args=(done, lost), daemon=True)
+        heartbeat.start()
+        start = time.monotonic()
+        try:
+            if 'stop' in inspect.signature(function).parameters:
+                function(stop=lost)
+            else:
+                function()
+            run.succeeded = not lost.is_set()
+            if lost.is_set():
+                run.error = "The lease was lost"
+        except Exception:
+            logger.exception("Job %s failed" % name)
+            run.succeeded = False
+            run.error = traceback.format_exc()
+        finally:
+            done.set()
+            heartbeat.join()
+        run.duration = time.monotonic() - start
+        run.save(update_fields=['succeeded', 'error', 'duration'])
+        return run
+
+    def heartbeat(self, done, lost):
+        """Internal.
+
+        Renews the lease until `done` is set; sets `lost` and stops if another node took the lease."""
+        try:
+            while not done.wait(self.lease_seconds / 3):
+                try:
+                    renewed = self.renew()
+                except Exception:  # for example, the DB is temporarily unavailable; retry while the lease lasts
+                    logger.exception("Scheduler %s cannot renew the lease" % self.node)
+                    continue
+                if not renewed:
+                    logger.warning("Scheduler %s lost the lease while running a job, stopping it" % self.node)
+                    lost.set()
+                    return
+        finally:
+            connection.close()  # of this thread
+
+    def run_pending(self):
+        """Runs the due jobs if this node is the leader.
+
+        Returns:
+            The list of :class:`~debits.debits_base.models.JobRun` of the run jobs."""
+        runs = []
+        for name, (function, interval) in sorted(self.jobs.items()):
+            close_old_connections()
+            if not self.renew():
+                self.next_runs.clear()  # the schedule may be changed by the leader
+                break
+            now = timezone.now()
+            if now >= self.next_run(name, interval, now):
+                runs.append(self.run_job(name))
+        return runs
+
+    def run_forever(self, poll=10, stop=None):
+        """Runs due jobs every `poll` seconds (with jitter) until `stop` (:class:`threading.Event`) is set."""
+        stop = stop or threading.Event()
+        try:
+            while not stop.is_set():
+                try:
+                    self.run_pending()
+                except Exception:  # for example, the DB is temporarily unavailable
+                    logger.exception("Scheduler error")
+                stop.wait(poll * random.uniform(1 - self.jitter, 1 + self.jitter))
+        finally:
+            self.release()
@@ -0,0 +1,48 @@
+from django.apps import apps
+from django.db.models.signals import post_save, post_delete
+
+from debits.debits_base.models import BaseTransaction, Item, Product
+from debits.debits_base.loader import invalidate_transactions, invalidate_items
+
+
+def connect_changed(handler, base):
+    """Connects `handler` to `post_save` and `post_delete` of `base` and every installed model inheriting from it.
+
+    A model signal is sent with the class of the saved instance as the sender, so a receiver connected
+    with `sender=base` would miss the subclasses (such as :class:`~debits.debits_base.models.SubscriptionItem`)."""
+    for model in apps.get_models():
+        if issubclass(model, base):
+            post_save.connect(handler, sender=model)
+            post_delete.connect(handler, sender=model)
+
+
+def for_product_items(product, invalidate, batch_size=1000):
+    """Calls `invalidate(*pks)` for the PKs of all items of `product`, `batch_size` PKs at a time."""
+    pks = []
+    for pk in Item.objects.filter(product=product.pk).values_list('pk', flat=True).iterator():
+        pks.append(pk)
+        if len(pks) == batch_size:
+            invalidate(*pks)
+            pks = []
+    if pks:
+        invalidate(*pks)
+
+
+def on_transaction_changed(sender, instance, **kwargs):
+    """Remove a changed transaction from the cache of :mod:`debits.debits_base.loader`."""
+    invalidate_transactions(instance.pk)
+
+
+def on_item_changed(sender, instance, **kwargs):
+    """Remove a changed item from the cache of :mod:`debits.debits_base.loader`."""
+    invalidate_items(instance.pk)
+
+
+def on_product_changed(sender, instance, **kwargs):
+    """Remove the items of a changed product from the cache of :mod:`debits.debits_base.loader`."""
+    for_product_items(instance, invalidate_items)
+
+
+connect_changed(on_transaction_changed, BaseTransaction)
+connect_changed(on_item_changed, Item)
+connect_changed(on_product_changed, Product)
@@ -0,0 +1,153 @@
+"""Billing summary of a subscription purchase, for customer-facing pages.
+
+A page showing the state of a subscription needs the purchase, its item and subscription item,
+the product, the processor and the payment. :func:`billing_summary` reads all of them in one query
+into an immutable :class:`BillingSummary`.
+
+Summaries are cached by the PK and :attr:`~debits.debits_base.models.SubscriptionPurchase.version`
+of the purchase, which is incremented on every change of it, so a cached summary is never stale
+for a known version. Changes of the item or the product (for example, the price) are seen after
+`settings.PAYMENTS_SUMMARY_CACHE_TIMEOUT` seconds (300 by default)."""
+
+import datetime
+from collections import namedtuple
+
+from django.conf import settings
+
+from debits.debits_base.base import get_cache
+from debits.debits_base.models import SubscriptionPurchase, SubscriptionStatus
+
+SUMMARY_CACHE_VERSION = 2
+"""Increase it when the format of cached summaries changes."""
+
+PeriodValue = namedtuple('PeriodValue', ('unit', 'count'))
+"""A period of :class:`BillingSummary` (can be passed to :func:`~debits.debits_base.base.period_to_string`
+and :func:`~debits.debits_base.base.period_to_delta`)."""
+
+SUMMARY_FIELDS = (
+    ('purchase_id', 'pk'),
+    ('version', 'version'),
+    ('stored_status', 'status'),
+    ('blocked', 'blocked'),
+    ('gratis', 'gratis'),
+    ('trial', 'trial'),
+    ('due_payment_date', 'due_payment_date'),
+    ('payment_deadline', 'payment_deadline'),
+    ('subscription_reference', 'subscription_reference'),
+    ('subinvoice', 'subinvoice'),
+    ('item_id', 'item_id'),
+    ('product', 'item__product__name'),
+    ('price', 'item__price'),
+    ('currency', 'item__currency'),
+    ('shipping', 'shipping'),
+    ('tax', 'tax'),
+    ('payment_period_unit', 'item__subscriptionitem__payment_period_unit'),
+    ('payment_period_count', 'item__subscriptionitem__payment_period_count'),
+    ('trial_period_unit', 'item__subscriptionitem__trial_period_unit'),
+    ('trial_period_count', 'item__subscriptionitem__trial_period_count'),
+    ('grace_period_unit', 'item__subscriptionitem__grace_period_unit'),
+    ('grace_period_count', 'item__subscriptionitem__grace_period_count'),
+    ('processor', 'processor__name'),
+    ('email', 'email'),
+    ('payment_email', 'payment__email'),
+)
+"""Internal.
+
+Pairs (column name, lookup from :class:`~debits.debits_base.models.SubscriptionPurchase`)."""
+
+
+class BillingSummary(object):
+    """The state of a subscription purchase. Create it by :func:`billing_summary`.
+
+    It cannot be modified."""
+
+    __slots__ = ('purchase_id', 'version', 'stored_status', 'blocked', 'gratis', 'trial', 'subscribed',
+                 'subscription_reference', 'subinvoice', 'due_payment_date', 'payment_deadline',
+                 'item_id', 'product', 'price', 'currency', 'shipping', 'tax',
+                 'payment_period', 'trial_period', 'grace_period', 'processor', 'email')
+
+    def __init__(self, **kwargs):
+        """Internal."""
+        for name in BillingSummary.__slots__:
+            object.__setattr__(self, name, kwargs[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("BillingSummary is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("BillingSummary is immutable")
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in BillingSummary.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(BillingSummary.__slots__, state):
+            object.__setattr__(self, name, value)
+
+    def __repr__(self):
+        return "<BillingSummary pk=%d version=%d %s>" % (self.purchase_id, self.version, self.status_name)
+
+    @property
+    def status(self):
+        """:class:`~debits.debits_base.models.SubscriptionStatus` (for today, not for the day of caching).
+
+        See :meth:`~debits.debits_base.models.SubscriptionPurchase.compute_status`."""
+        if self.stored_status == SubscriptionStatus.CANCELED and not self.subscribed:
+            return SubscriptionStatus.CANCELED
+        return SubscriptionStatus.derive(self.blocked, self.gratis, self.trial,
+                                         self.due_payment_date, self.payment_deadline)
+
+    @property
+    def status_name(self):
+        """:attr:`status` as a string (like ``'active'``)."""
+        return SubscriptionStatus.names[self.status]
+
+    @property
+    def is_active(self):
+        """The same as :meth:`~debits.debits_base.models.SubscriptionPurchase.is_active`
+        (a canceled subscription is active till its payment deadline)."""
+        prior = self.payment_deadline is not None and datetime.date.today() <= self.payment_deadline
+        return (prior or self.gratis) and not self.blocked
+
+    @staticmethod
+    def from_row(row):
+        """Internal."""
+        values = dict(zip([column for column, lookup in SUMMARY_FIELDS], row))
+        for period in ('payment_period', 'trial_period', 'grace_period'):
+            values[period] = PeriodValue(values.pop(period + '_unit'), values.pop(period + '_count'))
+        payment_email = values.pop('payment_email')
+        values['email'] = values['email'] or payment_email
+        values['subscribed'] = bool(values['subscription_reference'])
+        return BillingSummary(**values)
+
+
+def summary_cache_key(purchase_id, version):
+    """Internal."""
+    return 'debits.summary:%d:%d:%d' % (SUMMARY_CACHE_VERSION, purchase_id, version)
+
+
+def cache_timeout():
+    """Internal."""
+    return getattr(settings, 'PAYMENTS_SUMMARY_CACHE_TIMEOUT', 300)
+
+
+def billing_summary(purchase_id, version=None):
+    """The :class:`BillingSummary` of a subscription purchase.
+
+    Args:
+        purchase_id: the PK of :class:`~debits.debits_base.models.SubscriptionPurchase`.
+        version: the current :attr:`~debits.debits_base.models.SubscriptionPurchase.version` of the purchase
+            (for example, of an already loaded purchase) or `None`. If it is given, the summary
+            may be taken from the cache without any query.
+
+    Raises `SubscriptionPurchase.DoesNotExist` if there is no such purchase."""
+    cache = get_cache()
+    if version is not None:
+        summary = cache.get(summary_cache_key(purchase_id, version))
+        if summary is not None:
+            return summary
+    row = SubscriptionPurchase.objects.filter(pk=purchase_id).\
+        values_list(*[lookup for column, lookup in SUMMARY_FIELDS]).get()
+    summary = BillingSummary.from_row(row)
+    cache.set(summary_cache_key(purchase_id, summary.version), summary, cache_timeout())
+    return summary
@@ -0,0 +1,67 @@
+from django.core.exceptions import PermissionDenied
+from django.http import StreamingHttpResponse, HttpResponseBadRequest, JsonResponse
+from django.utils.dateparse import parse_date
+
+from debits.debits_base.export import export_rows, month_range, FORMATS
+from debits.debits_base.history import payment_history, transaction_history, purchase_history
+
+
+def export_payments_view(request):
+    """Streams the payments export (see :mod:`debits.debits_base.export`) to a staff user.
+
+    GET parameters: `format` (``csv`` or ``jsonl``), and `month` (``YYYY-MM``)
+    or `since` and `until` (``YYYY-MM-DD``)."""
+    if not request.user.is_staff:
+        raise PermissionDenied
+    format = request.GET.get('format', 'csv')
+    if format not in FORMATS:
+        return HttpResponseBadRequest("Wrong format")
+    try:
+        if 'month' in request.GET:
+            since, until = month_range(request.GET['month'])
+        else:
+            since = parse_date(request.GET['since']) if 'since' in request.GET else None
+            until = parse_date(request.GET['until']) if 'until' in request.GET else None
+    except ValueError:
+        return HttpResponseBadRequest("Wrong date")
+    lines, content_type = FORMATS[format]
+    response = StreamingHttpResponse(lines(export_rows(since, until)), content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="payments.%s"' % format
+    return response
+
+
+def history_view(request, history, **kwargs):
+    """Internal.
+
+    Common code of the history views."""
+    if not request.user.is_staff:
+        raise PermissionDenied
+    try:
+        if 'purchase' in request.GET:
+            kwargs['purchase_ids'] = [int(pk) for pk in request.GET.getlist('purchase')]
+        page = history(cursor=request.GET.get('cursor'), limit=int(request.GET.get('limit', 50)), **kwargs)
+    except ValueError:
+        return HttpResponseBadRequest("Wrong parameters")
+    return JsonResponse({'rows': page.rows, 'next_cursor': page.next_cursor})
+
+
+def payment_history_view(request):
+    """Returns a page of :func:`~debits.debits_base.history.payment_history` as JSON to a staff user.
+
+    GET parameters: `purchase` (may be repeated), `email`, `cursor` (`next_cursor` of the previous page)
+    and `limit`."""
+    return history_view(request, payment_history, email=request.GET.get('email'))
+
+
+def transaction_history_view(request):
+    """Returns a page of :func:`~debits.debits_base.history.transaction_history` as JSON to a staff user.
+
+    GET parameters: `purchase` (may be repeated), `cursor` and `limit`."""
+    return history_view(request, transaction_history)
+
+
+def purchase_history_view(request):
+    """Returns a page of :func:`~debits.debits_base.history.purchase_history` as JSON to a staff user.
+
+    GET parameters: `purchase` (may be repeated), `cursor` and `limit`."""
+    return history_view(request, purchase_history)
@@ -0,0 +1,153 @@
+"""Running the reminder, expiry and cancel jobs in several processes and on several nodes.
+
+Purchases are partitioned into `settings.PAYMENTS_WORKER_SHARDS` (16 by default) shards by the PK
+(`pk % shards`). This number must be the same on all nodes (and should be not less than the number
+of processes of all nodes together). The node `node` of `nodes` runs the shards `node`, `node + nodes`, ...,
+dividing them among its processes, so that the shards of nodes never overlap and cover all purchases
+however many processes every node has. Shards claim purchases by `SELECT ... FOR UPDATE SKIP LOCKED`,
+so even if nodes are misconfigured, no purchase is processed twice."""
+
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import django
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, close_old_connections
+from django.utils.module_loading import import_string
+
+from debits.debits_base.models import SubscriptionPurchase
+
+
+def send_reminders(shard, shards, stop=None, **kwargs):
+    """Internal."""
+    return SubscriptionPurchase.send_reminders(shard=shard, shards=shards, stop=stop, **kwargs)
+
+
+def expire(shard, shards, stop=None, **kwargs):
+    """Internal."""
+    callback_path = getattr(settings, 'PAYMENTS_CALLBACK', None)
+    callback = import_string(callback_path)() if callback_path else None
+    return SubscriptionPurchase.sweep_expired(callback, shard=shard, shards=shards, stop=stop, **kwargs)
+
+
+def cancel_subscriptions(shard, shards, stop=None, **kwargs):
+    """Internal."""
+    return SubscriptionPurchase.process_cancel_requests(shard=shard, shards=shards, stop=stop, **kwargs)
+
+
+JOBS = {
+    'reminders': send_reminders,
+    'expiry': expire,
+    'cancels': cancel_subscriptions,
+}
+"""Shardable jobs: name -> function(shard, shards, stop, **kwargs) returning the number of processed purchases
+(`kwargs` are options of the job, like `batch_size`)."""
+
+process_stop = None
+"""Internal.
+
+The stop event of a worker process."""
+
+
+def init_process(stop=None):
+    """Internal.
+
+    Initializes a worker process."""
+    global process_stop
+    process_stop = stop
+    if not apps.ready:  # a spawned (not forked) process
+        django.setup()
+
+
+def worker_shards():
+    """Internal.
+
+    The number of shards of all nodes (see the module docs)."""
+    return getattr(settings, 'PAYMENTS_WORKER_SHARDS', 16)
+
+
+def assign_shards(node, nodes, shards, processes):
+    """Internal.
+
+    Divides the shards of the node `node` of `nodes` among at most `processes` processes.
+
+    Returns:
+        A non-empty list of lists of shards for every process."""
+    own = list(range(node, shards, nodes))
+    processes = max(1, min(processes, len(own)))
+    return [own[i::processes] for i in range(processes)]
+
+
+def run_shards(job, shards, own, stop=None, **kwargs):
+    """Internal.
+
+    Runs a job for the shards `own` of `shards`."""
+    if len(own) == shards:  # all purchases, don't filter them by the shard
+        return JOBS[job](0, 1, stop, **kwargs)
+    return sum(JOBS[job](shard, shards, stop, **kwargs) for shard in own)
+
+
+def run_process(job, shards, own, **kwargs):
+    """Internal.
+
+    Runs a job for the shards `own` of `shards` in a worker process."""
+    close_old_connections()
+    try:
+        return run_shards(job, shards, own, process_stop, **kwargs)
+    finally:
+        connections.close_all()
+
+
+def relay_stop(stop, shared_stop, done):
+    """Internal.
+
+    Sets the event of worker processes `shared_stop` when `stop` is set (until `done` is set)."""
+    while not done.is_set():
+        if stop.wait(1):
+            shared_stop.set()
+            return
+
+
+def run_sharded(job, node=0, nodes=1, processes=None, stop=None, **kwargs):
+    """Runs a job of :data:`JOBS` for the shards of the node `node` of `nodes` in several processes
+    (see the module docs).
+
+    Args:
+        job: the name of the job.
+        node: the number of this node (from 0).
+        nodes: the number of nodes.
+        processes: the number of processes (by default, `settings.PAYMENTS_WORKER_PROCESSES` or 1;
+            0 means the number of CPUs).
+        stop: :class:`threading.Event` stopping the job (in all processes) after the current batch
+            when it is set, or `None`.
+        kwargs: options of the job, like `batch_size`.
+
+    Returns:
+        The number of processed purchases."""
+    shards = worker_shards()
+    if nodes > shards:
+        raise ImproperlyConfigured("PAYMENTS_WORKER_SHARDS is less than the number of nodes")
+    if processes is None:
+        processes = getattr(settings, 'PAYMENTS_WORKER_PROCESSES', 1)
+    if processes == 0:
+        processes = multiprocessing.cpu_count()
+    parts = assign_shards(node, nodes, shards, processes)
+    if len(parts) == 1:
+        return run_shards(job, shards, parts[0], stop, **kwargs)
+    connections.close_all()  # not to share connections with forked processes
+    start_method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+    context = multiprocessing.get_context(start_method)
+    shared_stop = context.Event()
+    done = threading.Event()
+    if stop is not None:
+        threading.Thread(target=relay_stop, args=(stop, shared_stop, done), daemon=True).start()
+    try:
+        with ProcessPoolExecutor(len(parts), mp_context=context,
+                                 initializer=init_process, initargs=(shared_stop,)) as pool:
+            return sum(pool.map(partial(run_process, job, shards, **kwargs), parts))
+    finally:
+        done.set()
@@ -1,5 +1,6 @@
 from debits.debits_base.models import AutomaticPayment
-from debits.paypal.views import PayPalIPN
+from debits.paypal.views import PayPalIPN, AsyncPayPalIPN
+from debits.paypal.webhooks import PayPalWebhook
 
 
 class MyPayPalIPN(PayPalIPN):
@@ -23,3 +24,13 @@ class MyPayPalIPN(PayPalIPN):
         if organization is not None:
             organization.purchase = purchase.subscriptionpurchase.mypurchase
             organization.save()
+
+
+class MyAsyncPayPalIPN(AsyncPayPalIPN, MyPayPalIPN):
+    """:class:`MyPayPalIPN` for ASGI."""
+    pass
+
+
+class MyPayPalWebhook(PayPalWebhook, MyPayPalIPN):
+    """:class:`MyPayPalIPN` for PayPal REST webhooks."""
+    pass
@@ -5,6 +5,8 @@ from debits.debits_base.models import ProlongPurchase
 class MyPayPalForm(PayPalForm):
     """A mixin result."""
 
+    item_cache_timeout = 0  # every purchase has its own item (see business.create_organization())
+
     def __init__(self, request):
         self.request = request
 
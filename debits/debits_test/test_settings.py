@@ -82,6 +82,8 @@ PAYMENTS_DAYS_BEFORE_TRIAL_END_REMIND = 10
 #PAYPAL_SECRET = 'XXX'
 PAYPAL_DEBUG = True
 PAYMENTS_REALM = 'testapp1'
+PAYMENTS_CALLBACK = 'debits.debits_test.callbacks.MyPayPalIPN'
+PAYMENTS_LAZY_TRANSACTIONS = True
 
 try:
     from .local_settings import *
@@ -0,0 +1,110 @@
+"""Common code of the tests."""
+
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.http import QueryDict
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from debits.debits_base.base import get_cache
+from debits.debits_base.models import SubscriptionPurchase, SubscriptionTransaction, processor_registry
+from debits.debits_test.business import create_organization
+from debits.debits_test.callbacks import MyPayPalIPN
+from debits.debits_test.processors import MyPayPalForm
+
+PAYPAL_EMAIL = 'seller@example.com'
+
+
+SETTINGS = dict(PAYMENTS_HOST='http://localhost', IPN_HOST='http://localhost', FROM_EMAIL='debits@example.com',
+                PAYPAL_EMAIL=PAYPAL_EMAIL, PAYPAL_ID='SELLER', PAYMENTS_LAZY_TRANSACTIONS=False,
+                PAYMENTS_CALLBACK=None)
+
+
+class DebitsTestMixin(object):
+    """The payment processors, the example products and pricing plans and the helpers of the tests."""
+    fixtures = ['processors', 'products', 'pricingplans']
+
+    def setUp(self):
+        super().setUp()
+        get_cache().clear()  # PKs are reused by the tests, so cached objects would be stale
+        processor_registry.forget()  # may have processors of previous tests
+
+    @staticmethod
+    def create_purchase(name='org', trial_months=0):
+        """A new :class:`~debits.debits_test.models.MyPurchase` (of an organization)."""
+        return create_organization(name, 1, trial_months).purchase
+
+    @staticmethod
+    def checkout(purchase):
+        """Creates the transaction of the PayPal form and returns the form fields."""
+        transaction = SubscriptionTransaction.for_checkout(processor_id=2, purchase=purchase)
+        return MyPayPalForm(None).amend_hash_new_purchase(transaction, {})
+
+    @staticmethod
+    def ipn(fields, handler=None):
+        """Processes a verified IPN."""
+        POST = QueryDict(mutable=True)
+        POST.update(fields)
+        (handler or MyPayPalIPN()).verified_post(POST, None)
+
+    def subscribe(self, purchase, subscr_id='I-1', email='payer@example.com'):
+        """Sends the signup and the first payment IPNs for a purchase.
+
+        Returns:
+            The base fields of the IPNs (for sending more of them) and the reloaded purchase."""
+        form = self.checkout(purchase)
+        base = {'custom': form['custom'], 'invoice': form['invoice'], 'payer_email': email, 'subscr_id': subscr_id,
+                'mc_currency': purchase.item.currency}
+        self.ipn(dict(base, txn_type='subscr_signup', amount3=str(purchase.item.price), period3='1 M'))
+        self.ipn(dict(base, txn_type='subscr_payment', payment_status='Completed', mc_gross=str(purchase.item.price)))
+        return base, SubscriptionPurchase.objects.get(pk=purchase.pk)
+
+
+@override_settings(**SETTINGS)
+class DebitsTestCase(DebitsTestMixin, TestCase):
+    """A test with the payment processors, the example products and pricing plans."""
+    pass
+
+
+@override_settings(**SETTINGS)
+class DebitsTransactionTestCase(DebitsTestMixin, TransactionTestCase):
+    """Like :class:`DebitsTestCase`, but the data is committed (to be seen by other threads)."""
+    pass
+
+
+class MigrationTestCase(TransactionTestCase):
+    """A test of a data migration of `debits_base`.
+
+    The DB is migrated to :attr:`migrate_from`, :meth:`create_data` creates objects by
+    the historical models and then the DB is migrated to :attr:`migrate_to`."""
+    migrate_from = None
+    migrate_to = None
+
+    def setUp(self):
+        self.migrate([('debits_base', self.migrate_from)])
+        self.create_data(self.apps)
+        self.migrate([('debits_base', self.migrate_to)])
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        self.migrate(executor.loader.graph.leaf_nodes())
+
+    def migrate(self, targets):
+        """Internal."""
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        executor.loader.build_graph()
+        self.apps = executor.loader.project_state(targets).apps
+
+    def create_data(self, apps):
+        """Creates the objects to migrate."""
+        pass
+
+    @staticmethod
+    def create_purchase(apps, **kwargs):
+        """A subscription purchase created by the historical models."""
+        Product = apps.get_model('debits_base', 'Product')
+        SubscriptionItem = apps.get_model('debits_base', 'SubscriptionItem')
+        SubscriptionPurchase = apps.get_model('debits_base', 'SubscriptionPurchase')
+        product = Product.objects.create(name="Product")
+        item = SubscriptionItem.objects.create(product=product, price=10)
+        return SubscriptionPurchase.objects.create(item=item, **kwargs)
@@ -0,0 +1,114 @@
+import datetime
+from unittest import mock
+
+from django.contrib import admin
+from django.contrib.admin.filters import ChoicesFieldListFilter
+from django.contrib.auth.models import User
+from django.db.models import Sum
+from django.test import RequestFactory
+from django.utils import timezone
+
+from debits.debits_base.admin import SubscriptionPurchaseAdmin, PaymentAdmin
+from debits.debits_base.base import logger
+from debits.debits_base.models import SubscriptionPurchase, SubscriptionStatus, CannotCancelSubscription, Payment, \
+    DailyRollup
+from debits.debits_test.tests.base import DebitsTestCase
+
+
+class SubscriptionPurchaseAdminTest(DebitsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.admin = SubscriptionPurchaseAdmin(SubscriptionPurchase, admin.site)
+        self.request = RequestFactory().get('/')
+        self.request.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+
+    def run_action(self, action, *purchases):
+        with mock.patch.object(SubscriptionPurchaseAdmin, 'message_user'):
+            getattr(self.admin, action)(self.request, SubscriptionPurchase.objects.filter(
+                pk__in=[purchase.pk for purchase in purchases]))
+
+    def reload(self, purchase):
+        return SubscriptionPurchase.objects.get(pk=purchase.pk)
+
+    def test_status_filter_has_choices(self):
+        changelist = self.admin.get_changelist_instance(self.request)
+        self.assertIsInstance(changelist.filter_specs[0], ChoicesFieldListFilter)
+
+    def test_block_and_unblock(self):
+        paid = self.subscribe(self.create_purchase('paid'))[1]
+        unpaid = self.reload(self.create_purchase('unpaid'))
+        self.run_action('block', paid, unpaid)
+        for purchase in (paid, unpaid):
+            loaded = self.reload(purchase)
+            self.assertEqual(loaded.status, SubscriptionStatus.BLOCKED)
+            self.assertEqual(loaded.version, purchase.version + 1)
+        self.run_action('unblock', paid, unpaid)
+        for purchase in (paid, unpaid):
+            loaded = self.reload(purchase)
+            self.assertFalse(loaded.blocked)
+            self.assertEqual(loaded.status, loaded.compute_status())
+        self.assertEqual(self.reload(paid).status, SubscriptionStatus.ACTIVE)
+
+    def test_make_gratis(self):
+        purchase = self.reload(self.create_purchase())
+        self.run_action('make_gratis', purchase)
+        self.assertEqual(self.reload(purchase).status, SubscriptionStatus.GRATIS)
+
+    def test_statuses_like_compute_status(self):
+        today = datetime.date.today()
+        cases = [
+            dict(trial=True, due_payment_date=today, payment_deadline=today),
+            dict(due_payment_date=today - datetime.timedelta(1), payment_deadline=today),
+            dict(due_payment_date=today, payment_deadline=today - datetime.timedelta(1)),
+            dict(due_payment_date=today, payment_deadline=None),
+            dict(status=SubscriptionStatus.CANCELED, payment_deadline=today),
+        ]
+        for fields in cases:
+            with self.subTest(fields):
+                purchase = self.create_purchase()
+                SubscriptionPurchase.objects.filter(pk=purchase.pk).update(**fields)
+                SubscriptionPurchase.update_statuses([purchase.pk])
+                loaded = self.reload(purchase)
+                self.assertEqual(loaded.status, loaded.compute_status())
+
+    def test_cancel_is_queued(self):
+        purchase = self.subscribe(self.create_purchase())[1]
+        with mock.patch.object(SubscriptionPurchase, 'force_cancel') as force_cancel:
+            self.run_action('cancel', purchase)
+            force_cancel.assert_not_called()
+            self.assertIsNotNone(self.reload(purchase).cancel_requested_at)
+            self.assertEqual(SubscriptionPurchase.process_cancel_requests(), 1)
+            force_cancel.assert_called_once_with()
+        self.assertIsNone(self.reload(purchase).cancel_requested_at)
+
+    def test_failed_cancel_is_retried(self):
+        purchase = self.subscribe(self.create_purchase())[1]
+        SubscriptionPurchase.request_cancels(SubscriptionPurchase.objects.filter(pk=purchase.pk))
+        with mock.patch.object(SubscriptionPurchase, 'force_cancel', side_effect=IOError), \
+                self.assertLogs(logger, 'ERROR'):
+            self.assertEqual(SubscriptionPurchase.process_cancel_requests(), 0)
+        self.assertGreater(self.reload(purchase).cancel_requested_at, timezone.now())
+        with mock.patch.object(SubscriptionPurchase, 'force_cancel', side_effect=CannotCancelSubscription):
+            self.assertEqual(SubscriptionPurchase.process_cancel_requests(), 0)  # not due yet
+            SubscriptionPurchase.objects.filter(pk=purchase.pk).update(cancel_requested_at=timezone.now())
+            self.assertEqual(SubscriptionPurchase.process_cancel_requests(), 1)  # given up
+        self.assertIsNone(self.reload(purchase).cancel_requested_at)
+
+
+class PaymentAdminTest(DebitsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.admin = PaymentAdmin(Payment, admin.site)
+        self.request = RequestFactory().get('/')
+
+    def test_refund_recorded_once(self):
+        purchase = self.subscribe(self.create_purchase())[1]
+        payment = Payment.objects.get(transaction_purchase=purchase)
+        with mock.patch.object(PaymentAdmin, 'message_user') as message_user:
+            for i in range(2):
+                self.admin.mark_refunded(self.request, Payment.objects.filter(pk=payment.pk))
+        self.assertEqual([str(call.args[1]) for call in message_user.call_args_list],
+                         ["1 refund(s) recorded.", "0 refund(s) recorded."])
+        self.assertTrue(Payment.objects.get(pk=payment.pk).refunded)
+        self.assertFalse(payment.refund_payment())  # for example, notified by the processor afterwards
+        self.assertEqual(DailyRollup.objects.aggregate(refunds=Sum('refunds'))['refunds'], 1)
@@ -0,0 +1,99 @@
+import datetime
+import io
+
+from django.utils import timezone
+
+from debits.debits_base.archive import archive_unpaid_transactions, archive_superseded_purchases, restore
+from debits.debits_base.models import BaseTransaction, Payment, Purchase, PurchaseLineage, SubscriptionPurchase, \
+    SubscriptionTransaction
+from debits.debits_test.models import MyPurchase, Organization, PricingPlan
+from debits.debits_test.tests.base import DebitsTestCase
+
+
+class ArchiveTest(DebitsTestCase):
+    def old_transaction(self, purchase):
+        transaction = SubscriptionTransaction.for_checkout(processor_id=2, purchase=purchase)
+        transaction.save()
+        BaseTransaction.objects.filter(pk=transaction.pk).\
+            update(creation_date=timezone.now() - datetime.timedelta(days=100))
+        return transaction
+
+    def archive(self):
+        out = io.StringIO()
+        count = archive_unpaid_transactions(out, 90)
+        return count, out.getvalue()
+
+    def test_unpaid_transaction_is_archived_and_restored(self):
+        transaction = self.old_transaction(self.create_purchase())
+        count, archived = self.archive()
+        self.assertEqual(count, 1)
+        self.assertFalse(BaseTransaction.objects.filter(pk=transaction.pk).exists())
+        self.assertEqual(restore(io.StringIO(archived)), (1, 0))
+        restored = SubscriptionTransaction.objects.get(pk=transaction.pk)
+        self.assertEqual(restored.invoice, transaction.invoice)
+
+    def test_restore_does_not_overwrite(self):
+        transaction = self.old_transaction(self.create_purchase())
+        count, archived = self.archive()
+        restore(io.StringIO(archived))
+        BaseTransaction.objects.filter(pk=transaction.pk).update(processor_id=1)
+        self.assertEqual(restore(io.StringIO(archived)), (0, 1))
+        self.assertEqual(BaseTransaction.objects.get(pk=transaction.pk).processor_id, 1)
+
+    def test_subscribed_purchase_is_kept(self):
+        purchase = self.create_purchase()
+        transaction = self.old_transaction(purchase)
+        SubscriptionPurchase.objects.filter(pk=purchase.pk).update(subscription_reference='I-1')
+        self.assertEqual(self.archive()[0], 0)
+        self.assertTrue(BaseTransaction.objects.filter(pk=transaction.pk).exists())
+
+    def test_trial_purchase_is_kept(self):
+        transaction = self.old_transaction(self.create_purchase(trial_months=1))
+        self.assertEqual(self.archive()[0], 0)
+        self.assertTrue(BaseTransaction.objects.filter(pk=transaction.pk).exists())
+
+
+class ArchiveSupersededTest(DebitsTestCase):
+    def upgrade(self, old, subscr_id, cancel=True):
+        """Upgrades the purchase of an organization."""
+        new = MyPurchase.objects.create(item=old.item, plan=PricingPlan.objects.get(pk=2), old_subscription=old)
+        Organization.objects.filter(purchase=old).update(purchase=new)
+        new = self.subscribe(new, subscr_id=subscr_id)[1]
+        if cancel:  # as done after the commit
+            SubscriptionPurchase.objects.filter(pk=old.pk).update(subscription_reference=None)
+        return new
+
+    def make_old(self, *purchases):
+        Purchase.objects.filter(pk__in=[p.pk for p in purchases]).\
+            update(creation_date=timezone.now() - datetime.timedelta(days=100))
+
+    def archive(self):
+        out = io.StringIO()
+        count = archive_superseded_purchases(out, 90)
+        return count, out.getvalue()
+
+    def test_chain(self):
+        first = self.subscribe(self.create_purchase('first'), subscr_id='I-1')[1]
+        second = self.upgrade(first, 'I-2')
+        third = self.upgrade(second, 'I-3')
+        self.make_old(first, second, third)
+        payments = list(Payment.objects.filter(transaction__purchase=first).values_list('pk', flat=True))
+        count, archived = self.archive()
+        self.assertEqual(count, 2)
+        self.assertEqual(set(Purchase.objects.values_list('pk', flat=True)), {third.pk})
+        self.assertFalse(Payment.objects.filter(pk__in=payments).exists())
+        self.assertEqual(PurchaseLineage.current_by_reference('I-3'), third.pk)
+        self.assertEqual(PurchaseLineage.objects.get(purchase=third).root_id, third.pk)
+        self.assertEqual(restore(io.StringIO(archived)), (2, 0))
+        self.assertTrue(Payment.objects.filter(pk__in=payments).exists())
+        self.assertEqual(PurchaseLineage.current(first.pk), third.pk)
+
+    def test_kept(self):
+        first = self.subscribe(self.create_purchase('first'), subscr_id='I-1')[1]
+        second = self.upgrade(first, 'I-2', cancel=False)
+        self.make_old(first, second)
+        self.assertEqual(self.archive()[0], 0)
+        SubscriptionPurchase.objects.filter(pk=first.pk).update(subscription_reference=None)
+        Purchase.objects.filter(pk=first.pk).update(creation_date=timezone.now())  # recent
+        self.assertEqual(self.archive()[0], 0)
+        self.assertTrue(Purchase.objects.filter(pk=first.pk).exists())
@@ -0,0 +1,71 @@
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.test import override_settings
+
+from debits.debits_base.models import SubscriptionPurchase, CannotCancelSubscription, processor_registry
+from debits.paypal.models import AsyncPayPalAPI
+from debits.debits_test.tests.base import DebitsTestCase
+
+
+class AsyncPurchaseTest(DebitsTestCase):
+    def test_quick_is_active(self):
+        inactive = self.create_purchase()
+        base, active = self.subscribe(self.create_purchase('other'))
+        for purchase in (inactive, active):
+            self.assertEqual(async_to_sync(SubscriptionPurchase.aquick_is_active)(purchase.pk),
+                             SubscriptionPurchase.quick_is_active(purchase.pk))
+        self.assertTrue(async_to_sync(active.ais_active)())
+
+    def test_force_cancel(self):
+        base, purchase = self.subscribe(self.create_purchase())
+        api = mock.Mock()
+        api.cancel_agreement = mock.AsyncMock()
+        with mock.patch.object(processor_registry, 'async_api', mock.AsyncMock(return_value=api)):
+            async_to_sync(purchase.aforce_cancel)(is_upgrade=True)
+        api.cancel_agreement.assert_awaited_once_with('I-1', is_upgrade=True)
+
+    def test_force_cancel_fallback(self):
+        base, purchase = self.subscribe(self.create_purchase())
+        api = mock.Mock()
+        api.cancel_agreement = mock.AsyncMock(side_effect=CannotCancelSubscription("gone"))
+        with mock.patch.object(processor_registry, 'async_api', mock.AsyncMock(return_value=api)):
+            with self.assertRaises(CannotCancelSubscription), self.assertLogs('debits', 'WARNING'):
+                async_to_sync(purchase.aforce_cancel)()
+        self.assertIsNone(SubscriptionPurchase.objects.get(pk=purchase.pk).subscription_reference)
+
+
+@override_settings(PAYPAL_DEBUG=True)
+class AsyncPayPalAPITest(DebitsTestCase):
+    def call(self, method, *args, status_code=204, body=None):
+        """Calls a method of :class:`AsyncPayPalAPI`, PayPal answering `status_code` and `body`."""
+        client = mock.Mock()
+        client.post = mock.AsyncMock(return_value=mock.Mock(status_code=status_code,
+                                                            json=mock.Mock(return_value=body)))
+        api = AsyncPayPalAPI('https://api.sandbox.paypal.com', 'TOKEN')
+        with mock.patch('debits.paypal.models.http_client', return_value=client):
+            async_to_sync(getattr(api, method))(*args)
+        return client.post
+
+    def test_cancel_agreement(self):
+        post = self.call('cancel_agreement', 'I-1')
+        self.assertEqual(post.await_args.args[0],
+                         'https://api.sandbox.paypal.com/v1/payments/billing-agreements/I-1/cancel')
+        self.assertEqual(post.await_args.kwargs['headers']['Authorization'], 'Bearer TOKEN')
+
+    def test_cancel_agreement_failed(self):
+        with self.assertRaisesMessage(CannotCancelSubscription, "Not found"):
+            self.call('cancel_agreement', 'I-1', status_code=404, body={'message': "Not found"})
+
+    def test_refund(self):
+        post = self.call('refund', 'T-1', '10.00', 'EUR', status_code=201)
+        self.assertIn('"currency": "EUR"', post.await_args.kwargs['content'])
+
+    def test_create(self):
+        client = mock.Mock()
+        client.post = mock.AsyncMock(return_value=mock.Mock(json=mock.Mock(return_value={'access_token': 'T'})))
+        with mock.patch('debits.paypal.models.http_client', return_value=client), \
+                self.settings(PAYPAL_CLIENT_ID='ID', PAYPAL_SECRET='SECRET'):
+            api = async_to_sync(AsyncPayPalAPI.create)()
+        self.assertEqual(api.headers['Authorization'], 'Bearer T')
+        self.assertEqual(client.post.await_args.kwargs['auth'], ('ID', 'SECRET'))
@@ -0,0 +1,58 @@
+from unittest import mock
+from urllib.parse import urlencode
+
+from asgiref.sync import async_to_sync
+from django.test import override_settings
+from django.urls import reverse
+
+from debits.debits_base.models import SubscriptionPurchase
+from debits.paypal import views
+from debits.debits_test.tests.base import DebitsTransactionTestCase, PAYPAL_EMAIL
+
+
+class AsyncIPNTest(DebitsTransactionTestCase):
+    def request(self, method, *args, **kwargs):
+        """Sends a request by the :class:`~django.test.AsyncClient`."""
+        async def send():
+            return await getattr(self.async_client, method)(*args, **kwargs)
+        return async_to_sync(send)()
+
+    def post(self, fields, verified='VERIFIED'):
+        """Posts an IPN to the async view, PayPal answering `verified` to the postback."""
+        client = mock.Mock()
+        client.post = mock.AsyncMock(return_value=mock.Mock(text=verified))
+        with mock.patch('debits.paypal.views.http_client', return_value=client):
+            response = self.request(
+                'post', reverse('paypal-ipn-async'), urlencode(dict(fields, receiver_email=PAYPAL_EMAIL, charset='utf-8')),
+                content_type='application/x-www-form-urlencoded')
+        self.assertEqual(response.status_code, 200)
+        return client.post
+
+    def test_signup(self):
+        purchase = self.create_purchase()
+        form = self.checkout(purchase)
+        postback = self.post({'txn_type': 'subscr_signup', 'custom': form['custom'], 'invoice': form['invoice'],
+                              'subscr_id': 'I-1', 'payer_email': 'payer@example.com',
+                              'mc_currency': purchase.item.currency, 'amount3': str(purchase.item.price),
+                              'period3': '1 M'})
+        self.assertTrue(postback.await_args.kwargs['content'].startswith('cmd=_notify-validate&'))
+        self.assertEqual(SubscriptionPurchase.objects.get(pk=purchase.pk).subscription_reference, 'I-1')
+
+    def test_not_verified(self):
+        purchase = self.create_purchase()
+        form = self.checkout(purchase)
+        self.post({'txn_type': 'subscr_signup', 'custom': form['custom'], 'invoice': form['invoice'],
+                   'subscr_id': 'I-1'}, verified='INVALID')
+        self.assertIsNone(SubscriptionPurchase.objects.get(pk=purchase.pk).subscription_reference)
+
+    def test_get_not_allowed(self):
+        response = self.request('get', reverse('paypal-ipn-async'))
+        self.assertEqual(response.status_code, 405)
+
+    @override_settings(PAYMENTS_IPN_DB_THREADS=3)
+    def test_executor_created_on_first_use(self):
+        with mock.patch.object(views, '_ipn_executor', None):
+            executor = views.ipn_executor()
+            self.assertEqual(executor._max_workers, 3)
+            self.assertIs(views.ipn_executor(), executor)
+        executor.shutdown()
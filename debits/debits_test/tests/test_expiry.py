@@ -0,0 +1,58 @@
+import datetime
+import threading
+
+from debits.debits_base.models import SubscriptionPurchase, SubscriptionStatus
+from debits.debits_base.processors import PaymentCallback
+from debits.debits_test.tests.base import DebitsTestCase
+
+
+class RecordingCallback(PaymentCallback):
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.expired = []
+
+    def on_subscription_expired(self, purchases):
+        if self.fail:
+            raise RuntimeError("callback failed")
+        self.expired.extend(purchase.pk for purchase in purchases)
+
+
+class SweepExpiredTest(DebitsTestCase):
+    def expire(self, purchase):
+        purchase.set_payment_date(datetime.date.today() - datetime.timedelta(days=30))
+        purchase.save()
+
+    def test_sweep_marks_and_reports(self):
+        purchase = self.create_purchase()
+        self.expire(purchase)
+        callback = RecordingCallback()
+        self.assertEqual(SubscriptionPurchase.sweep_expired(callback), 1)
+        self.assertEqual(callback.expired, [purchase.pk])
+        purchase = SubscriptionPurchase.objects.get(pk=purchase.pk)
+        self.assertTrue(purchase.expired)
+        self.assertEqual(purchase.status, SubscriptionStatus.EXPIRED)
+        self.assertEqual(SubscriptionPurchase.sweep_expired(callback), 0)
+
+    def test_failed_callback_is_retried(self):
+        purchase = self.create_purchase()
+        self.expire(purchase)
+        with self.assertRaises(RuntimeError):
+            SubscriptionPurchase.sweep_expired(RecordingCallback(fail=True))
+        self.assertFalse(SubscriptionPurchase.objects.get(pk=purchase.pk).expired)
+
+    def test_stop(self):
+        purchase = self.create_purchase()
+        self.expire(purchase)
+        stop = threading.Event()
+        stop.set()
+        self.assertEqual(SubscriptionPurchase.sweep_expired(stop=stop), 0)
+        self.assertFalse(SubscriptionPurchase.objects.get(pk=purchase.pk).expired)
+        callback = RecordingCallback()
+        self.assertEqual(SubscriptionPurchase.sweep_expired(callback), 1)
+        self.assertEqual(callback.expired, [purchase.pk])
+
+    def test_gratis_is_skipped(self):
+        purchase = self.create_purchase()
+        purchase.gratis = True
+        self.expire(purchase)
+        self.assertEqual(SubscriptionPurchase.sweep_expired(), 0)
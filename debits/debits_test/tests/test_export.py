@@ -0,0 +1,63 @@
+import csv
+import datetime
+import gzip
+import json
+import os
+import tempfile
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.exceptions import PermissionDenied
+from django.core.management import call_command
+from django.test import RequestFactory
+
+from debits.debits_base.export import export_rows, csv_lines, jsonl_lines, COLUMNS
+from debits.debits_base.models import Payment
+from debits.debits_base.views import export_payments_view
+from debits.debits_test.tests.base import DebitsTestCase
+
+
+class ExportTest(DebitsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.purchases = [self.subscribe(self.create_purchase('org%d' % i), subscr_id='I-%d' % i)[1]
+                          for i in range(3)]
+
+    def test_rows(self):
+        rows = [dict(zip(COLUMNS, row)) for row in export_rows(chunk_size=2)]  # in several chunks
+        self.assertEqual([row['purchase_id'] for row in rows], [purchase.pk for purchase in self.purchases])
+        self.assertEqual([row['subscription_reference'] for row in rows], ['I-0', 'I-1', 'I-2'])
+        self.assertEqual(rows[0]['product'], self.purchases[0].item.product.name)
+
+    def test_dates(self):
+        today = datetime.date.today()
+        first = Payment.objects.order_by('pk')[0]
+        Payment.objects.filter(pk=first.pk).update(payment_time=first.payment_time - datetime.timedelta(days=40))
+        self.assertEqual(len(list(export_rows(since=today - datetime.timedelta(days=1)))), 2)
+        self.assertEqual(len(list(export_rows(until=today - datetime.timedelta(days=1)))), 1)
+
+    def test_formats(self):
+        lines = list(csv_lines(export_rows()))
+        self.assertEqual(next(csv.reader(lines[:1])), COLUMNS)
+        self.assertEqual(len(lines), 4)
+        records = [json.loads(line) for line in jsonl_lines(export_rows())]
+        self.assertEqual(records[2]['subscription_reference'], 'I-2')
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'payments.jsonl.gz')
+            call_command('debits_export', filename)
+            with gzip.open(filename, 'rt', encoding='utf-8') as file:
+                self.assertEqual(len(file.readlines()), 3)
+
+    def test_view(self):
+        request = RequestFactory().get('/export/payments', {'format': 'csv'})
+        request.user = AnonymousUser()
+        with self.assertRaises(PermissionDenied):
+            export_payments_view(request)
+        request.user = User(username='staff', is_staff=True)
+        response = export_payments_view(request)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 4)
+        request = RequestFactory().get('/export/payments', {'month': '2020-13'})
+        request.user = User(username='staff', is_staff=True)
+        self.assertEqual(export_payments_view(request).status_code, 400)
@@ -0,0 +1,36 @@
+from django.urls import reverse
+
+from debits.debits_base.history import payment_history
+from debits.debits_base.models import Payment
+from debits.debits_test.tests.base import DebitsTestCase
+
+
+class PaymentHistoryTest(DebitsTestCase):
+    def test_by_purchases(self):
+        first = self.subscribe(self.create_purchase('first'), subscr_id='I-1')[1]
+        self.subscribe(self.create_purchase('second'), subscr_id='I-2')
+        self.assertEqual(Payment.objects.filter(transaction_purchase=first).count(), 1)
+        page = payment_history(purchase_ids=[first.pk])
+        self.assertEqual([row['transaction__purchase_id'] for row in page.rows], [first.pk])
+        self.assertIsNone(page.next_cursor)
+
+    def test_pages(self):
+        first = self.subscribe(self.create_purchase('first'), subscr_id='I-1')[1]
+        second = self.subscribe(self.create_purchase('second'), subscr_id='I-2')[1]
+        self.subscribe(self.create_purchase('other'), subscr_id='I-3')
+        pages = [payment_history(purchase_ids=[first.pk, second.pk], limit=1)]
+        pages.append(payment_history(purchase_ids=[first.pk, second.pk], cursor=pages[0].next_cursor, limit=1))
+        self.assertEqual([row['transaction__purchase_id'] for page in pages for row in page.rows],
+                         [second.pk, first.pk])
+        self.assertIsNone(pages[1].next_cursor)
+
+
+class OrganizationsViewTest(DebitsTestCase):
+    def test_wrong_after(self):
+        self.assertEqual(self.client.get(reverse('list-organizations'), {'after': 'x'}).status_code, 400)
+
+    def test_after(self):
+        purchase = self.create_purchase()
+        response = self.client.get(reverse('list-organizations'), {'after': purchase.organization.pk - 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([o['id'] for o in response.context['organizations']], [purchase.organization.pk])
@@ -0,0 +1,98 @@
+import datetime
+
+from django.db import connection
+from django.db.models import CharField, Value
+from django.db.models.functions import Cast, Concat
+from django.utils import timezone
+
+from debits.debits_base.management.commands.debits_explain import hot_queries, explain, FULL_SCAN
+from debits.debits_base.models import Purchase, SubscriptionPurchase, BaseTransaction, Payment, AutomaticPayment, \
+    SubscriptionStatus, SubscriptionAction, SubscriptionTransaction
+from debits.debits_test.tests.base import DebitsTestCase
+
+ROWS = 20000
+"""The number of generated purchases (and about as many transactions and payments)."""
+
+DAYS = 200
+"""Over how many days the scheduled actions of the generated purchases are spread."""
+
+
+def insert_children(model, template, first_pk):
+    """Inserts rows of a multi-table inheritance child `model` for all rows of its parent table
+    with PK not less than `first_pk`, copying other columns from the `template` object."""
+    qn = connection.ops.quote_name
+    ptr = model._meta.pk.column
+    parent = model._meta.pk.remote_field.model._meta
+    columns = [field.column for field in model._meta.local_concrete_fields if field.column != ptr]
+    with connection.cursor() as cursor:
+        cursor.execute("INSERT INTO %s (%s) SELECT p.%s, %s FROM %s p, %s t WHERE t.%s = %%s AND p.%s >= %%s" % (
+            qn(model._meta.db_table), ', '.join(qn(column) for column in [ptr] + columns), qn(parent.pk.column),
+            ', '.join('t.' + qn(column) for column in columns), qn(parent.db_table), qn(model._meta.db_table),
+            qn(ptr), qn(parent.pk.column)), [template.pk, first_pk])
+
+
+def every(queryset, step, start=0):
+    """Every `step`-th object of a queryset."""
+    return queryset.filter(pk__in=list(queryset.values_list('pk', flat=True))[start::step])
+
+
+def unique_references(queryset):
+    """Sets a different `subscription_reference` for every object."""
+    queryset.update(subscription_reference=Concat(Value('I-'), Cast('pk', CharField())))
+
+
+class HotQueryPlansTest(DebitsTestCase):
+    """The queries of :func:`~debits.debits_base.management.commands.debits_explain.hot_queries` use indexes
+    on a big DB (with normal planner settings)."""
+
+    @classmethod
+    def setUpTestData(cls):
+        today = datetime.date.today()
+        now = timezone.now()
+        template = cls.create_purchase()
+        transaction = SubscriptionTransaction.objects.create(purchase=template, processor_id=2)
+        payment = AutomaticPayment.objects.create(transaction=transaction, processor_id=2, subscription_reference='I')
+
+        Purchase.objects.bulk_create([Purchase(item_id=template.item_id) for i in range(ROWS)], batch_size=1000)
+        first_purchase = Purchase.objects.filter(pk__gt=template.pk).order_by('pk').values_list('pk', flat=True)[0]
+        insert_children(SubscriptionPurchase, template, first_purchase)
+        purchases = SubscriptionPurchase.objects.filter(pk__gte=first_purchase)
+        unique_references(purchases)
+        actions = (SubscriptionAction.REMIND_BEFORE_DUE, SubscriptionAction.REMIND_DUE,
+                   SubscriptionAction.REMIND_DEADLINE, SubscriptionAction.EXPIRE)
+        for day in range(DAYS):  # two days (1%) are due
+            action_at = today + datetime.timedelta(day - 1)
+            every(purchases, DAYS, day).update(
+                next_action=actions[day % len(actions)], next_action_at=action_at, expired=False,
+                due_payment_date=action_at + datetime.timedelta(10), payment_deadline=action_at + datetime.timedelta(30),
+                status=SubscriptionStatus.GRACE if day % 20 == 0 else SubscriptionStatus.ACTIVE)
+        Purchase.objects.filter(pk__in=every(purchases, 50)).update(creation_date=now - datetime.timedelta(200))
+
+        purchase_pks = list(purchases.values_list('pk', flat=True))
+        BaseTransaction.objects.bulk_create([BaseTransaction(purchase_id=pk, processor_id=2, invoice='gen %d' % pk)
+                                             for pk in purchase_pks], batch_size=1000)
+        transactions = BaseTransaction.objects.filter(pk__gt=transaction.pk)
+        transaction_pks = list(transactions.values_list('pk', flat=True))
+        BaseTransaction.objects.filter(pk__in=transaction_pks[::100]).\
+            update(creation_date=now - datetime.timedelta(200))
+        paid = [row for i, row in enumerate(transactions.order_by('pk').values_list('pk', 'purchase_id')) if i % 10]
+        Payment.objects.bulk_create([Payment(transaction_id=pk, transaction_purchase_id=purchase_pk,
+                                             email='u%d@example.com' % pk) for pk, purchase_pk in paid],
+                                    batch_size=1000)
+        payments = Payment.objects.filter(pk__gt=payment.pk)
+        insert_children(AutomaticPayment, payment, payments.values_list('pk', flat=True).order_by('pk')[0])
+        unique_references(AutomaticPayment.objects.filter(pk__gt=payment.pk))
+        payments.update(payment_time=now - datetime.timedelta(30))
+        every(payments, 100).update(payment_time=now)
+
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def test_hot_queries_use_indexes(self):
+        if connection.vendor not in FULL_SCAN:
+            self.skipTest("Full scans are not detected for %s" % connection.vendor)
+        self.assertEqual(SubscriptionPurchase.objects.count(), ROWS + 1)
+        for name, queryset in hot_queries():
+            with self.subTest(name):
+                plan, tables = explain(queryset)
+                self.assertEqual(tables, [], "%s scans a table:\n%s" % (name, plan))
@@ -0,0 +1,99 @@
+from unittest import mock
+
+from debits.debits_base.locks import purchase_lock
+from debits.debits_base.models import BaseTransaction, Purchase, SubscriptionPurchase, AutomaticPayment
+from debits.debits_test.callbacks import MyPayPalIPN
+from debits.debits_test.tests.base import DebitsTestCase
+
+
+class SubscriptionIPNTest(DebitsTestCase):
+    def test_signup_and_payment(self):
+        base, purchase = self.subscribe(self.create_purchase())
+        self.assertEqual(purchase.subscription_reference, 'I-1')
+        self.assertTrue(purchase.is_active())
+        self.assertEqual(AutomaticPayment.objects.filter(transaction__purchase=purchase).count(), 1)
+
+    def test_cancel_by_invoice(self):
+        base, purchase = self.subscribe(self.create_purchase())
+        self.ipn({'txn_type': 'subscr_cancel', 'invoice': base['invoice'], 'subscr_id': 'I-1'})
+        self.assertIsNone(SubscriptionPurchase.objects.get(pk=purchase.pk).subscription_reference)
+
+    def test_cancel_of_transaction_without_stored_invoice(self):
+        base, purchase = self.subscribe(self.create_purchase())
+        BaseTransaction.objects.filter(purchase=purchase).update(invoice=None)  # created before the invoice column
+        self.ipn({'txn_type': 'subscr_cancel', 'invoice': base['invoice'], 'subscr_id': 'I-1'})
+        self.assertIsNone(SubscriptionPurchase.objects.get(pk=purchase.pk).subscription_reference)
+
+
+class RecordingIPN(MyPayPalIPN):
+    def __init__(self):
+        super().__init__()
+        self.events = []
+
+    def on_payment(self, payment):
+        self.events.append('payment')
+
+    def on_subscription_created(self, POST, purchase):
+        self.events.append('created')
+
+    def on_subscription_canceled(self, POST, purchase):
+        self.events.append('canceled')
+
+
+class AfterCommitTest(DebitsTestCase):
+    """Hooks, emails and requests to PayPal run after the transaction of the IPN is committed."""
+
+    def test_hooks(self):
+        handler = RecordingIPN()
+        form = self.checkout(self.create_purchase())
+        base = {'custom': form['custom'], 'invoice': form['invoice'], 'payer_email': 'payer@example.com',
+                'subscr_id': 'I-1', 'mc_currency': 'USD'}
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ipn(dict(base, txn_type='subscr_payment', payment_status='Completed', mc_gross='10.00'), handler)
+            self.assertEqual(handler.events, [])
+        self.assertEqual(handler.events, ['created', 'payment'])
+        with mock.patch.object(SubscriptionPurchase, 'cancel_subscription_email') as email:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.ipn({'txn_type': 'subscr_cancel', 'invoice': base['invoice'], 'subscr_id': 'I-1'}, handler)
+                email.assert_not_called()
+            email.assert_called_once_with()
+        self.assertEqual(handler.events, ['created', 'payment', 'canceled'])
+
+    def test_upgrade_cancels_old_subscription(self):
+        old = self.subscribe(self.create_purchase('old'))[1]
+        new = self.create_purchase('new')
+        new.old_subscription = old
+        new.save()
+        with mock.patch.object(SubscriptionPurchase, 'force_cancel', autospec=True) as force_cancel:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.subscribe(new, subscr_id='I-2')
+                force_cancel.assert_not_called()
+            force_cancel.assert_called_once_with(old, is_upgrade=True)
+        self.assertIsNone(Purchase.objects.get(pk=new.pk).old_subscription)
+
+
+class SerializedIPNTest(DebitsTestCase):
+    """IPNs of a purchase run under its lock, and only the first of the signup and the payment activates it."""
+
+    def test_signup_after_payment(self):
+        handler = RecordingIPN()
+        purchase = self.create_purchase()
+        form = self.checkout(purchase)
+        base = {'custom': form['custom'], 'invoice': form['invoice'], 'payer_email': 'payer@example.com',
+                'subscr_id': 'I-1', 'mc_currency': 'USD'}
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ipn(dict(base, txn_type='subscr_payment', payment_status='Completed', mc_gross='10.00'), handler)
+            self.ipn(dict(base, txn_type='subscr_signup', amount3='10.00', period3='1 M'), handler)
+        self.assertEqual(handler.events, ['created', 'payment'])
+        purchase = SubscriptionPurchase.objects.get(pk=purchase.pk)
+        self.assertEqual(purchase.subscription_reference, 'I-1')
+        self.assertEqual(AutomaticPayment.objects.filter(transaction__purchase=purchase).count(), 1)
+
+    def test_lock(self):
+        purchase = self.create_purchase()
+        form = self.checkout(purchase)
+        with mock.patch('debits.paypal.views.purchase_lock', wraps=purchase_lock) as lock:
+            self.ipn({'txn_type': 'subscr_signup', 'custom': form['custom'], 'invoice': form['invoice'],
+                      'payer_email': 'payer@example.com', 'subscr_id': 'I-1', 'mc_currency': 'USD',
+                      'amount3': '10.00', 'period3': '1 M'})
+        lock.assert_called_once_with(purchase.pk)
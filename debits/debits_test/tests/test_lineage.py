@@ -0,0 +1,26 @@
+from debits.debits_base.models import Purchase, PurchaseLineage
+from debits.debits_test.tests.base import DebitsTestCase
+
+
+class LineageTest(DebitsTestCase):
+    def test_chain(self):
+        a, b, c = (self.create_purchase(name).pk for name in ('a', 'b', 'c'))
+        PurchaseLineage.link(a, b)
+        PurchaseLineage.link(b, c)
+        PurchaseLineage.link(b, c)  # repeated
+        self.assertEqual([PurchaseLineage.current(pk) for pk in (a, b, c)], [c, c, c])
+        self.assertEqual(set(PurchaseLineage.objects.values_list('root_id', flat=True)), {a})
+
+    def test_without_lineage(self):
+        purchase = self.create_purchase()
+        self.assertEqual(PurchaseLineage.current(purchase.pk), purchase.pk)
+        self.assertIsNone(PurchaseLineage.current_by_reference('I-1'))
+
+    def test_upgrade(self):
+        base, old = self.subscribe(self.create_purchase('old'), subscr_id='I-1')
+        new = self.create_purchase('new')
+        Purchase.objects.filter(pk=new.pk).update(old_subscription=old)
+        base, new = self.subscribe(new, subscr_id='I-2')
+        self.assertEqual(PurchaseLineage.current(old.pk), new.pk)
+        self.assertEqual(PurchaseLineage.current_by_reference('I-1'), new.pk)
+        self.assertEqual(PurchaseLineage.current_by_reference('I-2'), new.pk)
@@ -0,0 +1,93 @@
+import datetime
+
+from django.test import override_settings
+
+from debits.debits_base.models import SubscriptionAction, SubscriptionStatus
+from debits.debits_test.tests.base import MigrationTestCase
+
+
+@override_settings(PAYMENTS_DAYS_BEFORE_DUE_REMIND=10)
+class ScheduleExistingPurchasesTest(MigrationTestCase):
+    migrate_from = '0002_auto_20200504_0400'
+    migrate_to = '0003_squashed_0004_subscriptionpurchase_next_action'
+
+    def create_data(self, apps):
+        self.due = datetime.date.today() + datetime.timedelta(days=30)
+        self.purchase_pk = self.create_purchase(apps, due_payment_date=self.due,
+                                                payment_deadline=self.due + datetime.timedelta(days=20)).pk
+        self.reminded_pk = self.create_purchase(apps, due_payment_date=self.due, reminders_sent=3,
+                                                payment_deadline=self.due + datetime.timedelta(days=20)).pk
+
+    def test_next_action_is_scheduled(self):
+        SubscriptionPurchase = self.apps.get_model('debits_base', 'SubscriptionPurchase')
+        purchase = SubscriptionPurchase.objects.get(pk=self.purchase_pk)
+        self.assertEqual(purchase.next_action, SubscriptionAction.REMIND_BEFORE_DUE)
+        self.assertEqual(purchase.next_action_at, self.due - datetime.timedelta(days=10))
+        purchase = SubscriptionPurchase.objects.get(pk=self.reminded_pk)
+        self.assertEqual(purchase.next_action, SubscriptionAction.EXPIRE)
+        self.assertEqual(purchase.next_action_at, self.due + datetime.timedelta(days=21))
+
+
+@override_settings(PAYMENTS_REALM='test')
+class FillInvoicesTest(MigrationTestCase):
+    migrate_from = '0005_basetransaction_nonce'
+    migrate_to = '0006_basetransaction_invoice'
+
+    def create_data(self, apps):
+        PaymentProcessor = apps.get_model('debits_base', 'PaymentProcessor')
+        SubscriptionTransaction = apps.get_model('debits_base', 'SubscriptionTransaction')
+        processor = PaymentProcessor.objects.create(name="PayPal", url='https://www.paypal.com/')
+        self.purchase_pk = self.create_purchase(apps, subinvoice=2).pk
+        self.old_pk = SubscriptionTransaction.objects.create(purchase_id=self.purchase_pk, processor=processor).pk
+        self.new_pk = SubscriptionTransaction.objects.create(purchase_id=self.purchase_pk, processor=processor).pk
+
+    def test_invoice_is_stored(self):
+        BaseTransaction = self.apps.get_model('debits_base', 'BaseTransaction')
+        self.assertEqual(BaseTransaction.objects.get(pk=self.new_pk).invoice, 'test %d-2' % self.purchase_pk)
+        self.assertIsNone(BaseTransaction.objects.get(pk=self.old_pk).invoice)  # the same invoice
+
+
+class FillTransactionPurchaseTest(MigrationTestCase):
+    migrate_from = '0013_scheduler'
+    migrate_to = '0014_payment_transaction_purchase'
+
+    def create_data(self, apps):
+        BaseTransaction = apps.get_model('debits_base', 'BaseTransaction')
+        Payment = apps.get_model('debits_base', 'Payment')
+        PaymentProcessor = apps.get_model('debits_base', 'PaymentProcessor')
+        self.purchase = self.create_purchase(apps)
+        processor = PaymentProcessor.objects.create(name="PayPal", url='https://www.paypal.com/')
+        transaction = BaseTransaction.objects.create(purchase_id=self.purchase.pk, processor=processor)
+        self.payment = Payment.objects.create(transaction=transaction)
+
+    def test_filled(self):
+        Payment = self.apps.get_model('debits_base', 'Payment')
+        self.assertEqual(Payment.objects.get(pk=self.payment.pk).transaction_purchase_id, self.purchase.pk)
+
+
+class FillStatusesTest(MigrationTestCase):
+    migrate_from = '0011_purchaselineage'
+    migrate_to = '0012_subscriptionpurchase_status'
+
+    def create_data(self, apps):
+        today = datetime.date.today()
+        day = datetime.timedelta(days=1)
+        cases = {
+            'active': dict(due_payment_date=today, payment_deadline=today + day),
+            'trial': dict(trial=True, due_payment_date=today, payment_deadline=today + day),
+            'grace': dict(due_payment_date=today - day, payment_deadline=today),
+            'expired': dict(due_payment_date=today - 2 * day, payment_deadline=today - day),
+            'never_paid': dict(due_payment_date=today, payment_deadline=None),
+            'blocked': dict(blocked=True, gratis=True, due_payment_date=today, payment_deadline=today),
+            'gratis': dict(gratis=True, due_payment_date=today, payment_deadline=None),
+        }
+        self.pks = {name: self.create_purchase(apps, **fields).pk for name, fields in cases.items()}
+
+    def test_filled(self):
+        SubscriptionPurchase = self.apps.get_model('debits_base', 'SubscriptionPurchase')
+        statuses = dict(SubscriptionPurchase.objects.values_list('pk', 'status'))
+        self.assertEqual({name: statuses[pk] for name, pk in self.pks.items()},
+                         {'active': SubscriptionStatus.ACTIVE, 'trial': SubscriptionStatus.TRIAL,
+                          'grace': SubscriptionStatus.GRACE, 'expired': SubscriptionStatus.EXPIRED,
+                          'never_paid': SubscriptionStatus.EXPIRED, 'blocked': SubscriptionStatus.BLOCKED,
+                          'gratis': SubscriptionStatus.GRATIS})
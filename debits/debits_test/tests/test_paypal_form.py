@@ -0,0 +1,59 @@
+from decimal import Decimal
+
+from django.urls import reverse
+
+from debits.debits_base.models import SubscriptionTransaction
+from debits.debits_test.models import MyPurchase, PricingPlan
+from debits.debits_test.processors import MyPayPalForm
+from debits.debits_test.tests.base import DebitsTestCase
+
+
+class CachingPayPalForm(MyPayPalForm):
+    item_cache_timeout = 60
+
+
+class OtherIPNPayPalForm(CachingPayPalForm):
+    @classmethod
+    def ipn_name(cls):
+        return 'paypal-ipn-async'
+
+
+class PayPalFormTest(DebitsTestCase):
+    def form(self, purchase):
+        transaction = SubscriptionTransaction.for_checkout(processor_id=2, purchase=purchase)
+        return CachingPayPalForm(None).amend_hash_new_purchase(transaction, {})
+
+    def test_product_name_is_not_shared_by_item(self):
+        first = self.create_purchase()
+        second = MyPurchase.objects.create(item=first.item, plan=PricingPlan.objects.get(pk=2), shipping=1)
+        first_form = self.form(first)
+        second_form = self.form(second)
+        self.assertTrue(first_form['item_name'].endswith(': Plan 1'))
+        self.assertTrue(second_form['item_name'].endswith(': Plan 2'))
+        self.assertEqual(second_form['a3'], Decimal('11.00'))
+        self.assertNotEqual(first_form['invoice'], second_form['invoice'])
+
+    def test_item_change_invalidates_cache(self):
+        purchase = self.create_purchase()
+        self.form(purchase)
+        purchase.item.price = Decimal('12.00')
+        purchase.item.save()
+        self.assertEqual(self.form(purchase)['a3'], Decimal('12.00'))
+
+    def test_subscription_is_not_a_cart(self):
+        purchase = self.create_purchase()
+        transaction = SubscriptionTransaction.for_checkout(processor_id=2, purchase=purchase)
+        form = CachingPayPalForm(None).amend_hash_new_purchase(transaction, {'arcamens_cart': True})
+        self.assertEqual(form['cmd'], '_xclick-subscriptions')
+        self.assertEqual(form['src'], 1)
+        self.assertEqual(form['a3'], purchase.item.price)
+        self.assertNotIn('upload', form)
+
+    def test_notify_url_is_not_shared_by_forms(self):
+        purchase = self.create_purchase()
+        self.form(purchase)
+        transaction = SubscriptionTransaction.for_checkout(processor_id=2, purchase=purchase)
+        form = OtherIPNPayPalForm(None).amend_hash_new_purchase(transaction, {})
+        self.assertTrue(form['notify_url'].endswith(reverse('paypal-ipn-async')))
+        with self.settings(PAYPAL_ID='OTHER'):
+            self.assertEqual(self.form(purchase)['business'], 'OTHER')
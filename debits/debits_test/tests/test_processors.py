@@ -0,0 +1,40 @@
+from django.test import override_settings
+
+from debits.debits_base.base import get_cache
+from debits.debits_base.models import PaymentProcessor, ProcessorRegistry, processor_registry
+from debits.debits_test.tests.base import DebitsTestCase
+
+
+class ProcessorRegistryTest(DebitsTestCase):
+    def test_no_queries_after_load(self):
+        processor_registry.load()
+        with self.assertNumQueries(0):
+            self.assertEqual(processor_registry.processor(2).name, "PayPal")
+            self.assertEqual(processor_registry.klass(2).__name__, 'PayPalProcessorInfo')
+
+    def test_unknown_processor(self):
+        with self.assertRaises(PaymentProcessor.DoesNotExist):
+            processor_registry.processor(100)
+
+    @override_settings(PAYMENTS_PROCESSOR_REGISTRY_CHECK_INTERVAL=0)
+    def test_change_is_seen_by_other_processes(self):
+        other = ProcessorRegistry()  # the registry of another process (sharing the cache)
+        other.load()
+        PaymentProcessor.objects.filter(pk=2).update(name="PayPal 2")
+        self.assertEqual(other.processor(2).name, "PayPal")
+        processor = PaymentProcessor.objects.get(pk=2)
+        processor.save()  # sends the signal in this process
+        self.assertEqual(other.processor(2).name, "PayPal 2")
+        self.assertIsNotNone(get_cache().get(ProcessorRegistry.VERSION_KEY))
+
+    def test_processor_added_after_load(self):
+        processor_registry.load()
+        # added by another process, without a new version in the cache
+        PaymentProcessor.objects.bulk_create([PaymentProcessor(pk=100, name="Other", url='https://example.com',
+                                                               klass_app_label='paypal', klass_model='PayPalProcessorInfo')])
+        self.assertEqual(processor_registry.processor(100).name, "Other")
+
+    def test_loaded_on_first_use(self):
+        processor_registry.forget()
+        with self.assertNumQueries(1):
+            self.assertEqual(processor_registry.processor(2).name, "PayPal")
@@ -0,0 +1,50 @@
+import datetime
+from decimal import Decimal
+
+from django.utils import timezone
+
+from debits.debits_base.models import DailyRollup, Payment, Purchase
+from debits.debits_base.rollups import rebuild, daily_totals
+from debits.debits_test.tests.base import DebitsTestCase
+
+
+class RollupsTest(DebitsTestCase):
+    def totals(self):
+        today = datetime.date.today()
+        return {day['day']: day for day in daily_totals(today - datetime.timedelta(days=100),
+                                                        today + datetime.timedelta(days=1))}
+
+    def test_rebuild_matches_incremental(self):
+        for name in ('a', 'b'):
+            self.subscribe(self.create_purchase(name), subscr_id='I-' + name)
+        self.create_purchase('trial', trial_months=1)
+        incremental = self.totals()
+        DailyRollup.objects.all().update(payments=100)
+        rebuild(days=1)
+        rebuilt = self.totals()
+        today = datetime.date.today()
+        self.assertEqual(rebuilt[today]['payments'], 2)
+        self.assertEqual(rebuilt[today]['revenue'], Decimal('20.00'))
+        self.assertEqual(rebuilt[today]['activations'], 2)
+        self.assertEqual(rebuilt[today]['trials_started'], 1)
+        self.assertEqual(rebuilt[today]['payments'], incremental[today]['payments'])
+
+    def test_rebuild_by_ranges(self):
+        base, purchase = self.subscribe(self.create_purchase())
+        old = timezone.now() - datetime.timedelta(days=40)
+        Payment.objects.all().update(payment_time=old)
+        Purchase.objects.all().update(creation_date=old)
+        rebuild(days=7)
+        totals = self.totals()
+        old_day = timezone.localtime(old).date()
+        self.assertEqual(totals[old_day]['payments'], 1)
+        self.assertEqual(totals[old_day]['activations'], 1)
+        self.assertEqual(totals[old_day]['active_subscribers'], 1)
+        self.assertNotIn(datetime.date.today(), totals)  # today's rollup was deleted
+
+    def test_rebuild_only_given_days(self):
+        self.subscribe(self.create_purchase())
+        today = datetime.date.today()
+        DailyRollup.objects.filter(day=today).update(payments=100)
+        rebuild(today - datetime.timedelta(days=10), today)  # excludes today
+        self.assertEqual(self.totals()[today]['payments'], 100)
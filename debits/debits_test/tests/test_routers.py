@@ -0,0 +1,82 @@
+import time
+
+from django.contrib.auth.models import User
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from debits.debits_base import routers
+from debits.debits_base.models import Product
+from debits.debits_base.routers import DebitsRouter, ReplicaPinningMiddleware, use_primary
+
+
+@override_settings(PAYMENTS_REPLICA_DATABASES=['replica'], PAYMENTS_REPLICA_PIN_SECONDS=5)
+class RouterTest(SimpleTestCase):
+    def setUp(self):
+        self.router = DebitsRouter()
+        routers._pinned_until.set(0.0)
+
+    def tearDown(self):
+        routers._pinned_until.set(0.0)
+
+    def test_reads_from_replica(self):
+        self.assertEqual(self.router.db_for_read(Product), 'replica')
+
+    @override_settings(PAYMENTS_REPLICA_DATABASES=[])
+    def test_no_replicas(self):
+        self.assertEqual(self.router.db_for_read(Product), 'default')
+
+    def test_not_routed_app(self):
+        self.assertIsNone(self.router.db_for_read(User))
+        self.assertIsNone(self.router.db_for_write(User))
+
+    def test_reads_from_primary_after_write(self):
+        self.assertEqual(self.router.db_for_write(Product), 'default')
+        self.assertEqual(self.router.db_for_read(Product), 'default')
+
+    def test_use_primary(self):
+        with use_primary():
+            self.assertEqual(self.router.db_for_read(Product), 'default')
+        self.assertEqual(self.router.db_for_read(Product), 'replica')
+
+    def test_migrations_only_on_primary(self):
+        self.assertTrue(self.router.allow_migrate('default', 'debits_base'))
+        self.assertFalse(self.router.allow_migrate('replica', 'debits_base'))
+        self.assertIsNone(self.router.allow_migrate('replica', 'auth'))
+
+
+@override_settings(PAYMENTS_REPLICA_DATABASES=['replica'], PAYMENTS_REPLICA_PIN_SECONDS=5)
+class ReplicaPinningMiddlewareTest(SimpleTestCase):
+    def request(self, view, cookie=None):
+        request = RequestFactory().get('/')
+        if cookie is not None:
+            request.COOKIES[ReplicaPinningMiddleware.cookie_name] = cookie
+        return ReplicaPinningMiddleware(view)(request)
+
+    def test_write_sets_cookie(self):
+        def view(request):
+            DebitsRouter().db_for_write(Product)
+            return HttpResponse()
+        response = self.request(view)
+        self.assertIn(ReplicaPinningMiddleware.cookie_name, response.cookies)
+
+    def test_cookie_pins_reads(self):
+        reads = []
+
+        def view(request):
+            reads.append(DebitsRouter().db_for_read(Product))
+            return HttpResponse()
+        response = self.request(view, str(time.time() + 3))
+        self.assertEqual(reads, ['default'])
+        self.assertNotIn(ReplicaPinningMiddleware.cookie_name, response.cookies)
+        self.request(view, 'bad')
+        self.assertEqual(reads, ['default', 'replica'])
+        self.assertEqual(routers._pinned_until.get(), 0.0)  # reset after the request
+
+    def test_cookie_is_capped(self):
+        pins = []
+
+        def view(request):
+            pins.append(routers._pinned_until.get())
+            return HttpResponse()
+        self.request(view, str(time.time() + 3600))
+        self.assertLessEqual(pins[0], time.time() + 5)
@@ -0,0 +1,59 @@
+import datetime
+from unittest import mock
+
+from django.utils import timezone
+
+from debits.debits_base.models import SchedulerLease, JobRun
+from debits.debits_base.scheduler import Scheduler, LEASE_NAME
+from debits.debits_test.tests.base import DebitsTestCase, DebitsTransactionTestCase
+
+
+class LeaseTest(DebitsTestCase):
+    def test_only_one_leader(self):
+        leader, other = Scheduler(jobs={}), Scheduler(jobs={})
+        self.assertTrue(leader.renew())
+        self.assertFalse(other.renew())
+        self.assertTrue(leader.renew())
+
+    def test_uses_db_clock(self):
+        leader, other = Scheduler(jobs={}), Scheduler(jobs={})
+        with mock.patch('django.utils.timezone.now', return_value=timezone.now() - datetime.timedelta(days=1)):
+            self.assertTrue(leader.renew())  # the clock of the leader is behind
+        with mock.patch('django.utils.timezone.now', return_value=timezone.now() + datetime.timedelta(days=1)):
+            self.assertFalse(other.renew())  # the clock of the other node is ahead
+
+    def test_release(self):
+        leader, other = Scheduler(jobs={}), Scheduler(jobs={})
+        self.assertTrue(leader.renew())
+        leader.release()
+        self.assertTrue(other.renew())
+        self.assertEqual(SchedulerLease.objects.get(name=LEASE_NAME).holder, other.node)
+
+
+class LostLeaseTest(DebitsTransactionTestCase):
+    def test_job_is_stopped(self):
+        stopped = []
+
+        def job(stop):
+            # another node takes the lease
+            SchedulerLease.objects.filter(name=LEASE_NAME).\
+                update(holder='other', expires_at=timezone.now() + datetime.timedelta(days=1))
+            stopped.append(stop.wait(10))
+        scheduler = Scheduler(jobs={'job': (job, 3600)}, lease_seconds=0.3)
+        with self.assertLogs('debits', 'WARNING'):
+            runs = scheduler.run_pending()
+        self.assertEqual(stopped, [True])
+        self.assertEqual(len(runs), 1)
+        run = JobRun.objects.get(pk=runs[0].pk)
+        self.assertFalse(run.succeeded)
+        self.assertIn("lease", run.error)
+        self.assertEqual(scheduler.run_pending(), [])  # not the leader anymore
+
+    def test_job_without_stop_argument(self):
+        calls = []
+
+        def job():
+            calls.append(True)
+        runs = Scheduler(jobs={'job': (job, 3600)}).run_pending()
+        self.assertEqual(calls, [True])
+        self.assertTrue(runs[0].succeeded)
@@ -0,0 +1,43 @@
+from debits.debits_base.base import get_cache
+from debits.debits_base.loader import item_cache_key, transaction_cache_key
+from debits.debits_base.models import SubscriptionTransaction
+from debits.debits_base.signals import for_product_items
+from debits.paypal import form
+from debits.debits_test.tests.base import DebitsTestCase
+
+
+class InvalidationTest(DebitsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.purchase = self.create_purchase()
+        self.item = self.purchase.item.subscriptionitem
+
+    def cache(self, *keys):
+        """Puts `keys` into the cache."""
+        get_cache().set_many({key: True for key in keys})
+
+    def assertNotCached(self, *keys):
+        self.assertEqual(get_cache().get_many(keys), {})
+
+    def test_item_subclass_saved(self):
+        keys = [item_cache_key(self.item.pk), form.item_cache_key(self.item.pk, True)]
+        self.cache(*keys)
+        self.item.save()
+        self.assertNotCached(*keys)
+
+    def test_product_saved(self):
+        keys = [item_cache_key(self.item.pk), form.item_cache_key(self.item.pk, False)]
+        self.cache(*keys)
+        self.item.product.save()
+        self.assertNotCached(*keys)
+
+    def test_transaction_subclass_saved(self):
+        transaction = SubscriptionTransaction.for_checkout(processor_id=2, purchase=self.purchase)
+        self.cache(transaction_cache_key(transaction.pk))
+        transaction.save()
+        self.assertNotCached(transaction_cache_key(transaction.pk))
+
+    def test_product_items_in_batches(self):
+        batches = []
+        for_product_items(self.item.product, lambda *pks: batches.append(pks), batch_size=1)
+        self.assertEqual(batches, [(self.item.pk,)])
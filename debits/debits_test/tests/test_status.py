@@ -0,0 +1,31 @@
+import datetime
+
+from debits.debits_base.models import SubscriptionPurchase, SubscriptionStatus
+from debits.debits_test.tests.base import DebitsTestCase
+
+DAY = datetime.timedelta(days=1)
+
+
+class StatusTest(DebitsTestCase):
+    def reload(self, purchase):
+        return SubscriptionPurchase.objects.get(pk=purchase.pk)
+
+    def test_subscribe_and_cancel(self):
+        base, purchase = self.subscribe(self.create_purchase())
+        self.assertEqual(purchase.status, SubscriptionStatus.ACTIVE)
+        self.ipn({'txn_type': 'subscr_cancel', 'invoice': base['invoice'], 'subscr_id': 'I-1'})
+        self.assertEqual(self.reload(purchase).status, SubscriptionStatus.CANCELED)
+
+    def test_sweep(self):
+        today = datetime.date.today()
+        grace, expired, canceled = (self.subscribe(self.create_purchase(name), subscr_id=name)[1]
+                                    for name in ('grace', 'expired', 'canceled'))
+        SubscriptionPurchase.objects.filter(pk=grace.pk).\
+            update(due_payment_date=today - DAY, payment_deadline=today + DAY)
+        SubscriptionPurchase.objects.filter(pk__in=[expired.pk, canceled.pk]).\
+            update(due_payment_date=today - 2 * DAY, payment_deadline=today - DAY)
+        SubscriptionPurchase.objects.filter(pk=canceled.pk).update(status=SubscriptionStatus.CANCELED)
+        self.assertEqual(SubscriptionPurchase.sweep_statuses(batch_size=1), 3)
+        self.assertEqual([self.reload(purchase).status for purchase in (grace, expired, canceled)],
+                         [SubscriptionStatus.GRACE, SubscriptionStatus.EXPIRED, SubscriptionStatus.EXPIRED])
+        self.assertEqual(SubscriptionPurchase.sweep_statuses(), 0)
@@ -0,0 +1,40 @@
+from django.urls import reverse
+
+from debits.debits_base.models import SubscriptionPurchase, SubscriptionTransaction
+from debits.debits_base.summary import billing_summary
+from debits.debits_test.tests.base import DebitsTestCase
+
+
+class BillingSummaryTest(DebitsTestCase):
+    def assertSameActivity(self, purchase):
+        purchase = SubscriptionPurchase.objects.get(pk=purchase.pk)
+        self.assertEqual(billing_summary(purchase.pk, purchase.version).is_active, purchase.is_active())
+        return purchase.is_active()
+
+    def test_canceled_is_active_till_deadline(self):
+        base, purchase = self.subscribe(self.create_purchase())
+        self.ipn({'txn_type': 'subscr_cancel', 'invoice': base['invoice'], 'subscr_id': 'I-1'})
+        self.assertTrue(self.assertSameActivity(purchase))
+
+    def test_blocked(self):
+        base, purchase = self.subscribe(self.create_purchase())
+        SubscriptionPurchase.objects.filter(pk=purchase.pk).update(blocked=True, version=purchase.version + 1)
+        self.assertFalse(self.assertSameActivity(purchase))
+
+    def test_not_paid(self):
+        self.assertFalse(self.assertSameActivity(self.create_purchase()))
+
+
+class PaymentViewTest(DebitsTestCase):
+    def test_organization_view(self):
+        purchase = self.create_purchase()
+        response = self.client.get(reverse('organization-prolong-payment', args=[purchase.organization.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['plan'], purchase.plan.name)
+
+    def test_transaction_view(self):
+        purchase = self.create_purchase()
+        transaction = SubscriptionTransaction.for_checkout(processor_id=2, purchase=purchase)
+        response = self.client.get(reverse('transaction-prolong-payment', args=[transaction.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['organization_id'], purchase.organization.pk)
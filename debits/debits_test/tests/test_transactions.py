@@ -0,0 +1,53 @@
+from django.test import override_settings
+from django.db import IntegrityError
+
+from debits.debits_base.models import BaseTransaction, SubscriptionTransaction
+from debits.debits_test.tests.base import DebitsTestCase
+
+
+@override_settings(PAYMENTS_LAZY_TRANSACTIONS=True)
+class LazyTransactionTest(DebitsTestCase):
+    def test_checkout_does_not_create_transaction(self):
+        self.checkout(self.create_purchase())
+        self.assertFalse(BaseTransaction.objects.exists())
+
+    def test_created_once_by_ipns(self):
+        base, purchase = self.subscribe(self.create_purchase())  # the signup and the payment
+        transaction = SubscriptionTransaction.objects.get(purchase=purchase)
+        self.assertIsNotNone(transaction.nonce)
+        self.assertEqual(transaction.processor_id, 2)
+        self.assertEqual(purchase.subscription_reference, 'I-1')
+        self.assertTrue(purchase.is_active())
+
+    def test_forged_custom(self):
+        form = self.checkout(self.create_purchase())
+        realm, ref, secret = form['custom'].split(' ')
+        other_purchase = '%s%d.%s' % (ref[0], self.create_purchase('other').pk, ref.split('.', 1)[1])
+        for custom in ('%s %s %s' % (realm, ref, '0' * len(secret)), '%s %s %s' % (realm, other_purchase, secret)):
+            with self.assertRaises(BaseTransaction.DoesNotExist):
+                BaseTransaction.pk_from_custom_or_create(custom, 2)
+        self.assertFalse(BaseTransaction.objects.exists())
+
+    def test_saved_transaction_custom(self):
+        transaction = SubscriptionTransaction.objects.create(processor_id=2, purchase=self.create_purchase())
+        self.assertEqual(BaseTransaction.pk_from_custom_or_create(transaction.custom(), 2), transaction.pk)
+        self.assertEqual(BaseTransaction.objects.count(), 1)
+
+
+class TransactionInvoiceTest(DebitsTestCase):
+    def test_created_again_for_purchase(self):
+        purchase = self.create_purchase()
+        first = SubscriptionTransaction.objects.create(processor_id=2, purchase=purchase)
+        second = SubscriptionTransaction.objects.create(processor_id=3, purchase=purchase)
+        self.assertEqual(second.pk, first.pk)
+        self.assertEqual(second.invoice, first.invoice)
+        transaction = SubscriptionTransaction.objects.get()
+        self.assertEqual(transaction.processor_id, 3)
+        self.assertEqual(transaction.creation_date, first.creation_date)
+        self.assertEqual(BaseTransaction.objects.count(), 1)
+
+    def test_other_integrity_error(self):
+        purchase = self.create_purchase()
+        SubscriptionTransaction.objects.create(processor_id=2, purchase=purchase, nonce='n')
+        with self.assertRaises(IntegrityError):
+            SubscriptionTransaction.objects.create(processor_id=2, purchase=self.create_purchase('other'), nonce='n')
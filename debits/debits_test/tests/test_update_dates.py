@@ -0,0 +1,59 @@
+import datetime
+from unittest import mock
+
+from django.db.models import F
+from django.test import override_settings
+
+from debits.debits_base.models import SubscriptionPurchase, ConcurrentUpdate
+from debits.debits_test.tests.base import DebitsTestCase, DebitsTransactionTestCase
+
+DAY = datetime.timedelta(days=1)
+
+
+def add_day(purchase):
+    purchase.set_payment_date(purchase.due_payment_date + DAY)
+
+
+class UpdateDatesMixin(object):
+    def stale_purchase(self):
+        """A purchase whose dates were changed in the DB after it was loaded."""
+        purchase = SubscriptionPurchase.objects.get(pk=self.create_purchase().pk)
+        SubscriptionPurchase.objects.filter(pk=purchase.pk).update(
+            due_payment_date=F('due_payment_date') + DAY, version=F('version') + 1)
+        return purchase
+
+    def assertAdvanced(self, purchase, days):
+        loaded = SubscriptionPurchase.objects.get(pk=purchase.pk)
+        self.assertEqual(loaded.due_payment_date, self.start + days * DAY)
+        self.assertEqual(loaded.version, purchase.version)
+
+
+class InTransactionTest(UpdateDatesMixin, DebitsTestCase):
+    def test_locks_and_reloads_without_retries(self):
+        purchase = self.stale_purchase()
+        self.start = purchase.due_payment_date
+        with mock.patch('debits.debits_base.models.time.sleep') as sleep:
+            purchase.update_dates(add_day)
+        sleep.assert_not_called()
+        self.assertAdvanced(purchase, 2)
+
+
+class OutsideTransactionTest(UpdateDatesMixin, DebitsTransactionTestCase):
+    def test_retries_stale_version(self):
+        purchase = self.stale_purchase()
+        self.start = purchase.due_payment_date
+        with mock.patch('debits.debits_base.models.time.sleep') as sleep:
+            purchase.update_dates(add_day)
+        self.assertEqual(sleep.call_count, 1)
+        self.assertAdvanced(purchase, 2)
+
+    @override_settings(PAYMENTS_UPDATE_RETRIES=2)
+    def test_gives_up(self):
+        purchase = SubscriptionPurchase.objects.get(pk=self.create_purchase().pk)
+
+        def change(purchase):
+            SubscriptionPurchase.objects.filter(pk=purchase.pk).update(version=F('version') + 1)  # a concurrent change
+            add_day(purchase)
+        with mock.patch('debits.debits_base.models.time.sleep'):
+            with self.assertRaises(ConcurrentUpdate):
+                purchase.update_dates(change)
@@ -0,0 +1,44 @@
+from unittest import mock
+from urllib.parse import urlencode
+
+from django.urls import reverse
+
+from debits.debits_test.callbacks import MyPayPalIPN
+from debits.debits_test.tests.base import DebitsTestCase, PAYPAL_EMAIL
+
+
+class VerifiedCacheTest(DebitsTestCase):
+    def post(self, fields):
+        """Posts an IPN, PayPal answering VERIFIED to the postback.
+
+        Returns:
+            The numbers of postbacks and of processed IPNs."""
+        body = urlencode(dict(fields, receiver_email=PAYPAL_EMAIL, charset='utf-8'))
+        with mock.patch('debits.paypal.views.requests.post', return_value=mock.Mock(text='VERIFIED')) as postback, \
+                mock.patch.object(MyPayPalIPN, 'verified_post') as verified_post:
+            response = self.client.post(reverse('paypal-ipn'), body, content_type='application/x-www-form-urlencoded')
+        self.assertEqual(response.status_code, 200)
+        return postback.call_count, verified_post.call_count
+
+    def test_resend_is_not_verified_again(self):
+        fields = {'txn_type': 'subscr_cancel', 'subscr_id': 'I-1', 'ipn_track_id': 'track1'}
+        self.assertEqual(self.post(fields), (1, 1))
+        self.assertEqual(self.post(fields), (0, 1))
+
+    def test_different_body(self):
+        self.post({'txn_type': 'subscr_cancel', 'subscr_id': 'I-1', 'ipn_track_id': 'track1'})
+        self.assertEqual(self.post({'txn_type': 'subscr_cancel', 'subscr_id': 'I-2', 'ipn_track_id': 'track1'}),
+                         (1, 1))
+
+    def test_without_track_id(self):
+        fields = {'txn_type': 'subscr_cancel', 'subscr_id': 'I-1'}
+        self.assertEqual(self.post(fields), (1, 1))
+        self.assertEqual(self.post(fields), (1, 1))
+
+    def test_not_verified_is_not_cached(self):
+        fields = {'txn_type': 'subscr_cancel', 'subscr_id': 'I-1', 'ipn_track_id': 'track1'}
+        body = urlencode(dict(fields, receiver_email=PAYPAL_EMAIL, charset='utf-8'))
+        with mock.patch('debits.paypal.views.requests.post', return_value=mock.Mock(text='INVALID')), \
+                self.assertLogs('debits', 'WARNING'):
+            self.client.post(reverse('paypal-ipn'), body, content_type='application/x-www-form-urlencoded')
+        self.assertEqual(self.post(fields), (1, 1))
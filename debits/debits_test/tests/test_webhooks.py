@@ -0,0 +1,109 @@
+import datetime
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import override_settings
+from django.urls import reverse
+
+from debits.debits_test.tests.base import DebitsTestCase
+from debits.paypal.models import CannotVerifyWebhook
+from debits.paypal.webhooks import CertificateCache, PayPalWebhook, check_transmission_id, verify_webhook, x509
+
+URL = 'https://api.paypal.com/v1/notifications/certs/CERT-1'
+
+
+def headers(sent):
+    """The headers of a webhook event sent at `sent`."""
+    return {'Paypal-Transmission-Id': 'T-1', 'Paypal-Transmission-Time': sent.isoformat(),
+            'Paypal-Transmission-Sig': 'AAAA', 'Paypal-Cert-Url': URL}
+
+
+class CertificateCacheTest(DebitsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.cache = CertificateCache()
+
+    def store(self, mode):
+        """Stores a PEM for :data:`URL` in the directory with the given mode."""
+        os.chmod(self.directory.name, mode)
+        with override_settings(PAYPAL_WEBHOOK_CERT_DIR=self.directory.name):
+            with open(self.cache.path(URL), 'wb') as f:
+                f.write(b'PEM')
+
+    @override_settings(PAYPAL_WEBHOOK_CERT_DIR=None)
+    def test_directory_is_required(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self.cache.read(URL)
+
+    def test_read_from_private_directory(self):
+        self.store(0o700)
+        with override_settings(PAYPAL_WEBHOOK_CERT_DIR=self.directory.name):
+            self.assertEqual(self.cache.read(URL), b'PEM')
+
+    def test_shared_directory_is_refused(self):
+        self.store(0o777)
+        with override_settings(PAYPAL_WEBHOOK_CERT_DIR=self.directory.name):
+            with self.assertRaises(CannotVerifyWebhook):
+                self.cache.read(URL)
+
+    @unittest.skipIf(x509 is None, "requires cryptography")
+    def test_untrusted_certificate_is_refused(self):
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        name = x509.Name([x509.NameAttribute(x509.oid.NameOID.COMMON_NAME, 'messageverificationcerts.paypal.com')])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        certificate = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key()) \
+            .serial_number(1).not_valid_before(now - datetime.timedelta(days=1)) \
+            .not_valid_after(now + datetime.timedelta(days=1)).sign(key, hashes.SHA256())
+        with self.assertRaises(CannotVerifyWebhook):
+            self.cache.validate(certificate.public_bytes(serialization.Encoding.PEM))
+
+
+class TransmissionTest(DebitsTestCase):
+    def test_old_event_is_refused(self):
+        sent = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=1)
+        with self.assertRaisesMessage(CannotVerifyWebhook, "tolerance"):
+            verify_webhook(headers(sent), b'{}')
+
+    def test_future_event_is_refused(self):
+        sent = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+        with self.assertRaisesMessage(CannotVerifyWebhook, "tolerance"):
+            verify_webhook(headers(sent), b'{}')
+
+    def test_wrong_time_is_refused(self):
+        with self.assertRaisesMessage(CannotVerifyWebhook, "transmission time"):
+            verify_webhook(dict(headers(datetime.datetime.now()), **{'Paypal-Transmission-Time': 'now'}), b'{}')
+
+    def test_replayed_transmission_is_refused(self):
+        check_transmission_id('T-replayed')
+        with self.assertRaises(CannotVerifyWebhook):
+            check_transmission_id('T-replayed')
+
+    def test_view_refuses_old_event(self):
+        sent = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=1)
+        response = self.client.post(reverse('paypal-webhook'), '{}', content_type='application/json',
+                                    **{'HTTP_' + k.upper().replace('-', '_'): v for k, v in headers(sent).items()})
+        self.assertEqual(response.status_code, 400)
+
+    def test_failed_event_is_redelivered(self):
+        def verify(headers, body):  # without the signature
+            check_transmission_id(headers['Paypal-Transmission-Id'])
+
+        def post():
+            return self.client.post(reverse('paypal-webhook'), '{}', content_type='application/json',
+                                    HTTP_PAYPAL_TRANSMISSION_ID='T-failed')
+
+        with mock.patch('debits.paypal.webhooks.verify_webhook', verify), \
+                mock.patch.object(PayPalWebhook, 'on_event', side_effect=[IOError, None]) as on_event:
+            with self.assertLogs('debits', 'ERROR'):
+                self.assertEqual(post().status_code, 500)
+            self.assertEqual(post().status_code, 200)  # not refused as a replay
+            with self.assertLogs('debits', 'WARNING'):
+                self.assertEqual(post().status_code, 400)  # but processed events are
+        self.assertEqual(on_event.call_count, 2)
@@ -0,0 +1,61 @@
+import datetime
+from io import StringIO
+from unittest import mock
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.test import override_settings
+
+from debits.debits_base.models import SubscriptionPurchase
+from debits.debits_base.workers import assign_shards, run_sharded
+from debits.debits_test.tests.base import DebitsTestCase
+
+
+class AssignShardsTest(DebitsTestCase):
+    def test_nodes_cover_all_shards_once(self):
+        # the nodes may have different numbers of processes
+        for nodes in range(1, 6):
+            for processes in ([1] * nodes, [1, 4, 2, 8, 3][:nodes], [16] * nodes):
+                shards = [shard
+                          for node in range(nodes)
+                          for part in assign_shards(node, nodes, 16, processes[node])
+                          for shard in part]
+                self.assertEqual(sorted(shards), list(range(16)))
+
+    def test_processes(self):
+        self.assertEqual(assign_shards(1, 2, 8, 2), [[1, 5], [3, 7]])
+        self.assertEqual(assign_shards(1, 2, 8, 10), [[1], [3], [5], [7]])  # no idle processes
+
+
+class RunShardedTest(DebitsTestCase):
+    def expire(self, purchase):
+        purchase.set_payment_date(datetime.date.today() - datetime.timedelta(days=30))
+        purchase.save()
+
+    def test_all_shards_at_once(self):
+        self.expire(self.create_purchase())
+        self.assertEqual(run_sharded('expiry'), 1)
+
+    @override_settings(PAYMENTS_WORKER_SHARDS=4)
+    def test_shards_of_node(self):
+        job = mock.Mock(return_value=1)
+        with mock.patch.dict('debits.debits_base.workers.JOBS', {'job': job}):
+            self.assertEqual(run_sharded('job', 1, 2, processes=1, batch_size=5), 2)
+        self.assertEqual(job.call_args_list, [mock.call(1, 4, None, batch_size=5), mock.call(3, 4, None, batch_size=5)])
+
+    @override_settings(PAYMENTS_WORKER_SHARDS=2)
+    def test_too_many_nodes(self):
+        with self.assertRaises(ImproperlyConfigured):
+            run_sharded('expiry', 0, 3)
+
+    def test_sweep_batch_size(self):
+        with mock.patch.object(SubscriptionPurchase, 'sweep_expired', return_value=0) as sweep_expired, \
+                mock.patch.object(SubscriptionPurchase, 'sweep_statuses', return_value=0) as sweep_statuses:
+            call_command('debits_sweep_expired', batch_size=7, stdout=StringIO())
+        self.assertEqual(sweep_expired.call_args.kwargs['batch_size'], 7)
+        self.assertEqual(sweep_statuses.call_args.kwargs['batch_size'], 7)
+
+    def test_reminders_batch_size(self):
+        with mock.patch.object(SubscriptionPurchase, 'send_reminders', return_value=0) as send_reminders:
+            call_command('debits_send_reminders', batch_size=7, stdout=StringIO())
+        self.assertEqual(send_reminders.call_args.kwargs['batch_size'], 7)
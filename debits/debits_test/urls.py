@@ -1,6 +1,7 @@
 from django.conf.urls import url
-from .callbacks import MyPayPalIPN
+from .callbacks import MyPayPalIPN, MyAsyncPayPalIPN, MyPayPalWebhook
 from . import views
+import debits.debits_base.views
 
 urlpatterns = [
     url(r'^$', views.list_organizations_view, name='list-organizations'),
@@ -9,5 +10,11 @@ urlpatterns = [
     url(r'^transaction-prolong-payment/([0-9]+)$', views.transaction_payment_view, name='transaction-prolong-payment'),
     url(r'^organization-prolong-payment/([0-9]+)$', views.organization_payment_view, name='organization-prolong-payment'),
     url(r'^unsubscribe-organization/([0-9]+)$', views.unsubscribe_organization_view, name='unsubscribe-organization'),
-    url(r'^paypal/ipn$', MyPayPalIPN.as_view(), name='paypal-ipn')
+    url(r'^paypal/ipn$', MyPayPalIPN.as_view(), name='paypal-ipn'),
+    url(r'^paypal/ipn-async$', MyAsyncPayPalIPN.as_view(), name='paypal-ipn-async'),
+    url(r'^paypal/webhook$', MyPayPalWebhook.as_view(), name='paypal-webhook'),
+    url(r'^export/payments$', debits.debits_base.views.export_payments_view, name='export-payments'),
+    url(r'^history/payments$', debits.debits_base.views.payment_history_view, name='payment-history'),
+    url(r'^history/transactions$', debits.debits_base.views.transaction_history_view, name='transaction-history'),
+    url(r'^history/purchases$', debits.debits_base.views.purchase_history_view, name='purchase-history'),
 ]
@@ -1,12 +1,13 @@
 import datetime
 
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseBadRequest
 from django.shortcuts import render, reverse
 from django.utils.translation import ugettext_lazy as _
 from .models import Organization, MyPurchase, PricingPlan
 from .forms import CreateOrganizationForm, SwitchPricingPlanForm
 from .business import create_organization
 from debits.debits_base.base import Period, period_to_string
+from debits.debits_base.summary import billing_summary
 from debits.debits_base.models import SimpleTransaction, SubscriptionTransaction, ProlongPurchase, SubscriptionItem, \
     logger, \
     CannotCancelSubscription, ProlongPurchase, SimpleItem
@@ -16,47 +17,47 @@ from .processors import MyPayPalForm
 
 def transaction_payment_view(request, transaction_id):
     """A view initiated from a transaction."""
-    transaction = SubscriptionTransaction.objects.get(pk=int(transaction_id))
-    purchase = transaction.purchase
+    purchase = MyPurchase.objects.select_related('plan', 'organization').get(transactions=int(transaction_id))
     organization = purchase.organization
     return do_organization_payment_view(request, purchase, organization)
 
 
 def organization_payment_view(request, organization_id):
     """A view initiated for an organization."""
-    organization = Organization.objects.get(pk=int(organization_id))
+    organization = Organization.objects.select_related('purchase__plan').get(pk=int(organization_id))
     purchase = organization.purchase
     return do_organization_payment_view(request, purchase, organization)
 
 
 def do_organization_payment_view(request, purchase, organization):
     """The common pars of views for :func:`transaction_payment_view` and :func:`organization_payment_view`."""
-    plan_form = SwitchPricingPlanForm({'pricing_plan': purchase.plan.pk})
+    summary = billing_summary(purchase.pk, purchase.version)
+    plan_form = SwitchPricingPlanForm({'pricing_plan': purchase.plan_id})
     pp = MyPayPalForm(request)
     return render(request, 'debits_test/organization-payment-view.html',
                   {'organization_id': organization.pk,
                    'organization': organization.name,
-                   'item_id': purchase.pk,
-                   'email': purchase.payment.email if purchase.payment else None,
-                   'gratis': purchase.gratis,
-                   'active': purchase.is_active(),
-                   'blocked': purchase.blocked,
-                   'manual_mode': not purchase.subscribed,
-                   'processor_name': purchase.processor.name if purchase.processor else None,
+                   'item_id': summary.purchase_id,
+                   'email': summary.email,
+                   'gratis': summary.gratis,
+                   'active': summary.is_active,
+                   'blocked': summary.blocked,
+                   'manual_mode': not summary.subscribed,
+                   'processor_name': summary.processor,
                    # only for automatic recurring payment
                    'plan': purchase.plan.name,
-                   'trial': purchase.trial,
-                   'trial_period': period_to_string(purchase.item.subscriptionitem.trial_period),
-                   'due_date': purchase.due_payment_date,
-                   'deadline': purchase.payment_deadline,
-                   'price': purchase.item.price,
-                   'currency': purchase.item.currency,
-                   'payment_period': period_to_string(purchase.item.subscriptionitem.payment_period),
+                   'trial': summary.trial,
+                   'trial_period': period_to_string(summary.trial_period),
+                   'due_date': summary.due_payment_date,
+                   'deadline': summary.payment_deadline,
+                   'price': summary.price,
+                   'currency': summary.currency,
+                   'payment_period': period_to_string(summary.payment_period),
                    'plan_form': plan_form,
-                   'can_switch_to_recurring': pp.ready_for_subscription(purchase),
-                   'subscription_allowed_date': pp.subscription_allowed_date(purchase),
-                   'subscription_reference': purchase.subscription_reference,
-                   'subinvoice': purchase.subinvoice})
+                   'can_switch_to_recurring': pp.ready_for_subscription(summary),
+                   'subscription_allowed_date': pp.subscription_allowed_date(summary),
+                   'subscription_reference': summary.subscription_reference,
+                   'subinvoice': summary.subinvoice})
 
 
 def create_organization_view(request):
@@ -79,7 +80,7 @@ def get_processor(request, hash):
     if processor_name == 'PayPal':
         form = MyPayPalForm(request)
         processor_id = debits.debits_base.processors.PAYMENT_PROCESSOR_PAYPAL
-        processor = debits.debits_base.models.PaymentProcessor.objects.get(pk=processor_id)
+        processor = debits.debits_base.models.processor_registry.processor(processor_id)
     else:
         raise RuntimeError("Unsupported payment form.")
     return form, processor
@@ -87,7 +88,7 @@ def get_processor(request, hash):
 
 def do_subscribe(hash, form, processor, purchase):
     """Start subscription to our subscription purchase."""
-    transaction = SubscriptionTransaction.objects.create(processor=processor, purchase=purchase)
+    transaction = SubscriptionTransaction.for_checkout(processor=processor, purchase=purchase)
     return form.make_purchase_from_form(hash, transaction)
 
 
@@ -101,7 +102,7 @@ def do_prolong(hash, form, processor, purchase):
                                                  prolonged=purchase,
                                                  period_unit=Period.UNIT_MONTHS,
                                                  period_count=periods)
-    subtransaction = SimpleTransaction.objects.create(processor=processor, purchase=subpurchase)
+    subtransaction = SimpleTransaction.for_checkout(processor=processor, purchase=subpurchase)
     return form.make_purchase_from_form(hash, subtransaction)
 
 
@@ -153,7 +154,7 @@ def do_upgrade(hash, form, processor, purchase, organization):
         organization.save()
         return HttpResponseRedirect(reverse('organization-prolong-payment', args=[organization.pk]))
     else:
-        upgrade_transaction = SubscriptionTransaction.objects.create(processor=processor, purchase=new_purchase)
+        upgrade_transaction = SubscriptionTransaction.for_checkout(processor=processor, purchase=new_purchase)
         return form.make_purchase_from_form(hash, upgrade_transaction)
 
 
@@ -209,7 +210,14 @@ def unsubscribe_organization_view(request, organization_pk):
 
 
 def list_organizations_view(request):
-    """Django view to list all the organizations."""
-    list = [{'id': o.id, 'name': o.name} for o in Organization.objects.all()]
+    """Django view to list the organizations, by pages (GET parameter `after` is the last ID of the previous page)."""
+    page_size = 100
+    try:
+        after = int(request.GET.get('after', 0))
+    except ValueError:
+        return HttpResponseBadRequest("Wrong after")
+    list = [{'id': o['id'], 'name': o['name']}
+            for o in Organization.objects.filter(pk__gt=after).order_by('pk').values('id', 'name')[:page_size + 1]]
+    next_after = list[page_size - 1]['id'] if len(list) > page_size else None
     return render(request, 'debits_test/list-organizations.html',
-                  {'organizations': list})
+                  {'organizations': list[:page_size], 'next_after': next_after})
@@ -0,0 +1 @@
+default_app_config = 'debits.paypal.apps.PayPalConfig'
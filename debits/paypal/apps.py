@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class PayPalConfig(AppConfig):
+    name = 'debits.paypal'
+    label = 'paypal'
+    verbose_name = "PayPal"
+
+    def ready(self):
+        import debits.paypal.signals  # connects signal handlers
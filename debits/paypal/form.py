@@ -2,8 +2,8 @@ import abc
 import datetime
 from django.urls import reverse
 from debits.debits_base.processors import BasePaymentProcessor
-from debits.debits_base.base import Period
-from debits.debits_base.models import BaseTransaction
+from debits.debits_base.base import Period, get_cache
+from debits.debits_base.models import SubscriptionTransaction
 from django.conf import settings
 
 
@@ -11,8 +11,32 @@ from django.conf import settings
 # https://developer.paypal.com/docs/classic/express-checkout/integration-guide/ECRecurringPayments/
 # You can increase the profile amount by only 20% in each 180-day interval after you create the profile.
 
+ITEM_CACHE_VERSION = 2
+"""Increase it when the format of cached form fields changes."""
+
+
+def item_cache_key(item_pk, subscription):
+    """Internal."""
+    return 'debits.paypal.form:%d:%d:%s' % (ITEM_CACHE_VERSION, item_pk, 's' if subscription else 'r')
+
+
+def invalidate_item_cache(*item_pks):
+    """Remove cached PayPal form fields of the given items.
+
+    It is called automatically when an item or a product is saved or deleted."""
+    get_cache().delete_many([item_cache_key(pk, subscription) for pk in item_pks for subscription in (False, True)])
+
+
 class PayPalForm(BasePaymentProcessor):
     """Base class for processing submit of a PayPal form."""
+
+    item_cache_timeout = 3600
+    """How long (in seconds) to cache the form fields which depend only on the item
+    (prices and periods, but not :meth:`product_name`, which may depend on the purchase).
+
+    The cache helps when many purchases share an item. Set it to zero to disable caching
+    (for example, if every purchase has its own item)."""
+
     @classmethod
     def ipn_url(cls):
         return settings.IPN_HOST + reverse(cls.ipn_name())
@@ -25,32 +49,77 @@ class PayPalForm(BasePaymentProcessor):
     def amend_hash_new_purchase(self, transaction, hash):
         # https://developer.paypal.com/docs/classic/paypal-payments-standard/integration-guide/Appx_websitestandard_htmlvariables/
 
-        cart = hash.pop('arcamens_cart', transaction.purchase.is_aggregate)
-
-        items = self.init_items(transaction)
+        purchase = transaction.purchase
+        cart = hash.pop('arcamens_cart', purchase.is_aggregate)
         # if transaction.purchase.item.is_subscription():
-        if hasattr(transaction, 'subscriptiontransaction'):
-            self.make_subscription(items, transaction, transaction.purchase)
+        subscription = isinstance(transaction, SubscriptionTransaction) or \
+            hasattr(transaction, 'subscriptiontransaction')
+
+        items = self.init_items(subscription)
+        if cart and not subscription:  # a subscription is never paid as a cart
+            self.make_cart(items, purchase)
         else:
-            self.make_regular(items, transaction, transaction.purchase, cart)
+            items.update(self.item_items(purchase, subscription))
+            self.make_purchase_items(items, purchase, subscription)
+        items['custom'] = transaction.custom()
+        items['invoice'] = transaction.invoice_id()
 
         items.update(hash)
         items['bn'] = 'Arcamens_SP_EC'  # we don't want this token be changed without changing the code
         return items
 
-    def init_items(self, transaction):
+    def init_items(self, subscription):
+        """Internal.
+
+        The fields which depend neither on the item nor on the transaction (not cached,
+        as they depend on settings and on :meth:`ipn_url`)."""
         debug = settings.PAYPAL_DEBUG
         url = 'https://www.sandbox.paypal.com' if debug else 'https://www.paypal.com'
         return {'business': settings.PAYPAL_ID,
                 'arcamens_action': url + "/cgi-bin/webscr",
-                'cmd': "_xclick-subscriptions" if hasattr(transaction, 'subscriptiontransaction') else "_xclick",
-                'notify_url': self.ipn_url(),
-                'custom': BaseTransaction.custom_from_pk(transaction.pk),
-                'invoice': transaction.invoice_id()}
+                'cmd': "_xclick-subscriptions" if subscription else "_xclick",
+                'notify_url': self.ipn_url()}
 
-    def make_subscription(self, items, transaction, purchase):
+    def item_items(self, purchase, subscription):
+        """Internal.
+
+        The fields which depend only on the item (cached for :attr:`item_cache_timeout` seconds).
+        Don't modify the returned dict."""
+        if not self.item_cache_timeout:
+            return self.make_item_items(purchase, subscription)
+        cache = get_cache()
+        key = item_cache_key(purchase.item_id, subscription)
+        items = cache.get(key)
+        if items is None:
+            items = self.make_item_items(purchase, subscription)
+            cache.set(key, items, self.item_cache_timeout)
+        return items
+
+    def make_item_items(self, purchase, subscription):
+        """Internal."""
+        items = {}
+        if subscription:
+            self.make_subscription(items, purchase)
+        else:
+            self.make_regular(items, purchase)
+        return items
+
+    def make_purchase_items(self, items, purchase, subscription):
+        """Internal.
+
+        Adds the fields which depend on the purchase (not only on its item)."""
+        if subscription:
+            items['item_name'] = self.product_name(purchase)
+        else:
+            items['item_name'] = self.product_name(purchase)[0:127]
+        if subscription:
+            items['a3'] += purchase.shipping + purchase.tax  # make_subscription() sets it to the item price
+        else:
+            items['shipping'] = purchase.shipping
+            items['tax'] = purchase.tax
+
+    def make_subscription(self, items, purchase):
         """Internal."""
-        items['item_name'] = self.product_name(purchase)
         items['src'] = 1
 
         unit_map = {Period.UNIT_DAYS: 'D',
@@ -61,28 +130,26 @@ class PayPalForm(BasePaymentProcessor):
             items['a1'] = 0
             items['p1'] = purchase.item.subscriptionitem.trial_period.count
             items['t1'] = unit_map[purchase.item.subscriptionitem.trial_period.unit]
-        items['a3'] = purchase.item.price + purchase.shipping + purchase.tax
+        items['a3'] = purchase.item.price
         items['p3'] = purchase.item.subscriptionitem.payment_period.count
         items['t3'] = unit_map[purchase.item.subscriptionitem.payment_period.unit]
 
-    def make_regular(self, items, transaction, purchase, cart):
+    def make_regular(self, items, purchase):
         """Internal."""
-        if cart:
-            items['upload'] = 1
-            i = 1
-            for child in purchase.aggregatepurchase.childs.order_by('pk') if purchase.is_aggregate else [purchase]:
-                items['item_name_' + str(i)] = self.product_name(child)
-                items['amount_' + str(i)] = child.item.price
-                items['shipping_' + str(i)] = child.shipping
-                items['tax_' + str(i)] = child.tax
-                items['quantity_' + str(i)] = child.item.product_qty
-                i += 1
-        else:
-            items['item_name'] = self.product_name(purchase)[0:127]
-            items['amount'] = purchase.item.price
-            items['shipping'] = purchase.shipping
-            items['tax'] = purchase.tax
-            items['quantity'] = purchase.item.product_qty
+        items['amount'] = purchase.item.price
+        items['quantity'] = purchase.item.product_qty
+
+    def make_cart(self, items, purchase):
+        """Internal."""
+        items['upload'] = 1
+        i = 1
+        for child in purchase.aggregatepurchase.childs.order_by('pk') if purchase.is_aggregate else [purchase]:
+            items['item_name_' + str(i)] = self.product_name(child)
+            items['amount_' + str(i)] = child.item.price
+            items['shipping_' + str(i)] = child.shipping
+            items['tax_' + str(i)] = child.tax
+            items['quantity_' + str(i)] = child.item.product_qty
+            i += 1
 
     def subscription_allowed_date(self, purchase):
         return max(datetime.date.today(),
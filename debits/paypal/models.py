@@ -1,4 +1,6 @@
+import asyncio
 import json
+import weakref
 
 import requests
 from dateutil.relativedelta import relativedelta
@@ -9,11 +11,37 @@ try:
     from html import escape  # python 3.x
 except ImportError:
     from cgi import escape  # python 2.x
+from django.core.exceptions import ImproperlyConfigured
 from django.db import models
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 from debits.debits_base.models import logger, CannotCancelSubscription, CannotRefund
 
+try:
+    import httpx
+except ImportError:  # needed only for async code
+    httpx = None
+
+
+# One client (with its connection pool) per event loop.
+_http_clients = weakref.WeakKeyDictionary()
+
+
+def http_client():
+    """Internal.
+
+    The shared :class:`httpx.AsyncClient` of the running event loop."""
+    if httpx is None:
+        raise ImproperlyConfigured("Async PayPal code requires httpx.")
+    loop = asyncio.get_running_loop()
+    client = _http_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=getattr(settings, 'PAYPAL_HTTP_TIMEOUT', 30),
+            limits=httpx.Limits(max_connections=getattr(settings, 'PAYPAL_HTTP_MAX_CONNECTIONS', 100)))
+        _http_clients[loop] = client
+    return client
+
 
 class PayPalProcessorInfo(models.Model):
     class Meta:
@@ -23,6 +51,9 @@ class PayPalProcessorInfo(models.Model):
     def api(self):
         return PayPalAPI()
 
+    async def async_api(self):
+        return await AsyncPayPalAPI.create()
+
     @staticmethod
     def offset_date(date, offset):
         """Used to calculate the next recurring payment date."""
@@ -43,10 +74,9 @@ class PayPalAPI(object):
 
     def __init__(self):
         """Creates a HTTP session to access PayPal API."""
-        debug = settings.PAYPAL_DEBUG
-        self.server = 'https://api.sandbox.paypal.com' if debug else 'https://api.paypal.com'
+        self.server = PayPalAPI.api_server()
         s = requests.Session()
-        s.headers.update({'Accept': 'application/json', 'Accept-Language': 'en_US'})
+        s.headers.update(PayPalAPI.HEADERS)
         r = s.post(self.server + '/v1/oauth2/token',
                    data='grant_type=client_credentials',
                    headers={'content-type': 'application/x-www-form-urlencoded'},
@@ -55,6 +85,15 @@ class PayPalAPI(object):
         s.headers.update({'Authorization': 'Bearer '+token})
         self.session = s
 
+    HEADERS = {'Accept': 'application/json', 'Accept-Language': 'en_US'}
+    """Internal."""
+
+    @staticmethod
+    def api_server():
+        """Internal."""
+        debug = settings.PAYPAL_DEBUG
+        return 'https://api.sandbox.paypal.com' if debug else 'https://api.paypal.com'
+
     def cancel_agreement(self, agreement_id, is_upgrade=False):
         """Cancels a PayPal recurring payment."""
         note = _("Upgrading billing plan") if is_upgrade else _("Canceling a service")
@@ -89,3 +128,57 @@ class PayPalAPI(object):
     #     r = self.session.get(self.server + ('/v1/payments/billing-agreements/%s' % escape(agreement_id)),
     #                          headers={'content-type': 'application/json'})
     #     # ...
+
+
+class AsyncPayPalAPI(object):
+    """Async version of :class:`PayPalAPI` (requires `httpx`).
+
+    Create it by :meth:`create`."""
+
+    def __init__(self, server, token):
+        """Internal."""
+        self.server = server
+        self.headers = dict(PayPalAPI.HEADERS, Authorization='Bearer '+token)
+
+    @staticmethod
+    async def create():
+        """Logs in into PayPal API."""
+        server = PayPalAPI.api_server()
+        r = await http_client().post(server + '/v1/oauth2/token',
+                                     content='grant_type=client_credentials',
+                                     headers=dict(PayPalAPI.HEADERS,
+                                                  **{'content-type': 'application/x-www-form-urlencoded'}),
+                                     auth=(settings.PAYPAL_CLIENT_ID, settings.PAYPAL_SECRET))
+        return AsyncPayPalAPI(server, r.json()["access_token"])
+
+    async def post(self, path, data):
+        """Internal."""
+        return await http_client().post(self.server + path,
+                                        content=data,
+                                        headers=dict(self.headers, **{'content-type': 'application/json'}))
+
+    async def cancel_agreement(self, agreement_id, is_upgrade=False):
+        """Cancels a PayPal recurring payment."""
+        note = _("Upgrading billing plan") if is_upgrade else _("Canceling a service")
+        logger.debug("PayPal: now canceling agreement %s" % escape(agreement_id))
+        r = await self.post('/v1/payments/billing-agreements/%s/cancel' % escape(agreement_id),
+                            '{"note": "%s"}' % note)
+        if r.status_code < 200 or r.status_code >= 300:  # PayPal returns 204, to be sure
+            # Don't include secret information into the message
+            raise CannotCancelSubscription(r.json()["message"])
+
+    async def refund(self, transaction_id, sum=None, currency='USD'):
+        """Refunds a PayPal payment."""
+        logger.debug("PayPal: now refunding transaction %s" % escape(transaction_id))
+        data = {}
+        if sum is not None:
+            data['amount'] = {'total': sum, 'currency': currency}
+        r = await self.post('/v1/payments/sale/%s/refund' % escape(transaction_id), json.dumps(data))
+        if r.status_code < 200 or r.status_code >= 300:  # PayPal returns 204, to be sure
+            # Don't include secret information into the message
+            raise CannotRefund(r.json()["message"])
+
+
+class CannotVerifyWebhook(Exception):
+    """The signature of a PayPal webhook event is wrong or cannot be checked."""
+    pass
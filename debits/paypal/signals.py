@@ -0,0 +1,17 @@
+from debits.debits_base.models import Item, Product
+from debits.debits_base.signals import connect_changed, for_product_items
+from debits.paypal.form import invalidate_item_cache
+
+
+def on_item_changed(sender, instance, **kwargs):
+    """Invalidate the cached PayPal form fields of a changed item."""
+    invalidate_item_cache(instance.pk)
+
+
+def on_product_changed(sender, instance, **kwargs):
+    """Invalidate the cached PayPal form fields of all items of a changed product."""
+    for_product_items(instance, invalidate_item_cache)
+
+
+connect_changed(on_item_changed, Item)
+connect_changed(on_product_changed, Product)
@@ -1,17 +1,26 @@
+import hashlib
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 import datetime
 import requests
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from django.db.models import F
 from django.utils import timezone
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotAllowed
 from django.utils.decorators import method_decorator
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 
 from debits.debits_base.processors import PaymentCallback, PAYMENT_PROCESSOR_PAYPAL
-from debits.debits_base.base import logger
+from debits.debits_base.base import logger, get_cache
+from debits.debits_base.routers import use_primary
+from debits.debits_base.loader import load_transaction
+from debits.debits_base.locks import purchase_lock
 from debits.debits_base.models import BaseTransaction, SimpleTransaction, SubscriptionTransaction, AutomaticPayment, \
-    SubscriptionPurchase
+    SubscriptionPurchase, DailyRollup, processor_registry, after_commit
 from debits.debits_base.base import Period
 from django.conf import settings
 
@@ -52,7 +61,7 @@ from django.conf import settings
 
 
 # Internal.
-from debits.paypal.models import PayPalAPI, PayPalProcessorInfo
+from debits.paypal.models import PayPalProcessorInfo, http_client
 
 MONTHS = [
     'Jan', 'Feb', 'Mar', 'Apr',
@@ -96,7 +105,8 @@ class PayPalIPN(PaymentCallback, View):
     # for all kinds of IPN for recurring payments.
     def post(self, request):
         try:
-            self.do_post(request)
+            with use_primary():
+                self.do_post(request)
         except KeyError as e:
             logger.warning("PayPal IPN var %s is missing" % e)
         except:
@@ -111,15 +121,42 @@ class PayPalIPN(PaymentCallback, View):
         else:
             logger.warning("Wrong PayPal email")
 
-    def do_do_post(self, POST, request):
+    @staticmethod
+    def verification_request(POST, request):
+        """The URL, the body and the headers of the `_notify-validate` postback."""
         debug = settings.PAYPAL_DEBUG
         url = 'https://www.sandbox.paypal.com' if debug else 'https://www.paypal.com'
-        r = requests.post(url + '/cgi-bin/webscr',
-                          'cmd=_notify-validate&' + request.body.decode(
-                              POST.get('charset') or request.content_params['charset']),
-                          headers={
-                              'content-type': request.content_type})  # message must use the same encoding as the original
+        return (url + '/cgi-bin/webscr',
+                'cmd=_notify-validate&' + request.body.decode(
+                    POST.get('charset') or request.content_params['charset']),
+                {'content-type': request.content_type})  # message must use the same encoding as the original
+
+    @staticmethod
+    def verified_cache_key(POST, request):
+        """The cache key of a verified IPN (`None` if it is not cached).
+
+        PayPal resends an IPN with the same `ipn_track_id`, and it is the same IPN only
+        if the body is also the same."""
+        if 'ipn_track_id' not in POST:
+            return None
+        return 'debits.paypal.ipn:%s:%s' % (hashlib.sha256(POST['ipn_track_id'].encode('utf-8')).hexdigest(),
+                                              hashlib.sha256(request.body).hexdigest())
+
+    @staticmethod
+    def verified_cache_timeout():
+        """Internal."""
+        return getattr(settings, 'PAYPAL_IPN_VERIFIED_CACHE_TIMEOUT', 86400)
+
+    def do_do_post(self, POST, request):
+        key = self.verified_cache_key(POST, request)
+        if key is not None and get_cache().get(key):
+            self.verified_post(POST, request)
+            return
+        url, data, headers = self.verification_request(POST, request)
+        r = requests.post(url, data, headers=headers)
         if r.text == 'VERIFIED':
+            if key is not None:
+                get_cache().set(key, True, self.verified_cache_timeout())
             self.verified_post(POST, request)
         else:
             logger.warning("PayPal verification not passed")
@@ -127,8 +164,30 @@ class PayPalIPN(PaymentCallback, View):
     def verified_post(self, POST, request):
         # print('custom', POST['custom'])  # Don't print sensitive data
         # As of 4 May 2020 in PayPal there is not `custom` in unsubscription notification
-        transaction_id = BaseTransaction.pk_from_custom(POST['custom']) if 'custom' in POST else None
-        self.on_transaction_complete(POST, transaction_id)
+        ref = POST.get('recurring_payment_id') or POST.get('subscr_id')
+        if 'custom' in POST:
+            transaction_id = BaseTransaction.pk_from_custom_or_create(POST['custom'], PAYMENT_PROCESSOR_PAYPAL)
+        elif 'invoice' in POST:
+            try:
+                transaction_id = BaseTransaction.pk_from_invoice(POST['invoice'])
+            except BaseTransaction.DoesNotExist:
+                if ref is None:
+                    raise
+                transaction_id = None  # found by `ref`, for example a transaction without stored invoice
+        else:
+            transaction_id = None
+        with purchase_lock(self.purchase_id(transaction_id, ref)):
+            self.on_transaction_complete(POST, transaction_id)
+
+    @staticmethod
+    def purchase_id(transaction_id, subscription_reference):
+        """The PK of the purchase of an IPN (for locking) or `None` if unknown."""
+        if transaction_id is not None:
+            return BaseTransaction.objects.filter(pk=transaction_id).values_list('purchase_id', flat=True).first()
+        if subscription_reference is not None:
+            return SubscriptionPurchase.objects.filter(subscription_reference=subscription_reference).\
+                values_list('pk', flat=True).first()
+        return None
 
     def on_transaction_complete(self, POST, transaction_id):
         # Crazy: Recurring payment and subscription payments are not the same.
@@ -155,7 +214,7 @@ class PayPalIPN(PaymentCallback, View):
 
     def do_appect_refund(self, POST, transaction_id):
         try:
-            transaction = BaseTransaction.objects.get(pk=transaction_id)
+            transaction = load_transaction(BaseTransaction, transaction_id)
         except BaseTransaction.DoesNotExist:
             traceback.print_exc()
             return
@@ -174,7 +233,7 @@ class PayPalIPN(PaymentCallback, View):
 
     def do_do_accept_regular_payment(self, POST, transaction_id):
         try:
-            transaction = SimpleTransaction.objects.get(pk=transaction_id)
+            transaction = load_transaction(SimpleTransaction, transaction_id)
         except BaseTransaction.DoesNotExist:
             traceback.print_exc()
             return
@@ -185,7 +244,7 @@ class PayPalIPN(PaymentCallback, View):
             if self.auto_refund(transaction, transaction.purchase.simplepurchase.prolongpurchase.prolonged, POST):
                 return HttpResponse('')
             payment = transaction.on_accept_regular_payment(POST['payer_email'])
-            self.on_payment(payment)
+            after_commit(self.on_payment, payment)
         else:
             logger.warning("Wrong amount or currency")
 
@@ -197,13 +256,13 @@ class PayPalIPN(PaymentCallback, View):
     def do_accept_recurring_payment(self, POST, transaction_id):
         # transaction = BaseTransaction.objects.select_for_update().get(pk=transaction_id)  # only inside transaction
         try:
-            transaction = SubscriptionTransaction.objects.get(pk=transaction_id)
+            transaction = load_transaction(SubscriptionTransaction, transaction_id)
         except BaseTransaction.DoesNotExist:
             traceback.print_exc()
             return
-        if Decimal(POST['amount_per_cycle']) == transaction.purchase.item.price + transaction.purchase.item.shipping + transaction.purchase.item.tax and \
+        if Decimal(POST['amount_per_cycle']) == transaction.purchase.item.price + transaction.purchase.shipping + transaction.purchase.tax and \
                         POST['payment_cycle'] in self.pp_payment_cycles(transaction.purchase.item):
-            self.do_do_accept_subscription_or_recurring_payment(transaction, transaction.purchase.item, POST, POST['recurring_payment_id'])
+            self.do_do_accept_subscription_or_recurring_payment(transaction, transaction.purchase, POST, POST['recurring_payment_id'])
         else:
             logger.warning("Wrong recurring payment data")
 
@@ -215,20 +274,24 @@ class PayPalIPN(PaymentCallback, View):
     def do_do_accept_subscription_or_recurring_payment(self, transaction, purchase, POST, ref):
         if self.auto_refund(transaction, purchase, POST):
             return HttpResponse('')
-        purchase.subscriptionpurchase.activate_subscription(ref, POST['payer_email'], PAYMENT_PROCESSOR_PAYPAL)
-        # This is already done in activate_subscription():
+        # If the payment IPN comes before the signup IPN, it does the activation (see activated()).
+        activated = purchase.subscriptionpurchase.activate_subscription(ref, POST['payer_email'],
+                                                                        PAYMENT_PROCESSOR_PAYPAL)
         payment = AutomaticPayment.objects.create(transaction=transaction,
                                                   email=POST['payer_email'],
                                                   subscription_reference=ref,
                                                   processor_id=PAYMENT_PROCESSOR_PAYPAL)
-        purchase.payment = payment
+        DailyRollup.record(purchase, payments=1, revenue=DailyRollup.amount(purchase))
+        purchase.subscriptionpurchase.payment = payment
         self.do_subscription_or_recurring_payment(purchase.subscriptionpurchase)  # calls save()
-        self.on_payment(transaction.payment.automaticpayment)
+        if activated:
+            self.activated(purchase.subscriptionpurchase, POST)
+        after_commit(self.on_payment, payment)
 
     def do_accept_subscription_payment(self, POST, transaction_id):
         # transaction = BaseTransaction.objects.select_for_update().get(pk=transaction_id)  # only inside transaction
         try:
-            transaction = SubscriptionTransaction.objects.get(pk=transaction_id)
+            transaction = load_transaction(SubscriptionTransaction, transaction_id)
         except BaseTransaction.DoesNotExist:
             traceback.print_exc()
             return
@@ -241,13 +304,15 @@ class PayPalIPN(PaymentCallback, View):
 
     def do_subscription_or_recurring_payment(self, purchase):
         # transaction.processor = PaymentProcessor.objects.get(pk=PAYMENT_PROCESSOR_PAYPAL)
-        purchase.trial = False
-        date = purchase.due_payment_date
-        if purchase.item.subscriptionitem.payment_period.count > 0:  # hack to eliminate infinite loop
-            while date <= datetime.date.today():
-                date = self.advance_item_date(date, purchase)
-        purchase.due_payment_date = date
-        purchase.save()
+        def change(purchase):
+            purchase.trial = False
+            date = purchase.due_payment_date
+            if purchase.item.subscriptionitem.payment_period.count > 0:  # hack to eliminate infinite loop
+                while date <= datetime.date.today():
+                    date = self.advance_item_date(date, purchase)
+            purchase.due_payment_date = date
+        purchase.update_dates(change)
+        purchase.save()  # other changed fields
 
     def advance_item_date(self, date, purchase):
         date = PayPalProcessorInfo.offset_date(date, purchase.item.subscriptionitem.payment_period)
@@ -257,18 +322,28 @@ class PayPalIPN(PaymentCallback, View):
 
     def do_subscription_or_recurring_created(self, transaction, POST, ref):
         purchase = transaction.purchase.subscriptionpurchase
-        purchase.activate_subscription(ref, POST['payer_email'], PAYMENT_PROCESSOR_PAYPAL)
+        if not purchase.activate_subscription(ref, POST['payer_email'], PAYMENT_PROCESSOR_PAYPAL):
+            return  # already activated by a payment IPN
         # transaction.processor = PaymentProcessor.objects.get(pk=PAYMENT_PROCESSOR_PAYPAL)
-        SubscriptionPurchase.objects.filter(pk=purchase.pk).update(trial=False)
+        purchase.trial = False
+        purchase.reschedule()
+        SubscriptionPurchase.objects.filter(pk=purchase.pk).update(trial=False, version=F('version') + 1,
+                                                                   **purchase.schedule_fields())
+        purchase.refresh_from_db(fields=['trial', 'next_action', 'next_action_at', 'version'])
+        self.activated(purchase, POST)
+
+    def activated(self, purchase, POST):
+        """The part of the activation of a subscription done once, by either signup or payment IPN,
+        whichever comes first (IPNs of a purchase are serialized by :func:`~debits.debits_base.locks.purchase_lock`)."""
         purchase.upgrade_subscription()
-        self.on_subscription_created(POST, purchase)
+        after_commit(self.on_subscription_created, POST, purchase)
 
     def accept_subscription_signup(self, POST, transaction_id):
         self.do_accept_subscription_signup(POST, transaction_id)
 
     def do_accept_subscription_signup(self, POST, transaction_id):
         try:
-            transaction = SubscriptionTransaction.objects.get(pk=transaction_id)
+            transaction = load_transaction(SubscriptionTransaction, transaction_id)
         except BaseTransaction.DoesNotExist:
             traceback.print_exc()
             return
@@ -292,7 +367,7 @@ class PayPalIPN(PaymentCallback, View):
 
     def accept_recurring_signup(self, POST, transaction_id):
         try:
-            transaction = SubscriptionTransaction.objects.get(pk=transaction_id)
+            transaction = load_transaction(SubscriptionTransaction, transaction_id)
         except BaseTransaction.DoesNotExist:
             traceback.print_exc()
             return
@@ -304,10 +379,10 @@ class PayPalIPN(PaymentCallback, View):
         else:
             logger.warning("Wrong recurring signup data")
 
-    def accept_recurring_canceled(self, POST, subscription_reference):
-        self.do_accept_recurring_canceled(POST, subscription_reference)
+    def accept_recurring_canceled(self, POST, transaction_id):
+        self.do_accept_recurring_canceled(POST, transaction_id)
 
-    def do_accept_recurring_canceled(self, POST, subscription_reference):
+    def do_accept_recurring_canceled(self, POST, transaction_id):
         # try:
         #     transaction = SubscriptionTransaction.objects.get(pk=transaction_id)
         # except BaseTransaction.DoesNotExist:
@@ -316,18 +391,21 @@ class PayPalIPN(PaymentCallback, View):
         #     return
         # transaction.purchase.subscriptionpurchase.cancel_subscription()
         # self.on_subscription_canceled(POST, transaction.purchase)
-        subscription_reference = getattr(POST, 'recurring_payment_id', POST['subscr_id'])
-        subscriptionpurchase = SubscriptionPurchase.objects.get(subscription_reference=subscription_reference)
+        subscription_reference = POST.get('recurring_payment_id') or POST['subscr_id']
+        q = SubscriptionPurchase.objects.filter(subscription_reference=subscription_reference)
+        if transaction_id is not None:
+            q = q.filter(transactions=transaction_id)
+        subscriptionpurchase = q.get()
         subscriptionpurchase.cancel_subscription()
-        self.on_subscription_canceled(POST, subscriptionpurchase.purchase)
+        after_commit(self.on_subscription_canceled, POST, subscriptionpurchase)
 
     def auto_refund(self, transaction, purchase, POST):
         # "purchase" is SubscriptionItem
         if self.should_auto_refund():
-            api = PayPalAPI()
+            api = processor_registry.api(PAYMENT_PROCESSOR_PAYPAL)
             # FIXME: Wrong for American Express card: https://www.paypal.com/us/selfhelp/article/How-do-I-issue-a-full-or-partial-refund-FAQ780
             amount = (transaction.purchase.item.price - Decimal(0.30)).quantize(Decimal('1.00'))
-            api.refund(POST['txn_id'], str(amount))
+            after_commit(api.refund, POST['txn_id'], str(amount))
             return True
         return False
 
@@ -353,3 +431,78 @@ class PayPalIPN(PaymentCallback, View):
             return (first, second)
         else:
             return (first,)
+
+
+_ipn_executor = None
+_ipn_executor_lock = threading.Lock()
+
+
+def ipn_executor():
+    """Internal.
+
+    The pool of threads processing IPNs of :class:`AsyncPayPalIPN` in the DB (created on the first use)."""
+    global _ipn_executor
+    with _ipn_executor_lock:
+        if _ipn_executor is None:
+            _ipn_executor = ThreadPoolExecutor(max_workers=getattr(settings, 'PAYMENTS_IPN_DB_THREADS', 10),
+                                               thread_name_prefix='debits-ipn')
+        return _ipn_executor
+
+
+class AsyncPayPalIPN(PayPalIPN):
+    """Like :class:`PayPalIPN`, but for ASGI: it does not hold a thread while PayPal verifies an IPN.
+
+    The postback is sent by the shared `httpx` client, and the DB work runs in a bounded
+    pool of `settings.PAYMENTS_IPN_DB_THREADS` (10 by default) threads.
+
+    Combine it with your callbacks class: ``class MyAsyncIPN(AsyncPayPalIPN, MyPayPalIPN)``.
+    :meth:`as_view` returns an ``async def`` function view (Django before 4.1 does not
+    support async methods of class-based views).
+
+    All its methods are considered internal."""
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        async def view(request, *args, **kwargs):
+            if request.method != 'POST':
+                return HttpResponseNotAllowed(['POST'])
+            return await cls(**initkwargs).async_post(request)
+        view.view_class = cls
+        view.view_initkwargs = initkwargs
+        view.csrf_exempt = True  # not csrf_exempt(), its wrapper is not a coroutine function
+        return view
+
+    async def async_post(self, request):
+        try:
+            await self.async_do_post(request)
+        except KeyError as e:
+            logger.warning("PayPal IPN var %s is missing" % e)
+        except Exception:
+            logger.exception("Cannot process PayPal IPN")
+        return HttpResponse('', content_type="text/plain")
+
+    async def async_do_post(self, request):
+        POST = request.POST
+        if POST['receiver_email'] != settings.PAYPAL_EMAIL:
+            logger.warning("Wrong PayPal email")
+            return
+        key = self.verified_cache_key(POST, request)
+        verified = key is not None and await sync_to_async(get_cache().get, thread_sensitive=False)(key)
+        if not verified:
+            url, data, headers = self.verification_request(POST, request)
+            r = await http_client().post(url, content=data, headers=headers)
+            verified = r.text == 'VERIFIED'
+            if verified and key is not None:
+                await sync_to_async(get_cache().set, thread_sensitive=False)(key, True, self.verified_cache_timeout())
+        if verified:
+            await sync_to_async(self.db_post, thread_sensitive=False, executor=ipn_executor())(POST, request)
+        else:
+            logger.warning("PayPal verification not passed")
+
+    def db_post(self, POST, request):
+        close_old_connections()
+        try:
+            with use_primary():
+                self.verified_post(POST, request)
+        finally:
+            close_old_connections()
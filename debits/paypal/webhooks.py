@@ -0,0 +1,326 @@
+"""PayPal REST webhooks.
+
+Events are verified locally: the signature is checked against PayPal's signing certificate,
+which is downloaded once, validated up to a trusted CA and then cached in memory and on disk,
+so that (unlike IPN) no request to PayPal is needed for an event.
+
+Set `settings.PAYPAL_WEBHOOK_ID` to the ID of the webhook registered at PayPal
+and `settings.PAYPAL_WEBHOOK_CERT_DIR` to a directory for the certificates.
+It requires `cryptography` (42 or newer)."""
+
+import base64
+import binascii
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import zlib
+from decimal import Decimal
+from urllib.parse import urlparse
+
+import requests
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponse
+from django.utils.dateparse import parse_datetime
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
+
+from debits.debits_base.base import logger, get_cache
+from debits.debits_base.models import BaseTransaction, SubscriptionTransaction, SubscriptionPurchase
+from debits.debits_base.processors import PAYMENT_PROCESSOR_PAYPAL
+from debits.debits_base.routers import use_primary
+from debits.debits_base.loader import load_transaction
+from debits.debits_base.locks import purchase_lock
+from debits.paypal.models import CannotVerifyWebhook
+from debits.paypal.views import PayPalIPN
+
+try:
+    from cryptography import x509
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+    from cryptography.x509.verification import PolicyBuilder, Store, VerificationError
+except ImportError:  # needed only for webhooks
+    x509 = None
+
+
+class CertificateCache(object):
+    """PayPal signing certificates by their URLs.
+
+    Downloaded certificates are stored in `settings.PAYPAL_WEBHOOK_CERT_DIR` (which must be owned
+    by the user of the process and not writable by others) and kept in memory.
+    Every certificate (read from the disk or downloaded) is validated up to a CA of
+    `settings.PAYPAL_WEBHOOK_CA_FILE` (by default, the CA bundle of `requests`)
+    for the name `settings.PAYPAL_WEBHOOK_CERT_NAME`.
+    Use the :data:`certificate_cache` instance."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.certificates = {}
+
+    @staticmethod
+    def directory():
+        """Internal."""
+        directory = getattr(settings, 'PAYPAL_WEBHOOK_CERT_DIR', None)
+        if not directory:
+            raise ImproperlyConfigured("PayPal webhooks require settings.PAYPAL_WEBHOOK_CERT_DIR.")
+        return directory
+
+    def path(self, url):
+        """Internal."""
+        return os.path.join(self.directory(), hashlib.sha256(url.encode('utf-8')).hexdigest() + '.pem')
+
+    @staticmethod
+    def check_url(url):
+        """Internal.
+
+        Accept only certificates downloaded from PayPal by HTTPS."""
+        parsed = urlparse(url)
+        if parsed.scheme != 'https' or not (parsed.hostname or '').endswith('.paypal.com'):
+            raise CannotVerifyWebhook("Wrong certificate URL")
+
+    @staticmethod
+    def check_owner(path):
+        """Internal.
+
+        Refuses a file or directory which other users could have written."""
+        st = os.stat(path)
+        if st.st_uid != os.geteuid() or st.st_mode & 0o022:
+            raise CannotVerifyWebhook("%s is not owned by us or writable by others" % path)
+
+    @staticmethod
+    def cert_name():
+        """Internal."""
+        default = 'messageverificationcerts.sandbox.paypal.com' if settings.PAYPAL_DEBUG \
+            else 'messageverificationcerts.paypal.com'
+        return getattr(settings, 'PAYPAL_WEBHOOK_CERT_NAME', default)
+
+    @staticmethod
+    def ca_file():
+        """Internal."""
+        return getattr(settings, 'PAYPAL_WEBHOOK_CA_FILE', None) or requests.certs.where()
+
+    def validate(self, pem):
+        """Internal.
+
+        Returns the signing certificate of a PEM chain (the first one) if the chain is valid."""
+        try:
+            chain = x509.load_pem_x509_certificates(pem)
+        except ValueError:
+            raise CannotVerifyWebhook("Wrong certificate")
+        with open(self.ca_file(), 'rb') as f:
+            store = Store(x509.load_pem_x509_certificates(f.read()))
+        verifier = PolicyBuilder().store(store).build_server_verifier(x509.DNSName(self.cert_name()))
+        try:
+            verifier.verify(chain[0], chain[1:])
+        except VerificationError as e:
+            raise CannotVerifyWebhook("Untrusted certificate: %s" % e)
+        return chain[0]
+
+    def get(self, url):
+        """The certificate (:class:`cryptography.x509.Certificate`) at `url`."""
+        with self.lock:
+            certificate = self.certificates.get(url)
+        if certificate is None:
+            self.check_url(url)
+            pem = self.read(url)
+            if pem is None:
+                pem = self.fetch(url)
+            certificate = self.validate(pem)
+            with self.lock:
+                self.certificates[url] = certificate
+        return certificate
+
+    def read(self, url):
+        """Internal."""
+        path = self.path(url)
+        try:
+            self.check_owner(os.path.dirname(path))
+            self.check_owner(path)
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def fetch(self, url):
+        """Internal."""
+        logger.debug("PayPal: now downloading certificate %s" % url)
+        r = requests.get(url, timeout=30)
+        if r.status_code != 200:
+            raise CannotVerifyWebhook("Cannot download the certificate")
+        self.validate(r.content)  # don't store garbage
+        path = self.path(url)
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        self.check_owner(os.path.dirname(path))
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')  # mode 0600
+        with os.fdopen(fd, 'wb') as f:
+            f.write(r.content)
+        os.replace(tmp, path)  # atomic, for concurrent processes
+        return r.content
+
+
+certificate_cache = CertificateCache()
+"""The :class:`CertificateCache`."""
+
+
+def check_transmission_time(transmission_time):
+    """Internal.
+
+    Refuses events sent more than `settings.PAYPAL_WEBHOOK_TOLERANCE` (300 by default) seconds ago
+    (or in the future), against replays."""
+    try:
+        sent = parse_datetime(transmission_time)
+    except ValueError:
+        sent = None
+    if sent is None or sent.tzinfo is None:
+        raise CannotVerifyWebhook("Wrong transmission time")
+    now = datetime.datetime.now(datetime.timezone.utc)
+    if abs((now - sent).total_seconds()) > getattr(settings, 'PAYPAL_WEBHOOK_TOLERANCE', 300):
+        raise CannotVerifyWebhook("Transmission time out of tolerance")
+
+
+def transmission_id_key(transmission_id):
+    """Internal."""
+    return 'debits.paypal.webhook:%s' % hashlib.sha256(transmission_id.encode('utf-8')).hexdigest()
+
+
+def check_transmission_id(transmission_id):
+    """Internal.
+
+    Refuses an already seen `Paypal-Transmission-Id` (a replay within the tolerance)."""
+    key = transmission_id_key(transmission_id)
+    if not get_cache().add(key, True, 2 * getattr(settings, 'PAYPAL_WEBHOOK_TOLERANCE', 300)):
+        raise CannotVerifyWebhook("Replayed transmission")
+
+
+def forget_transmission_id(transmission_id):
+    """Internal.
+
+    Lets a transmission which failed to be processed in (when PayPal redelivers it)."""
+    get_cache().delete(transmission_id_key(transmission_id))
+
+
+def verify_webhook(headers, body):
+    """Checks the signature and the transmission time of a webhook event.
+
+    Args:
+        headers: HTTP headers of the request (:attr:`HttpRequest.headers`).
+        body: the request body (bytes).
+
+    Raises :class:`~debits.paypal.models.CannotVerifyWebhook` if it is wrong."""
+    try:
+        transmission_id = headers['Paypal-Transmission-Id']
+        transmission_time = headers['Paypal-Transmission-Time']
+        signature = base64.b64decode(headers['Paypal-Transmission-Sig'], validate=True)
+        cert_url = headers['Paypal-Cert-Url']
+    except KeyError as e:
+        raise CannotVerifyWebhook("Missing header %s" % e)
+    except binascii.Error:
+        raise CannotVerifyWebhook("Wrong signature encoding")
+    if headers.get('Paypal-Auth-Algo', 'SHA256withRSA') != 'SHA256withRSA':
+        raise CannotVerifyWebhook("Unsupported signature algorithm")
+    check_transmission_time(transmission_time)
+    if x509 is None:
+        raise ImproperlyConfigured("PayPal webhooks require cryptography (42 or newer).")
+    certificate = certificate_cache.get(cert_url)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    if not certificate.not_valid_before_utc <= now <= certificate.not_valid_after_utc:
+        raise CannotVerifyWebhook("The certificate is expired")
+    message = '%s|%s|%s|%d' % (transmission_id, transmission_time, settings.PAYPAL_WEBHOOK_ID, zlib.crc32(body))
+    try:
+        certificate.public_key().verify(signature, message.encode('utf-8'), padding.PKCS1v15(), hashes.SHA256())
+    except InvalidSignature:
+        raise CannotVerifyWebhook("Wrong signature")
+    check_transmission_id(transmission_id)  # after the signature, not to let others spend IDs
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class PayPalWebhook(PayPalIPN):
+    """Processes PayPal REST webhook events (Subscriptions API and sales),
+    calling the same handlers and :class:`~debits.debits_base.processors.PaymentCallback` hooks as IPN.
+
+    Combine it with your callbacks class: ``class MyWebhook(PayPalWebhook, MyPayPalIPN)``.
+
+    All its methods are considered internal."""
+
+    def post(self, request):
+        try:
+            verify_webhook(request.headers, request.body)
+        except CannotVerifyWebhook as e:
+            logger.warning("PayPal webhook verification not passed: %s" % e)
+            return HttpResponse('', content_type="text/plain", status=400)
+        try:
+            with use_primary():
+                self.on_event(json.loads(request.body.decode('utf-8')))
+        except KeyError as e:  # a redelivery would not help
+            logger.warning("PayPal webhook var %s is missing" % e)
+        except Exception:
+            logger.exception("Cannot process PayPal webhook event")
+            # PayPal redelivers the event after an error response
+            forget_transmission_id(request.headers['Paypal-Transmission-Id'])
+            return HttpResponse('', content_type="text/plain", status=500)
+        return HttpResponse('', content_type="text/plain")
+
+    def on_event(self, event):
+        handler = {
+            'BILLING.SUBSCRIPTION.ACTIVATED': self.on_subscription_activated_event,
+            'BILLING.SUBSCRIPTION.CANCELLED': self.on_subscription_canceled_event,
+            'BILLING.SUBSCRIPTION.SUSPENDED': self.on_subscription_canceled_event,
+            'BILLING.SUBSCRIPTION.EXPIRED': self.on_subscription_canceled_event,
+            'PAYMENT.SALE.COMPLETED': self.on_sale_completed_event,
+            'PAYMENT.SALE.REFUNDED': self.on_sale_refunded_event,
+        }.get(event['event_type'])
+        if handler is not None:
+            resource = event['resource']
+            with purchase_lock(self.event_purchase_id(resource)):
+                handler(resource)
+
+    def event_purchase_id(self, resource):
+        custom = resource.get('custom_id') or resource.get('custom')
+        if custom:
+            return self.purchase_id(BaseTransaction.pk_from_custom_or_create(custom, PAYMENT_PROCESSOR_PAYPAL), None)
+        return self.purchase_id(None, resource.get('billing_agreement_id') or resource.get('id'))
+
+    def on_subscription_activated_event(self, resource):
+        transaction_id = BaseTransaction.pk_from_custom_or_create(resource['custom_id'], PAYMENT_PROCESSOR_PAYPAL)
+        transaction = load_transaction(SubscriptionTransaction, transaction_id)
+        POST = {'payer_email': resource.get('subscriber', {}).get('email_address'), 'subscr_id': resource['id']}
+        self.do_subscription_or_recurring_created(transaction, POST, resource['id'])
+
+    def on_subscription_canceled_event(self, resource):
+        self.do_accept_recurring_canceled({'recurring_payment_id': resource['id']}, None)
+
+    def on_sale_completed_event(self, resource):
+        amount = resource['amount']
+        if 'billing_agreement_id' in resource:
+            ref = resource['billing_agreement_id']
+            if resource.get('custom'):
+                transaction = load_transaction(SubscriptionTransaction, BaseTransaction.pk_from_custom_or_create(
+                    resource['custom'], PAYMENT_PROCESSOR_PAYPAL))
+            else:
+                purchase = SubscriptionPurchase.objects.get(subscription_reference=ref)
+                transaction = SubscriptionTransaction.objects.filter(purchase=purchase).latest('pk')
+            purchase = transaction.purchase
+            if Decimal(amount['total']) == purchase.item.price + purchase.shipping + purchase.tax and \
+                    amount['currency'] == purchase.item.currency:
+                POST = {'payer_email': purchase.subscriptionpurchase.email, 'txn_id': resource['id']}
+                self.do_do_accept_subscription_or_recurring_payment(transaction, purchase, POST, ref)
+            else:
+                logger.warning("Wrong subscription payment data")
+        else:
+            transaction_id = BaseTransaction.pk_from_custom_or_create(resource['custom'], PAYMENT_PROCESSOR_PAYPAL)
+            details = amount.get('details', {})
+            POST = {'mc_gross': amount['total'], 'mc_currency': amount['currency'],
+                    'shipping': details.get('shipping', '0'), 'tax': details.get('tax', '0'),
+                    'payer_email': None, 'txn_id': resource['id']}
+            self.do_do_accept_regular_payment(POST, transaction_id)
+
+    def on_sale_refunded_event(self, resource):
+        if not resource.get('custom'):
+            logger.warning("PayPal refund without custom")
+            return
+        transaction_id = BaseTransaction.pk_from_custom_or_create(resource['custom'], PAYMENT_PROCESSOR_PAYPAL)
+        self.do_appect_refund({'mc_currency': resource['amount']['currency']}, transaction_id)